@@ -73,6 +73,34 @@
 #   request body: application/x-www-form-urlencoded
 #   response body: status line
 #
+# Export identifiers matching search constraints:
+#   GET /export   [authentication required]
+#     ?format={csv|json}
+#     ?column={column}   (CSV only; repeatable)
+#     ?{search column}={value}   (see download.exportRequest)
+#   response body: on success, no status line; CSV or JSON lines
+#     (content type text/csv or application/x-ndjson) streamed back as
+#     identifiers are retrieved
+#
+# Page through identifiers matching search constraints:
+#   GET /search_page   [authentication required]
+#     ?pageSize={n}
+#     ?order={[-]search column}
+#     ?cursor={next or previous cursor from a preceding page}
+#     ?{search column}={value}   (see download.searchRequest)
+#   response body: on success, no status line; JSON object holding
+#     the page's identifiers and next and previous page cursors
+#
+# Create, update, or delete identifiers in batch:
+#   POST /batch   [authentication required]
+#     ?operation={create|update|delete}
+#     ?update_if_exists={yes|no}
+#   request body: sequence of records, each consisting of a
+#     ":: identifier" line followed by optional metadata
+#   response body: status line followed by, per record and in order,
+#     a ":: identifier" line and a status line, streamed back as
+#     records are processed
+#
 # Author:
 #   Greg Janee <gjanee@ucop.edu>
 #
@@ -83,6 +111,8 @@
 # -----------------------------------------------------------------------------
 
 import django.http
+import itertools
+import re
 import time
 
 import anvl
@@ -476,3 +506,151 @@ def batchDownloadRequest (request):
   elif not user:
     return _unauthorized()
   return _response(download.enqueueRequest(user, request.POST))
+
+def exportIdentifiers (request):
+  """
+  Streams an export of identifiers matching search constraints;
+  interface to download.exportRequest.
+  """
+  if request.method != "GET": return _methodNotAllowed()
+  user = userauth.authenticateRequest(request)
+  if type(user) is str:
+    return _response(user)
+  elif not user:
+    return _unauthorized()
+  r = download.exportRequest(user, request.GET)
+  if type(r) is str: return _response(r)
+  # The response closes the content, and thereby ends the search, when
+  # the server closes the response.
+  return django.http.StreamingHttpResponse(r[1], content_type=r[0])
+
+def searchPage (request):
+  """
+  Returns a page of identifiers matching search constraints;
+  interface to download.searchRequest.
+  """
+  if request.method != "GET": return _methodNotAllowed()
+  user = userauth.authenticateRequest(request)
+  if type(user) is str:
+    return _response(user)
+  elif not user:
+    return _unauthorized()
+  r = download.searchRequest(user, request.GET)
+  if r.startswith("error:"): return _response(r)
+  return django.http.HttpResponse(r, content_type="application/json")
+
+class _BatchInputException (Exception):
+  pass
+
+def _checkBatchContentType (request):
+  # Returns an error status if the request's content type is
+  # unacceptable, else None.
+  if "CONTENT_TYPE" in request.META:
+    ct = [w.strip() for w in request.META["CONTENT_TYPE"].split(";")]
+    if ct[0] != "text/plain":
+      return "error: bad request - unsupported content type"
+    if len(ct) > 1 and ct[1].startswith("charset=") and\
+      ct[1][8:].upper() != "UTF-8":
+      return "error: bad request - unsupported character encoding"
+  return None
+
+def _readBatchLines (request):
+  # Generates the lines of the request body, decoded and stripped of
+  # line terminators, reading the body incrementally.
+  for l in request:
+    l = l.decode("UTF-8")
+    ll = re.split("\r\n?|\n", l)
+    if ll[-1] == "" and len(ll) > 1: del ll[-1]
+    for l in ll: yield l
+
+def _readBatchInput (request):
+  # Generates (identifier, metadata dictionary) pairs as the request
+  # body is read, so that the body need not be held in memory.
+  # Raises _BatchInputException (carrying an error status) if the body
+  # is malformed.
+  identifier = None
+  lines = []
+  def record ():
+    # See _readInput regarding sanitizing after ANVL parsing.
+    return (identifier, { util.sanitizeXmlSafeCharset(k):\
+      util.sanitizeXmlSafeCharset(v)\
+      for k, v in anvl.parse("\n".join(lines)).items() })
+  try:
+    for l in _readBatchLines(request):
+      if l.startswith("::"):
+        if identifier != None:
+          r = record()
+          identifier = lines = None
+          yield r
+        identifier = l[2:].strip()
+        lines = []
+      elif identifier != None:
+        lines.append(l)
+      elif l.strip() != "" and not l.startswith("#"):
+        raise _BatchInputException(
+          "error: bad request - batch record lacks identifier line")
+    if identifier != None:
+      r = record()
+      identifier = None
+      yield r
+  except (_BatchInputException, GeneratorExit):
+    raise
+  except UnicodeDecodeError:
+    raise _BatchInputException(
+      "error: bad request - character decoding error")
+  except anvl.AnvlParseException, e:
+    raise _BatchInputException(
+      "error: bad request - ANVL parse error (%s)" % str(e))
+  except:
+    raise _BatchInputException(
+      "error: bad request - malformed or incomplete request body")
+
+def _batchResultGenerator (operation, records, user, options):
+  yield "success: batch results follow\n"
+  try:
+    for identifier, status in ezid.batchOperation(operation, records, user,
+      updateIfExists=options.get("update_if_exists", False),
+      updateExternalServices=options.get("update_external_services", True)):
+      yield (":: %s\n%s" % (identifier,
+        anvl.formatPair(*[v.strip() for v in status.split(":", 1)]))).\
+        encode("UTF-8")
+  except _BatchInputException, e:
+    # Records preceding the malformed input have been processed, and
+    # their results returned, by this point.
+    yield ("%s\n" % str(e)).encode("UTF-8")
+
+def batch (request):
+  """
+  Creates, updates, or deletes identifiers in batch; interface to
+  ezid.batchOperation.  The request body is read, and records are
+  processed, incrementally, and per-record results are streamed back
+  to the client as they become available.  Malformed input following
+  the first record is reported by a final, unlabeled error line.
+  """
+  if request.method != "POST": return _methodNotAllowed()
+  user = userauth.authenticateRequest(request)
+  if type(user) is str:
+    return _response(user)
+  elif not user:
+    return _unauthorized()
+  o = { "operation": ["create", "update", "delete"],
+    "update_if_exists": [("yes", True), ("no", False)] }
+  # Easter egg.
+  if user.isSuperuser:
+    o["update_external_services"] = [("yes", True), ("no", False)]
+  options = _validateOptions(request, o)
+  if type(options) is str: return _response(options)
+  if "operation" not in options:
+    return _response("error: bad request - no 'operation' parameter")
+  s = _checkBatchContentType(request)
+  if s != None: return _response(s)
+  records = _readBatchInput(request)
+  # Reading the first record now allows an entirely malformed request
+  # body to be reported as an ordinary error.
+  try:
+    first = next(records, None)
+  except _BatchInputException, e:
+    return _response(str(e))
+  return django.http.StreamingHttpResponse(_batchResultGenerator(
+    options["operation"], itertools.chain([first] if first != None else [],
+    records), user, options), content_type="text/plain; charset=UTF-8")
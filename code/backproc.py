@@ -4,6 +4,18 @@
 #
 # Background identifier processing.
 #
+# Update queue entries are processed in batches, in four stages:
+# deserialization; writing the search database; inserting into the
+# registrar queues; and removal from the update queue.  The search
+# database stage runs on a worker thread of its own, in parallel with
+# the registrar queue stage (the two stages write different
+# databases); the batch is removed from the update queue, in the same
+# store database transaction as the registrar queue insertions, only
+# once both have succeeded.  Batches are handed to the worker through
+# a bounded queue holding one batch at a time, so batches are applied
+# to both databases in update queue order, which preserves
+# per-identifier ordering.
+#
 # This module should be imported at server startup so that its daemon
 # thread is started.
 #
@@ -16,6 +28,7 @@
 #
 # -----------------------------------------------------------------------------
 
+import Queue
 import django.conf
 import django.db
 import django.db.transaction
@@ -29,7 +42,10 @@ import crossref
 import datacite_async
 import ezidapp.models
 import ezidapp.models.search_identifier
+import ezidapp.models.search_identifier_summary
+import ezidapp.models.search_identifier_tombstone
 import log
+import notification
 import search_util
 import util
 
@@ -38,18 +54,202 @@ _lock = threading.Lock()
 _runningThreads = set()
 _threadName = None
 _idleSleep = None
+_batchSize = None
+_maxAttempts = None
+
+# Per-stage processing statistics.  Each stage maps to a list [number
+# of update queue entries processed, elapsed seconds].
+
+_statisticsLock = threading.Lock()
+_stages = ["deserialize", "search", "registrar", "dequeue"]
+_statistics = None
+
+def _resetStatistics ():
+  global _statistics
+  _statisticsLock.acquire()
+  try:
+    _statistics = dict((s, [0, 0.0]) for s in _stages)
+  finally:
+    _statisticsLock.release()
+
+def _recordStatistics (stage, n, startTime):
+  t = time.time()
+  _statisticsLock.acquire()
+  try:
+    _statistics[stage][0] += n
+    _statistics[stage][1] += t-startTime
+  finally:
+    _statisticsLock.release()
+  return t
+
+def getStatistics ():
+  """
+  Returns per-stage processing statistics accumulated since the
+  previous call, as a list of (stage, number of update queue entries
+  processed, elapsed seconds) tuples in processing order.
+  """
+  _statisticsLock.acquire()
+  try:
+    l = [(s, _statistics[s][0], _statistics[s][1]) for s in _stages]
+  finally:
+    _statisticsLock.release()
+  _resetStatistics()
+  return l
 
-def _updateSearchDatabase (identifier, operation, metadata, blob):
-  if operation in ["create", "update"]:
-    ezidapp.models.search_identifier.updateFromLegacy(identifier, metadata)
-  elif operation == "delete":
-    ezidapp.models.SearchIdentifier.objects.filter(identifier=identifier).\
-      delete()
-  else:
-    assert False, "unrecognized operation"
+_resetStatistics()
 
-def _checkContinue ():
-  return _enabled and threading.currentThread().getName() == _threadName
+def _updateSearchDatabase (batch):
+  # Applies a batch of update queue entries to the search database.
+  # The batch is a list of (UpdateQueue object, metadata, blob)
+  # tuples.  Only the last operation on each identifier need be
+  # applied, for each entry fully describes the identifier's state.
+  last = {}
+  for uq, metadata, blob in batch:
+    if uq.actualObject.owner != None: last[uq.identifier] = (uq, metadata)
+  upserts = []
+  deletes = []
+  for identifier, (uq, metadata) in last.items():
+    if uq.operation in [ezidapp.models.UpdateQueue.CREATE,
+      ezidapp.models.UpdateQueue.UPDATE]:
+      upserts.append((identifier, metadata))
+    elif uq.operation == ezidapp.models.UpdateQueue.DELETE:
+      deletes.append(identifier)
+    else:
+      assert False, "unrecognized operation"
+  with django.db.transaction.atomic(using="search"):
+    before = ezidapp.models.search_identifier_summary.tally(last.keys())
+    visible = ezidapp.models.search_identifier_tombstone.getVisible(
+      last.keys())
+    ezidapp.models.search_identifier.updateMultipleFromLegacy(upserts)
+    ezidapp.models.search_identifier.deleteMultiple(deletes)
+    ezidapp.models.search_identifier_summary.adjust(before,
+      ezidapp.models.search_identifier_summary.tally(last.keys()))
+    # Identifiers deleted or no longer OAI-visible are recorded as
+    # deleted for the benefit of OAI-PMH harvesters.
+    ezidapp.models.search_identifier_tombstone.record(visible,
+      ezidapp.models.search_identifier_tombstone.getVisible(last.keys()),
+      dict((identifier, uq.enqueueTime)\
+      for identifier, (uq, metadata) in last.items()))
+  # Any change may affect the results of public searches, for an
+  # identifier may have been made or ceased to be publicly visible.
+  search_util.invalidateResultCache(
+    set(uq.actualObject.owner.username for uq, metadata in last.values()),
+    set(uq.actualObject.ownergroup.groupname\
+    for uq, metadata in last.values()), len(last) > 0)
+
+def _enqueueRegistrars (batch):
+  # Inserts a batch of update queue entries into the registrar queues.
+  # Entries are inserted in batch order, thereby preserving per
+  # identifier ordering.
+  binder = []
+  datacite = []
+  crossrefs = []
+  for uq, metadata, blob in batch:
+    if not uq.actualObject.isReserved:
+      op = uq.get_operation_display()
+      binder.append((uq.identifier, op, blob))
+      if uq.updateExternalServices:
+        if uq.actualObject.isDatacite:
+          if not uq.actualObject.isTest:
+            datacite.append((uq.identifier, op, blob))
+        elif uq.actualObject.isCrossref:
+          crossrefs.append((uq.identifier, op, metadata, blob))
+  binder_async.enqueueIdentifiers(binder)
+  datacite_async.enqueueIdentifiers(datacite)
+  crossref.enqueueIdentifiers(crossrefs)
+
+def _checkContinue (threadName=None):
+  if threadName == None: threadName = threading.currentThread().getName()
+  return _enabled and threadName == _threadName
+
+class _SearchWorker (object):
+  # Applies batches of update queue entries to the search database on
+  # a thread of its own on behalf of daemon thread 'daemonName'.  At
+  # most one batch is in progress at a time.
+
+  def __init__ (self, daemonName):
+    self.daemonName = daemonName
+    self.requests = Queue.Queue(1)
+    self.responses = Queue.Queue(1)
+    t = threading.Thread(target=self._run, name=daemonName + "/search")
+    t.setDaemon(True)
+    t.start()
+
+  def _run (self):
+    while True:
+      try:
+        batch = self.requests.get(timeout=_idleSleep)
+      except Queue.Empty:
+        django.db.connections["search"].close()
+        continue
+      if batch == None: break
+      t = time.time()
+      try:
+        search_util.withAutoReconnect("backproc._updateSearchDatabase",
+          lambda: _updateSearchDatabase(batch),
+          lambda: _checkContinue(self.daemonName))
+        _recordStatistics("search", len(batch), t)
+        self.responses.put(None)
+      except Exception, e:
+        self.responses.put(e)
+    django.db.connections["search"].close()
+
+  def submit (self, batch):
+    # Starts applying a batch.  'result' must be called before another
+    # batch is submitted.
+    self.requests.put(batch)
+
+  def result (self):
+    # Waits for the submitted batch to be applied.  Returns None on
+    # success, or the exception raised.
+    return self.responses.get()
+
+  def close (self):
+    self.requests.put(None)
+
+def _processBatch (l, worker):
+  # Processes a list of update queue entries.
+  # Stage 1: deserialization (which, for the StoreIdentifier objects,
+  # happens as the rows are loaded).  The use of legacy
+  # representations and blobs will go away soon.
+  t = time.time()
+  batch = []
+  for uq in l:
+    metadata = uq.actualObject.toLegacy()
+    batch.append((uq, metadata, util.blobify(metadata)))
+  _recordStatistics("deserialize", len(l), t)
+  # Stage 2 (search database) runs in parallel with stage 3
+  # (registrar queues).  Stage 4 (removal from the update queue) must
+  # be performed atomically with stage 3, and only if stage 2
+  # succeeded.
+  worker.submit(batch)
+  pending = True
+  try:
+    with django.db.transaction.atomic():
+      t = time.time()
+      _enqueueRegistrars(batch)
+      _recordStatistics("registrar", len(l), t)
+      e = worker.result()
+      pending = False
+      if e != None: raise e
+      t = time.time()
+      ezidapp.models.UpdateQueue.objects.filter(seq__in=[uq.seq\
+        for uq in l]).delete()
+    _recordStatistics("dequeue", len(l), t)
+  finally:
+    if pending: worker.result()
+
+def _discard (uq):
+  # Removes an update queue entry that cannot be processed.  The entry
+  # is logged so that the identifier can be repaired (e.g., by
+  # re-saving it) by an administrator.
+  try:
+    ezidapp.models.UpdateQueue.objects.filter(seq=uq.seq).delete()
+    log.otherError("backproc._discard", Exception(
+      "discarded update queue entry %d (%s, %s) after %d failed attempts" %\
+      (uq.seq, uq.identifier, uq.get_operation_display(), _maxAttempts)))
+  except Exception, e:
+    log.otherError("backproc._discard", e)
 
 def _backprocDaemon ():
   _lock.acquire()
@@ -74,45 +274,53 @@ def _backprocDaemon ():
       time.sleep(_idleSleep)
   except AssertionError, e:
     log.otherError("backproc._backprocDaemon", e)
-  # Regular processing.
+  # Regular processing.  Should processing a batch fail, we fall back
+  # to processing entries singly until we're past the batch, so that a
+  # problematic entry does not hold up the entries preceding it.  An
+  # entry that repeatedly fails to be processed (for reasons other than
+  # database connectivity) is eventually discarded, so that it does
+  # not block the queue.
+  singlyThrough = None
+  failures = (None, 0)
+  worker = _SearchWorker(threading.currentThread().getName())
+  listener = notification.Listener("UpdateQueue")
   while _checkContinue():
+    l = []
     try:
-      l = list(ezidapp.models.UpdateQueue.objects.all().order_by("seq")[:1000])
+      l = list(ezidapp.models.UpdateQueue.objects.all().order_by("seq")\
+        [:(_batchSize if singlyThrough == None else 1)])
       if len(l) > 0:
-        for uq in l:
-          if not _checkContinue(): break
-          # The use of legacy representations and blobs will go away soon.
-          metadata = uq.actualObject.toLegacy()
-          blob = util.blobify(metadata)
-          if uq.actualObject.owner != None:
-            try:
-              search_util.withAutoReconnect("backproc._updateSearchDatabase",
-                lambda: _updateSearchDatabase(uq.identifier,
-                uq.get_operation_display(), metadata, blob), _checkContinue)
-            except search_util.AbortException:
-              break
-          with django.db.transaction.atomic():
-            if not uq.actualObject.isReserved:
-              binder_async.enqueueIdentifier(uq.identifier,
-                uq.get_operation_display(), blob)
-              if uq.updateExternalServices:
-                if uq.actualObject.isDatacite:
-                  if not uq.actualObject.isTest:
-                    datacite_async.enqueueIdentifier(uq.identifier,
-                      uq.get_operation_display(), blob)
-                elif uq.actualObject.isCrossref:
-                  crossref.enqueueIdentifier(uq.identifier,
-                    uq.get_operation_display(), metadata, blob)
-            uq.delete()
+        if singlyThrough != None and l[0].seq > singlyThrough:
+          singlyThrough = None
+          continue
+        _processBatch(l, worker)
+        if failures[0] == l[-1].seq: failures = (None, 0)
       else:
-        django.db.connections["default"].close()
-        django.db.connections["search"].close()
-        time.sleep(_idleSleep)
+        singlyThrough = None
+        # Wait for entries to be enqueued.  Database connections are
+        # closed only if we've been idle for a while.
+        if not listener.wait(_idleSleep):
+          django.db.connections["default"].close()
+          django.db.connections["search"].close()
+    except search_util.AbortException:
+      break
     except Exception, e:
       log.otherError("backproc._backprocDaemon", e)
+      if len(l) > 1:
+        singlyThrough = l[-1].seq
+      elif len(l) == 1 and not isinstance(e, django.db.OperationalError):
+        if failures[0] == l[0].seq:
+          failures = (l[0].seq, failures[1]+1)
+        else:
+          failures = (l[0].seq, 1)
+        if failures[1] >= _maxAttempts:
+          _discard(l[0])
+          failures = (None, 0)
       django.db.connections["default"].close()
       django.db.connections["search"].close()
       time.sleep(_idleSleep)
+  worker.close()
+  listener.close()
   _lock.acquire()
   try:
     _runningThreads.remove(threading.currentThread().getName())
@@ -120,11 +328,14 @@ def _backprocDaemon ():
     _lock.release()
 
 def _loadConfig ():
-  global _enabled, _idleSleep, _threadName
+  global _enabled, _idleSleep, _threadName, _batchSize, _maxAttempts
   _enabled = django.conf.settings.DAEMON_THREADS_ENABLED and\
     config.get("daemons.backproc_enabled").lower() == "true"
   if _enabled:
     _idleSleep = int(config.get("daemons.background_processing_idle_sleep"))
+    _batchSize = int(config.get("daemons.background_processing_batch_size"))
+    _maxAttempts =\
+      int(config.get("daemons.background_processing_max_attempts"))
     _threadName = uuid.uuid1().hex
     t = threading.Thread(target=_backprocDaemon, name=_threadName)
     t.setDaemon(True)
@@ -67,6 +67,14 @@ def enqueueIdentifier (identifier, operation, blob):
   register_async.enqueueIdentifier(ezidapp.models.BinderQueue,
     identifier, operation, blob)
 
+def enqueueIdentifiers (entries):
+  """
+  Adds multiple identifiers to the binder asynchronous processing
+  queue.  'entries' should be a list of (identifier, operation, blob)
+  tuples as in enqueueIdentifier.
+  """
+  register_async.enqueueIdentifiers(ezidapp.models.BinderQueue, entries)
+
 def getQueueLength ():
   """
   Returns the length of the binder queue.
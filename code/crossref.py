@@ -17,6 +17,7 @@ import django.conf
 import django.core.mail
 import django.db
 import django.db.models
+import django.db.transaction
 import lxml.etree
 import re
 import threading
@@ -28,7 +29,9 @@ import uuid
 import ezid
 import ezidapp.models
 import config
+import http_pool
 import log
+import notification
 import util
 import util2
 
@@ -47,6 +50,11 @@ _idleSleep = None
 _ezidUrl = None
 _dataciteEnabled = None
 
+# The maximum number of superseded queue entries deleted per database
+# statement.
+
+_deleteBatchSize = 500
+
 def _loadConfig ():
   global _enabled, _depositorName, _depositorEmail, _realServer, _testServer
   global _depositUrl, _resultsUrl, _username, _password
@@ -297,11 +305,9 @@ def _submitDeposit (deposit, batchId, doi):
   url = _depositUrl %\
     (_testServer if util2.isTestCrossrefDoi(doi) else _realServer)
   try:
-    c = None
     try:
-      c = urllib2.urlopen(urllib2.Request(url, body,
-        { "Content-Type": "multipart/form-data; boundary=" + boundary }))
-      r = c.read()
+      r = http_pool.request("POST", url, body,
+        { "Content-Type": "multipart/form-data; boundary=" + boundary }).read()
       assert "Your batch submission was successfully received." in r,\
         "unexpected return from metadata submission: " + r
     except urllib2.HTTPError, e:
@@ -314,8 +320,6 @@ def _submitDeposit (deposit, batchId, doi):
           if not e.msg.endswith("\n"): e.msg += "\n"
           e.msg += m
       raise e
-    finally:
-      if c: c.close()
   except Exception, e:
     log.otherError("crossref._submitDeposit",
       _wrapException("error submitting deposit, doi %s, batch %s" %\
@@ -354,12 +358,10 @@ def _pollDepositStatus (batchId, doi):
   url = _resultsUrl %\
     (_testServer if util2.isTestCrossrefDoi(doi) else _realServer)
   try:
-    c = None
     try:
-      c = urllib2.urlopen("%s?%s" % (url,
+      response = http_pool.request("GET", "%s?%s" % (url,
         urllib.urlencode({ "usr": _username, "pwd": _password,
-        "file_name": batchId + ".xml", "type": "result" })))
-      response = c.read()
+        "file_name": batchId + ".xml", "type": "result" }))).read()
     except urllib2.HTTPError, e:
       if e.fp != None:
         try:
@@ -370,8 +372,6 @@ def _pollDepositStatus (batchId, doi):
           if not e.msg.endswith("\n"): e.msg += "\n"
           e.msg += m
       raise e
-    finally:
-      if c: c.close()
     try:
       # We leave the returned XML undecoded, and let lxml decode it
       # based on the embedded encoding declaration.
@@ -422,6 +422,20 @@ def enqueueIdentifier (identifier, operation, metadata, blob):
     metadata=blob,
     operation=ezidapp.models.CrossrefQueue.operationLabelToCode(operation))
   e.save()
+  notification.signal("CrossrefQueue")
+
+def enqueueIdentifiers (entries):
+  """
+  Adds multiple identifiers to the Crossref queue using multi-row
+  inserts.  'entries' should be a list of (identifier, operation,
+  metadata, blob) tuples as in enqueueIdentifier.
+  """
+  ezidapp.models.CrossrefQueue.objects.bulk_create([
+    ezidapp.models.CrossrefQueue(identifier=identifier, owner=metadata["_o"],
+    metadata=blob,
+    operation=ezidapp.models.CrossrefQueue.operationLabelToCode(operation))\
+    for identifier, operation, metadata, blob in entries], batch_size=100)
+  notification.signal("CrossrefQueue")
 
 def getQueueStatistics ():
   """
@@ -504,13 +518,25 @@ def _sendEmail (emailAddress, r):
 def _oneline (s):
   return re.sub("\s", " ", s)
 
-def _doPoll (r):
+def _doPoll (r, completed):
+  # Completed deposits are appended to list 'completed' for
+  # processing by _finishPolls.
   t = _pollDepositStatus(r.batchId, r.identifier[4:])
   if t[0] == "submitted":
     r.message = t[1]
     _checkAbort()
     r.save()
   elif t[0].startswith("completed"):
+    completed.append((r, t))
+  else:
+    pass
+
+def _finishPolls (completed):
+  # Processes completed deposits, which are (queue entry, poll result)
+  # tuples.  Identifiers' Crossref statuses are updated in a single
+  # batch operation.
+  updates = []
+  for r, t in completed:
     # Deleted identifiers aren't retained in the queue, but just to
     # make it clear...
     if r.operation != ezidapp.models.CrossrefQueue.DELETE:
@@ -523,14 +549,22 @@ def _doPoll (r):
         else:
           crs = ezidapp.models.StoreIdentifier.CR_FAILURE
         crm = _oneline(t[1]).strip()
-      _checkAbort()
-      # We update the identifier's Crossref status in the store and
-      # search databases, but do so in such a way as to avoid
-      # infinite loops and triggering further updates to DataCite or
-      # Crossref.
-      s = ezid.setMetadata(r.identifier, ezidapp.models.getAdminUser(),
-        { "_crossref": "%s/%s" % (crs, crm) }, updateExternalServices=False)
-      assert s.startswith("success:"), "ezid.setMetadata failed: " + s
+      updates.append((r.identifier, { "_crossref": "%s/%s" % (crs, crm) }))
+  failed = set()
+  if len(updates) > 0:
+    _checkAbort()
+    # We update the identifiers' Crossref statuses in the store and
+    # search databases, but do so in such a way as to avoid infinite
+    # loops and triggering further updates to DataCite or Crossref.
+    for identifier, s in ezid.batchOperation("update", updates,
+      ezidapp.models.getAdminUser(), updateExternalServices=False):
+      if not s.startswith("success:"):
+        # The queue entry is left as is and will be polled again.
+        failed.add(identifier)
+        log.otherError("crossref._finishPolls",
+          Exception("ezid.setMetadata failed: " + s))
+  for r, t in completed:
+    if r.identifier in failed: continue
     if t[0] == "completed successfully":
       _checkAbort()
       r.delete()
@@ -546,15 +580,18 @@ def _doPoll (r):
         _sendEmail(u.crossrefEmail, r)
       _checkAbort()
       r.save()
-  else:
-    pass
 
 def _daemonThread ():
+  # Submitted deposits must be polled periodically, so we process the
+  # queue every idle sleep interval regardless, but also immediately
+  # upon identifiers being enqueued.  Database connections are closed
+  # only if no identifiers were enqueued during the interval.
+  listener = notification.Listener("CrossrefQueue")
   maxSeq = None
   while True:
-    django.db.connections["default"].close()
-    django.db.connections["search"].close()
-    time.sleep(_idleSleep)
+    if not listener.wait(_idleSleep):
+      django.db.connections["default"].close()
+      django.db.connections["search"].close()
     try:
       _checkAbort()
       # First, a quick test to avoid retrieving the entire table if
@@ -567,33 +604,41 @@ def _daemonThread ():
           continue
       # Hopefully the queue will not grow so large that the following
       # query will cause a burden.
-      query = _queue().objects.all().order_by("seq")
+      query = list(_queue().objects.all().order_by("seq"))
       if len(query) > 0:
-        maxSeq = query[len(query)-1].seq
+        maxSeq = query[-1].seq
       else:
         maxSeq = None
+      # If there are multiple entries for an identifier, all but the
+      # last, i.e., the latest, represent superseded modifications.
+      # Hence we simply delete them regardless of their status.
+      latest = dict((r.identifier, r.seq) for r in query)
+      redundant = [r.seq for r in query if r.seq != latest[r.identifier]]
+      if len(redundant) > 0:
+        _checkAbort()
+        with django.db.transaction.atomic():
+          for i in range(0, len(redundant), _deleteBatchSize):
+            _queue().objects.filter(
+              seq__in=redundant[i:i+_deleteBatchSize]).delete()
+        query = [r for r in query if r.seq == latest[r.identifier]]
+        maxSeq = None
+      completed = []
       for r in query:
-        # If there are multiple entries for this identifier, we are
-        # necessarily looking at the first, i.e., the earliest, and
-        # the others must represent subsequent modifications.  Hence
-        # we simply delete this entry regardless of its status.
-        if _queue().objects.filter(identifier=r.identifier).count() > 1:
-          r.delete()
+        if r.status == ezidapp.models.CrossrefQueue.UNSUBMITTED:
+          _doDeposit(r)
+          maxSeq = None
+        elif r.status == ezidapp.models.CrossrefQueue.SUBMITTED:
+          _doPoll(r, completed)
           maxSeq = None
         else:
-          if r.status == ezidapp.models.CrossrefQueue.UNSUBMITTED:
-            _doDeposit(r)
-            maxSeq = None
-          elif r.status == ezidapp.models.CrossrefQueue.SUBMITTED:
-            _doPoll(r)
-            maxSeq = None
-          else:
-            pass
+          pass
+      _finishPolls(completed)
     except _AbortException:
       break
     except Exception, e:
       log.otherError("crossref._daemonThread", e)
       maxSeq = None
+  listener.close()
 
 _loadConfig()
 config.registerReloadListener(_loadConfig)
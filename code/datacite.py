@@ -23,13 +23,13 @@ import os
 import os.path
 import re
 import threading
-import time
 import urllib
 import urllib2
 
 import config
 import ezidapp.models
 import ezidapp.models.validation
+import http_pool
 import mapping
 import util
 
@@ -99,15 +99,6 @@ def numActiveOperations ():
   finally:
     _lock.release()
 
-class _HTTPErrorProcessor (urllib2.HTTPErrorProcessor):
-  def http_response (self, request, response):
-    # Bizarre that Python considers this an error.
-    if response.code == 201:
-      return response
-    else:
-      return urllib2.HTTPErrorProcessor.http_response(self, request, response)
-  https_response = http_response
-
 def _authorization (doi, datacenter=None):
   if datacenter == None:
     s = ezidapp.models.getLongestShoulderMatch("doi:" + doi)
@@ -119,6 +110,23 @@ def _authorization (doi, datacenter=None):
   assert p is not None, "no such allocator: " + a
   return "Basic " + base64.b64encode(datacenter + ":" + p)
 
+def _request (method, url, doi, datacenter, contentType=None, body=None):
+  # Issues a DataCite request over a pooled connection and returns the
+  # response body.  To hide transient network errors (and, for
+  # registration, transient problems with the Handle system underlying
+  # the DataCite service), multiple attempts are made.  We manually
+  # supply the HTTP Basic authorization header to avoid the doubling
+  # of the number of HTTP transactions caused by the challenge/response
+  # model.
+  headers = { "Authorization": _authorization(doi, datacenter) }
+  if contentType != None: headers["Content-Type"] = contentType
+  _modifyActiveCount(1)
+  try:
+    return http_pool.request(method, url, body, headers, timeout=_timeout,
+      numAttempts=_numAttempts, reattemptDelay=_reattemptDelay).read()
+  finally:
+    _modifyActiveCount(-1)
+
 def registerIdentifier (doi, targetUrl, datacenter=None):
   """
   Registers a scheme-less DOI identifier (e.g., "10.5060/FOO") and
@@ -129,36 +137,16 @@ def registerIdentifier (doi, targetUrl, datacenter=None):
   DataCite; or a thrown exception on other error.
   """
   if not _enabled: return None
-  # To deal with transient problems with the Handle system underlying
-  # the DataCite service, we make multiple attempts.
-  for i in range(_numAttempts):
-    o = urllib2.build_opener(_HTTPErrorProcessor)
-    r = urllib2.Request(_doiUrl)
-    # We manually supply the HTTP Basic authorization header to avoid
-    # the doubling of the number of HTTP transactions caused by the
-    # challenge/response model.
-    r.add_header("Authorization", _authorization(doi, datacenter))
-    r.add_header("Content-Type", "text/plain; charset=UTF-8")
-    r.add_data(("doi=%s\nurl=%s" % (doi.replace("\\", "\\\\"),
+  try:
+    r = _request("POST", _doiUrl, doi, datacenter,
+      "text/plain; charset=UTF-8",
+      ("doi=%s\nurl=%s" % (doi.replace("\\", "\\\\"),
       targetUrl.replace("\\", "\\\\"))).encode("UTF-8"))
-    c = None
-    try:
-      _modifyActiveCount(1)
-      c = o.open(r, timeout=_timeout)
-      assert c.read() == "OK",\
-        "unexpected return from DataCite register DOI operation"
-    except urllib2.HTTPError, e:
-      message = e.fp.read()
-      if e.code == 400 and message.startswith("[url]"): return message
-      if e.code != 500 or i == _numAttempts-1: raise e
-    except:
-      if i == _numAttempts-1: raise
-    else:
-      break
-    finally:
-      _modifyActiveCount(-1)
-      if c: c.close()
-    time.sleep(_reattemptDelay)
+  except urllib2.HTTPError, e:
+    message = e.fp.read()
+    if e.code == 400 and message.startswith("[url]"): return message
+    raise
+  assert r == "OK", "unexpected return from DataCite register DOI operation"
   return None
 
 def setTargetUrl (doi, targetUrl, datacenter=None):
@@ -178,28 +166,12 @@ def getTargetUrl (doi, datacenter=None):
   identifier is not registered.  'datacenter', if specified, should be
   the identifier's datacenter, e.g., "CDL.BUL".
   """
-  # To hide transient network errors, we make multiple attempts.
-  for i in range(_numAttempts):
-    o = urllib2.build_opener(_HTTPErrorProcessor)
-    r = urllib2.Request(_doiUrl + "/" + urllib.quote(doi))
-    # We manually supply the HTTP Basic authorization header to avoid
-    # the doubling of the number of HTTP transactions caused by the
-    # challenge/response model.
-    r.add_header("Authorization", _authorization(doi, datacenter))
-    c = None
-    try:
-      _modifyActiveCount(1)
-      c = o.open(r, timeout=_timeout)
-      return c.read()
-    except urllib2.HTTPError, e:
-      if e.code == 404: return None
-      if e.code != 500 or i == _numAttempts-1: raise e
-    except:
-      if i == _numAttempts-1: raise
-    finally:
-      _modifyActiveCount(-1)
-      if c: c.close()
-    time.sleep(_reattemptDelay)
+  try:
+    return _request("GET", _doiUrl + "/" + urllib.quote(doi), doi,
+      datacenter)
+  except urllib2.HTTPError, e:
+    if e.code == 404: return None
+    raise
 
 _prologRE = re.compile("(<\?xml\s+version\s*=\s*['\"]([-\w.:]+)[\"'])" +\
   "(\s+encoding\s*=\s*['\"]([-\w.]+)[\"'])?")
@@ -436,62 +408,21 @@ def uploadMetadata (doi, current, delta, forceUpload=False, datacenter=None):
     return "DOI metadata requirements not satisfied: " + str(e)
   if newRecord == oldRecord and not forceUpload: return None
   if not _enabled: return None
-  # To hide transient network errors, we make multiple attempts.
-  for i in range(_numAttempts):
-    o = urllib2.build_opener(_HTTPErrorProcessor)
-    r = urllib2.Request(_metadataUrl)
-    # We manually supply the HTTP Basic authorization header to avoid
-    # the doubling of the number of HTTP transactions caused by the
-    # challenge/response model.
-    r.add_header("Authorization", _authorization(doi, datacenter))
-    r.add_header("Content-Type", "application/xml; charset=UTF-8")
-    r.add_data(newRecord.encode("UTF-8"))
-    c = None
-    try:
-      _modifyActiveCount(1)
-      c = o.open(r, timeout=_timeout)
-      s = c.read()
-      assert s.startswith("OK"),\
-        "unexpected return from DataCite store metadata operation: " + s
-    except urllib2.HTTPError, e:
-      message = e.fp.read()
-      if e.code in [400, 422]: return "element 'datacite': " + message
-      if e.code != 500 or i == _numAttempts-1: raise e
-    except:
-      if i == _numAttempts-1: raise
-    else:
-      return None
-    finally:
-      _modifyActiveCount(-1)
-      if c: c.close()
-    time.sleep(_reattemptDelay)
+  try:
+    s = _request("POST", _metadataUrl, doi, datacenter,
+      "application/xml; charset=UTF-8", newRecord.encode("UTF-8"))
+  except urllib2.HTTPError, e:
+    message = e.fp.read()
+    if e.code in [400, 422]: return "element 'datacite': " + message
+    raise
+  assert s.startswith("OK"),\
+    "unexpected return from DataCite store metadata operation: " + s
+  return None
 
 def _deactivate (doi, datacenter):
-  # To hide transient network errors, we make multiple attempts.
-  for i in range(_numAttempts):
-    o = urllib2.build_opener(_HTTPErrorProcessor)
-    r = urllib2.Request(_metadataUrl + "/" + urllib.quote(doi))
-    # We manually supply the HTTP Basic authorization header to avoid
-    # the doubling of the number of HTTP transactions caused by the
-    # challenge/response model.
-    r.add_header("Authorization", _authorization(doi, datacenter))
-    r.get_method = lambda: "DELETE"
-    c = None
-    try:
-      _modifyActiveCount(1)
-      c = o.open(r, timeout=_timeout)
-      assert c.read() == "OK",\
-        "unexpected return from DataCite deactivate DOI operation"
-    except urllib2.HTTPError, e:
-      if e.code != 500 or i == _numAttempts-1: raise e
-    except:
-      if i == _numAttempts-1: raise
-    else:
-      break
-    finally:
-      _modifyActiveCount(-1)
-      if c: c.close()
-    time.sleep(_reattemptDelay)
+  r = _request("DELETE", _metadataUrl + "/" + urllib.quote(doi), doi,
+    datacenter)
+  assert r == "OK", "unexpected return from DataCite deactivate DOI operation"
 
 def deactivate (doi, datacenter=None):
   """
@@ -541,27 +472,13 @@ def pingDataciteOnly ():
   Tests the DataCite API (only), returning "up" or "down".
   """
   if not _enabled: return "up"
-  # To hide transient network errors, we make multiple attempts.
-  for i in range(_numAttempts):
-    o = urllib2.build_opener(_HTTPErrorProcessor)
-    r = urllib2.Request(_doiUrl + "/" + _pingDoi)
-    # We manually supply the HTTP Basic authorization header to avoid
-    # the doubling of the number of HTTP transactions caused by the
-    # challenge/response model.
-    r.add_header("Authorization", _authorization(_pingDoi, _pingDatacenter))
-    c = None
-    try:
-      _modifyActiveCount(1)
-      c = o.open(r, timeout=_timeout)
-      assert c.read() == _pingTarget
-    except:
-      if i == _numAttempts-1: return "down"
-    else:
-      return "up"
-    finally:
-      _modifyActiveCount(-1)
-      if c: c.close()
-    time.sleep(_reattemptDelay)
+  try:
+    r = _request("GET", _doiUrl + "/" + _pingDoi, _pingDoi, _pingDatacenter)
+    assert r == _pingTarget
+  except:
+    return "down"
+  else:
+    return "up"
 
 def dcmsRecordToHtml (record):
   """
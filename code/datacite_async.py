@@ -61,6 +61,14 @@ def enqueueIdentifier (identifier, operation, blob):
   register_async.enqueueIdentifier(ezidapp.models.DataciteQueue,
     identifier, operation, blob)
 
+def enqueueIdentifiers (entries):
+  """
+  Adds multiple identifiers to the DataCite asynchronous processing
+  queue.  'entries' should be a list of (identifier, operation, blob)
+  tuples as in enqueueIdentifier.
+  """
+  register_async.enqueueIdentifiers(ezidapp.models.DataciteQueue, entries)
+
 def getQueueLength ():
   """
   Returns the length of the DataCite queue.
@@ -21,10 +21,13 @@
 #
 # -----------------------------------------------------------------------------
 
+import cStringIO
 import csv
 import django.conf
 import django.core.mail
 import hashlib
+import itertools
+import json
 import os
 import os.path
 import re
@@ -37,7 +40,9 @@ import anvl
 import config
 import ezidapp.models
 import log
+import notification
 import policy
+import search_util
 import util
 import util2
 
@@ -49,10 +54,11 @@ _threadName = None
 _idleSleep = None
 _gzipCommand = None
 _zipCommand = None
+_maxPageSize = None
 
 def _loadConfig ():
   global _ezidUrl, _usedFilenames, _daemonEnabled, _threadName, _idleSleep
-  global _gzipCommand, _zipCommand
+  global _gzipCommand, _zipCommand, _maxPageSize
   _ezidUrl = config.get("DEFAULT.ezid_base_url")
   _lock.acquire()
   try:
@@ -66,6 +72,7 @@ def _loadConfig ():
   _idleSleep = int(config.get("daemons.download_processing_idle_sleep"))
   _gzipCommand = config.get("DEFAULT.gzip_command")
   _zipCommand = config.get("DEFAULT.zip_command")
+  _maxPageSize = int(config.get("search.max_page_size"))
   _daemonEnabled = (django.conf.settings.DAEMON_THREADS_ENABLED and\
     config.get("daemons.download_enabled").lower() == "true")
   if _daemonEnabled:
@@ -303,6 +310,7 @@ def enqueueRequest (user, request):
       options=_encode(options), notify=_encode(notify), filename=filename,
       toHarvest=",".join(toHarvest))
     r.save()
+    notification.signal("DownloadQueue")
     return "success: %s/download/%s.%s" % (_ezidUrl, filename,
       _fileSuffix(r))
   except Exception, e:
@@ -469,6 +477,7 @@ def _harvest1 (r, f):
       identifier__gt=r.lastId)\
       .filter(owner__pid=r.toHarvest.split(",")[r.currentIndex])\
       .select_related("owner", "ownergroup", "datacenter", "profile")\
+      .defer("oaiDublinCoreRecord", "oaiDataciteRecord")\
       .order_by("identifier")
     ids = list(qs[:1000])
     if len(ids) == 0: break
@@ -616,12 +625,15 @@ def _notifyRequestor (r):
   r.delete()
 
 def _daemonThread ():
+  listener = notification.Listener("DownloadQueue")
   doSleep = True
   while True:
     if doSleep:
-      django.db.connections["default"].close()
-      django.db.connections["search"].close()
-      time.sleep(_idleSleep)
+      # Wait for a request to be enqueued.  Database connections are
+      # closed only if we've been idle for a while.
+      if not listener.wait(_idleSleep):
+        django.db.connections["default"].close()
+        django.db.connections["search"].close()
     try:
       _checkAbort()
       r = ezidapp.models.DownloadQueue.objects.all().order_by("seq")[:1]
@@ -649,7 +661,304 @@ def _daemonThread ():
       break
     except Exception, e:
       log.otherError("download._daemonThread", e)
-      doSleep = True
+      django.db.connections["default"].close()
+      django.db.connections["search"].close()
+      time.sleep(_idleSleep)
+      doSleep = False
+  listener.close()
+
+# Streaming export follows.  Unlike a batch download, an export is
+# produced synchronously and streamed directly to the requestor, and
+# is constrained using the search columns accepted by
+# search_util.formulateQuery rather than the batch download
+# parameters.
+
+def _validateRange (v, validator):
+  l = v.split(",")
+  if len(l) != 2: raise _ValidationException("invalid range")
+  return tuple(validator(b) if b.strip() != "" else None for b in l)
+
+def _validateYear (v):
+  try:
+    return int(v)
+  except:
+    raise _ValidationException("invalid year")
+
+_exportParameters = {
+  # name: (repeatable, validator)
+  "column": (True, _validateString),
+  "convertTimestamps": (False, _validateBoolean),
+  "createTime": (False, lambda v: _validateRange(v, _validateTimestamp)),
+  "crossref": (False, _validateBoolean),
+  "crossrefStatus": (True, _validateString),
+  "exported": (False, _validateBoolean),
+  "format": (False, lambda v: _validateEnumerated(v, ["csv", "json"])),
+  "hasIssues": (False, _validateBoolean),
+  "hasMetadata": (False, _validateBoolean),
+  "identifier": (False, _validateString),
+  "identifierType": (True, lambda v: _validateEnumerated(v, ["ark", "doi",
+    "uuid"])),
+  "isTest": (False, _validateBoolean),
+  "keywords": (False, _validateString),
+  "linkIsBroken": (False, _validateBoolean),
+  "owner": (True, _validateUser),
+  "ownergroup": (True, _validateGroup),
+  "profile": (True, _validateString),
+  "resourceCreator": (False, _validateString),
+  "resourcePublicationYear": (False,
+    lambda v: _validateRange(v, _validateYear)),
+  "resourcePublisher": (False, _validateString),
+  "resourceTitle": (False, _validateString),
+  "resourceType": (True, _validateString),
+  "status": (True, lambda v: _validateEnumerated(v, ["reserved", "public",
+    "unavailable"])),
+  "target": (False, _validateString),
+  "targetHost": (False, _validateString),
+  "targetPrefix": (False, _validateString),
+  "updateTime": (False, lambda v: _validateRange(v, _validateTimestamp))
+}
+
+_exportContentType = {
+  "csv": "text/csv; charset=UTF-8",
+  "json": "application/x-ndjson; charset=UTF-8"
+}
+
+def _parseSearchParameters (request, parameters):
+  # Validates the parameters of an export or search page request
+  # against 'parameters', which is structured as _exportParameters
+  # above.  Returns a dictionary of converted parameter values or an
+  # error status.
+  def error (s):
+    return "error: bad request - " + s
+  d = {}
+  for k in request:
+    if k not in parameters:
+      return error("invalid parameter: " + util.oneLine(k))
+    try:
+      if parameters[k][0]:
+        d[k] = map(parameters[k][1], request.getlist(k))
+      else:
+        if len(request.getlist(k)) > 1:
+          return error("parameter is not repeatable: " + k)
+        d[k] = parameters[k][1](request[k])
+    except _ValidationException, e:
+      return error("parameter '%s': %s" % (k, str(e)))
+  return d
+
+def _authorizeSearch (user, constraints):
+  # Checks that the requestor may search the owners and owner groups
+  # named in a dictionary of constraints returned by
+  # _parseSearchParameters, and converts the constraints to
+  # usernames and group names.  In the absence of owner and
+  # ownergroup constraints, the search is limited to the requestor's
+  # own identifiers.  Returns False if the search is not authorized.
+  d = constraints
+  for o in d.get("owner", []):
+    if not policy.authorizeDownload(user, owner=o): return False
+  for g in d.get("ownergroup", []):
+    if not policy.authorizeDownload(user, ownergroup=g): return False
+  if "owner" in d: d["owner"] = [o.username for o in d["owner"]]
+  if "ownergroup" in d:
+    d["ownergroup"] = [g.groupname for g in d["ownergroup"]]
+  if "owner" not in d and "ownergroup" not in d:
+    d["owner"] = user.username
+  return True
+
+def _exportGenerator (format, columns, convertTimestamps, first, ids):
+  # Writes are buffered so that each chunk of the response holds a
+  # reasonable number of records.  Errors are reported in-band (see
+  # exportRequest below).
+  f = cStringIO.StringIO()
+  try:
+    if format == "csv":
+      csv.writer(f).writerow([_csvEncode(c) for c in columns])
+    n = 0
+    try:
+      for id in itertools.chain([first], ids):
+        if id == None: break
+        m = _prepareMetadata(id, convertTimestamps)
+        if format == "csv":
+          _writeCsv(f, columns, id, m)
+        else:
+          m["_id"] = id.identifier
+          f.write(json.dumps(m, separators=(",", ":")) + "\n")
+        n += 1
+        if n%100 == 0:
+          yield f.getvalue()
+          f.close()
+          f = cStringIO.StringIO()
+    except search_util.SearchLimitException, e:
+      message = "error: " + util.oneLine(str(e))
+    except Exception, e:
+      log.otherError("download._exportGenerator", e)
+      message = "error: internal server error"
+    else:
+      message = None
+    if message != None:
+      if format == "csv":
+        csv.writer(f).writerow([_csvEncode(message)])
+      else:
+        f.write(json.dumps({ "_error": message }) + "\n")
+    yield f.getvalue()
+  finally:
+    f.close()
+    ids.close()
+
+class _ExportContent (object):
+  # The content of an export.  The search underlying an export is
+  # begun before the content is returned, and so must be ended even if
+  # the content is never consumed (a generator that has not been
+  # started ignores close()).  Django's streaming responses close
+  # their content when the response is closed, which the server does
+  # whether or not the response was sent.
+  def __init__ (self, generator, ids):
+    self.generator = generator
+    self.ids = ids
+  def __iter__ (self):
+    return self.generator
+  def close (self):
+    try:
+      self.generator.close()
+    finally:
+      self.ids.close()
+
+def exportRequest (user, request):
+  """
+  Exports identifiers.  The request must be authenticated; 'user'
+  should be a StoreUser object.  'request' should be a
+  django.http.QueryDict object containing the parameters of the
+  request: a 'format' parameter ("csv" or "json"); for CSV, one or
+  more 'column' parameters as in batch download; optionally, a
+  'convertTimestamps' parameter; and zero or more constraints, each
+  a search column accepted by search_util.formulateQuery.  Repeatable
+  columns may be repeated; boolean values are expressed as "yes" or
+  "no", and ranges as two comma-separated bounds, either of which may
+  be empty.  In the absence of owner and ownergroup constraints, the
+  requestor's own identifiers are exported.
+
+  The successful return is a tuple (content type, content), where
+  content is an iterable that yields the export in pieces: CSV, with
+  a header row, or JSON lines, one object per identifier holding the
+  identifier (under key "_id") and its metadata as in batch download.
+  Identifiers are retrieved incrementally as the content is consumed.
+  Because the response status has been sent by then, an error that
+  occurs partway through (e.g., a search timeout) is reported by
+  ending the content with an error record: in CSV, a row consisting
+  of the single field "error: " followed by a description; in JSON
+  lines, an object holding the description under key "_error".  The
+  search counts against the requestor's concurrent search limit until
+  the content is exhausted or closed; the content must be closed if
+  it is abandoned (passing it to a Django StreamingHttpResponse
+  suffices).  Unsuccessful returns are strings as in enqueueRequest.  Raises
+  search_util.SearchLimitException if the requestor has too many
+  searches in progress.
+  """
+  def error (s):
+    return "error: bad request - " + s
+  try:
+    d = _parseSearchParameters(request, _exportParameters)
+    if type(d) is str: return d
+    if "format" not in d:
+      return error("missing required parameter: format")
+    format = d["format"]
+    del d["format"]
+    if format == "csv":
+      if "column" not in d:
+        return error("format 'csv' requires at least one column")
+      columns = d["column"]
+      del d["column"]
+    else:
+      if "column" in d:
+        return error("parameter is incompatible with format: column")
+      columns = []
+    convertTimestamps = d.get("convertTimestamps", False)
+    if "convertTimestamps" in d: del d["convertTimestamps"]
+    if not _authorizeSearch(user, d): return "error: forbidden"
+    ids = search_util.executeSearchStream(user, d,
+      selectRelated=["owner", "ownergroup", "datacenter", "profile"],
+      defer=["oaiDublinCoreRecord", "oaiDataciteRecord"])
+    # Retrieving the first identifier now causes the search to begin,
+    # and any search errors to be raised, before content is returned.
+    first = next(ids, None)
+    return (_exportContentType[format], _ExportContent(
+      _exportGenerator(format, columns, convertTimestamps, first, ids), ids))
+  except search_util.SearchLimitException:
+    raise
+  except Exception, e:
+    log.otherError("download.exportRequest", e)
+    return "error: internal server error"
+
+def _validatePageSize (v):
+  try:
+    v = int(v)
+    assert 1 <= v <= _maxPageSize
+    return v
+  except:
+    raise _ValidationException("invalid page size (must be between 1 and " +\
+      "%d)" % _maxPageSize)
+
+def _validateOrder (v):
+  if not search_util.isValidOrdering(v):
+    raise _ValidationException("invalid ordering")
+  return v
+
+_searchPageParameters = dict((k, v) for k, v in _exportParameters.items()\
+  if k not in ["column", "format"])
+_searchPageParameters.update({
+  "cursor": (False, _validateString),
+  "order": (False, _validateOrder),
+  "pageSize": (False, _validatePageSize)
+})
+
+def searchRequest (user, request):
+  """
+  Returns a page of identifiers matching search constraints, using
+  keyset pagination (see search_util.executeSearchPage).  The request
+  must be authenticated; 'user' should be a StoreUser object.
+  'request' should be a django.http.QueryDict object containing the
+  parameters of the request: a 'pageSize' parameter; optionally, an
+  'order' parameter naming a search column by which to order results,
+  prefixed with a minus sign for descending order; optionally, a
+  'cursor' parameter as returned by a previous request having the
+  same constraints and ordering; optionally, a 'convertTimestamps'
+  parameter; and zero or more constraints as in exportRequest.
+
+  The successful return is a JSON-serialized object holding, under
+  key "results", a list of identifiers in the form of exportRequest's
+  JSON lines, and under keys "next" and "previous", the cursors of the
+  next and previous pages, or null if there is no such page.
+  Unsuccessful returns are strings as in enqueueRequest.  Raises
+  search_util.SearchLimitException if the requestor has too many
+  searches in progress.
+  """
+  try:
+    d = _parseSearchParameters(request, _searchPageParameters)
+    if type(d) is str: return d
+    if "pageSize" not in d:
+      return "error: bad request - missing required parameter: pageSize"
+    pageSize = d.pop("pageSize")
+    cursor = d.pop("cursor", None)
+    orderBy = d.pop("order", None)
+    convertTimestamps = d.pop("convertTimestamps", False)
+    if not _authorizeSearch(user, d): return "error: forbidden"
+    if cursor != None and not search_util.isValidCursor(cursor, d, orderBy):
+      return "error: bad request - invalid cursor"
+    ids, next, previous = search_util.executeSearchPage(user, d, pageSize,
+      cursor, orderBy=orderBy,
+      selectRelated=["owner", "ownergroup", "datacenter", "profile"],
+      defer=["oaiDublinCoreRecord", "oaiDataciteRecord"])
+    results = []
+    for id in ids:
+      m = _prepareMetadata(id, convertTimestamps)
+      m["_id"] = id.identifier
+      results.append(m)
+    return json.dumps({ "results": results, "next": next,
+      "previous": previous }, separators=(",", ":"))
+  except search_util.SearchLimitException:
+    raise
+  except Exception, e:
+    log.otherError("download.searchRequest", e)
+    return "error: internal server error"
 
 _loadConfig()
 config.registerReloadListener(_loadConfig)
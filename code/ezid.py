@@ -16,11 +16,12 @@
 import django.core.exceptions
 import django.db.transaction
 import django.db.utils
-import threading
+import time
 import uuid
 
 import config
 import ezidapp.models
+import identifier_lock
 import log
 import noid_nog
 import policy
@@ -29,63 +30,68 @@ import util2
 
 _perUserThreadLimit = None
 _perUserThrottle = None
+_perUserReadThrottle = None
+_lockManager = None
+_batchChunkSize = None
 
 def _loadConfig ():
-  global _perUserThreadLimit, _perUserThrottle
+  global _perUserThreadLimit, _perUserThrottle, _perUserReadThrottle
+  global _lockManager, _batchChunkSize
   _perUserThreadLimit = int(config.get("DEFAULT.max_threads_per_user"))
   _perUserThrottle =\
     int(config.get("DEFAULT.max_concurrent_operations_per_user"))
+  _perUserReadThrottle =\
+    int(config.get("DEFAULT.max_concurrent_reads_per_user"))
+  if _lockManager == None:
+    _lockManager = identifier_lock.LockManager(_perUserThrottle,
+      _perUserThreadLimit, _perUserReadThrottle,
+      int(config.get("DEFAULT.identifier_lock_stripes")))
+  else:
+    _lockManager.setLimits(_perUserThrottle, _perUserThreadLimit,
+      _perUserReadThrottle)
+  _batchChunkSize = int(config.get("DEFAULT.batch_chunk_size"))
 
 _loadConfig()
 config.registerReloadListener(_loadConfig)
 
-# Simple locking mechanism to ensure that, in a multi-threaded
-# environment, no given identifier is operated on by two threads
-# simultaneously.  Additionally, we enforce a per-user throttle on
-# concurrent operations.  _activeUsers maps local usernames to the
-# number of operations currently being performed by that user.  For
-# status reporting purposes, _waitingUsers similarly maps local
-# usernames to numbers of waiting requests.  If _paused is true, no
-# new locks are granted, but the mechanism otherwise operates
-# normally.
-
-_lockedIdentifiers = set()
-_activeUsers = {}
-_waitingUsers = {}
-_lock = threading.Condition()
-_paused = False
-
-def _incrementCount (d, k):
-  d[k] = d.get(k, 0) + 1
-
-def _decrementCount (d, k):
-  if d[k] == 1:
-    del d[k]
-  else:
-    d[k] = d[k] - 1
+# Locking mechanism to ensure that, in a multi-threaded environment,
+# no given identifier is operated on by two threads simultaneously.
+# Additionally, we enforce a per-user throttle on concurrent
+# operations.  Reads bypass the locks and are separately throttled.
+# See the identifier_lock module for details.
 
 def _acquireIdentifierLock (identifier, user):
-  _lock.acquire()
-  while _paused or identifier in _lockedIdentifiers or\
-    _activeUsers.get(user, 0) >= _perUserThrottle:
-    if _activeUsers.get(user, 0) + _waitingUsers.get(user, 0) >=\
-      _perUserThreadLimit:
-      _lock.release()
-      return False
-    _incrementCount(_waitingUsers, user)
-    _lock.wait()
-    _decrementCount(_waitingUsers, user)
-  _incrementCount(_activeUsers, user)
-  _lockedIdentifiers.add(identifier)
-  _lock.release()
-  return True
+  return _lockManager.acquire(identifier, user)
 
 def _releaseIdentifierLock (identifier, user):
-  _lock.acquire()
-  _lockedIdentifiers.remove(identifier)
-  _decrementCount(_activeUsers, user)
-  _lock.notifyAll()
-  _lock.release()
+  _lockManager.release(identifier, user)
+
+# The number of times a read that overlaps a write is attempted, and
+# the delay before the first reattempt (doubled thereafter).  If all
+# attempts overlap a write, the last value read is returned; being a
+# committed state of the identifier, it is not incorrect, merely
+# possibly stale.
+
+_maxReadAttempts = 3
+_readReattemptDelay = 0.01
+
+def _readIdentifier (identifier, prefixMatch):
+  # Reads an identifier without locking it.  Raises
+  # StoreIdentifier.DoesNotExist.
+  if prefixMatch:
+    l = util.explodePrefixes(identifier)
+  else:
+    l = [identifier]
+  for i in range(_maxReadAttempts):
+    if i > 0: time.sleep(_readReattemptDelay*2**(i-1))
+    before = _lockManager.readSnapshot(l)
+    try:
+      si = ezidapp.models.getIdentifier(identifier, prefixMatch)
+    except ezidapp.models.StoreIdentifier.DoesNotExist:
+      si = None
+    if before != None and _lockManager.readSnapshot(l) == before: break
+  if si == None: raise ezidapp.models.StoreIdentifier.DoesNotExist()
+  return si
 
 def getStatus ():
   """
@@ -97,11 +103,7 @@ def getStatus ():
   numbers of waiting requests.  The boolean flag indicates if the
   server is currently paused.
   """
-  _lock.acquire()
-  try:
-    return (_activeUsers.copy(), _waitingUsers.copy(), _paused)
-  finally:
-    _lock.release()
+  return _lockManager.getStatus()
 
 def pause (newValue):
   """
@@ -109,15 +111,84 @@ def pause (newValue):
   value.  If the server is paused, no new identifier locks are granted
   and all requests are forced to wait.
   """
-  global _paused
-  _lock.acquire()
-  try:
-    oldValue = _paused
-    _paused = newValue
-    if not _paused: _lock.notifyAll()
-    return oldValue
-  finally:
-    _lock.release()
+  return _lockManager.pause(newValue)
+
+def _logBegin (tid, function, identifier, user, metadata={}):
+  log.begin(tid, function, identifier, user.username, user.pid,
+    user.group.groupname, user.group.pid,
+    *[a for p in metadata.items() for a in p])
+
+# The following functions perform the validation and authorization
+# parts of the create, update, and delete operations, leaving only the
+# database writes to the caller.  Each returns an error status string
+# (having logged the transaction's end) if the operation is not to be
+# performed.  Exceptions are passed through.
+
+def _prepareCreate (tid, nqidentifier, user, metadata):
+  # Returns a new, unsaved StoreIdentifier object or an error status.
+  if not policy.authorizeCreate(user, nqidentifier):
+    log.forbidden(tid)
+    return "error: forbidden"
+  si = ezidapp.models.StoreIdentifier(identifier=nqidentifier,
+    owner=(None if user == ezidapp.models.AnonymousUser else user))
+  si.updateFromUntrustedLegacy(metadata,
+    allowRestrictedSettings=user.isSuperuser)
+  if si.isDoi:
+    s = ezidapp.models.getLongestShoulderMatch(si.identifier)
+    # Should never happen.
+    assert s != None, "no matching shoulder found"
+    if s.isDatacite:
+      if si.datacenter == None: si.datacenter = s.datacenter
+    elif s.isCrossref:
+      if not si.isCrossref:
+        if si.isReserved:
+          si.crossrefStatus = ezidapp.models.StoreIdentifier.CR_RESERVED
+        else:
+          si.crossrefStatus = ezidapp.models.StoreIdentifier.CR_WORKING
+    else:
+      assert False, "unhandled case"
+  si.my_full_clean()
+  if si.owner != user:
+    if not policy.authorizeOwnershipChange(user, user, si.owner):
+      log.badRequest(tid)
+      return "error: bad request - ownership change prohibited"
+  return si
+
+def _createSuccess (si):
+  if si.isDoi:
+    return "success: %s | %s" % (si.identifier, si.arkAlias)
+  else:
+    return "success: " + si.identifier
+
+def _prepareUpdate (tid, si, user, metadata, updateExternalServices):
+  # Updates StoreIdentifier object 'si' in place.  Returns None or an
+  # error status.
+  if not policy.authorizeUpdate(user, si):
+    log.forbidden(tid)
+    return "error: forbidden"
+  previousOwner = si.owner
+  si.updateFromUntrustedLegacy(metadata,
+    allowRestrictedSettings=user.isSuperuser)
+  if si.isCrossref and not si.isReserved and updateExternalServices:
+    si.crossrefStatus = ezidapp.models.StoreIdentifier.CR_WORKING
+    si.crossrefMessage = ""
+  if "_updated" not in metadata: si.updateTime = ""
+  si.my_full_clean()
+  if si.owner != previousOwner:
+    if not policy.authorizeOwnershipChange(user, previousOwner, si.owner):
+      log.badRequest(tid)
+      return "error: bad request - ownership change prohibited"
+  return None
+
+def _prepareDelete (tid, si, user):
+  # Returns None or an error status.
+  if not policy.authorizeDelete(user, si):
+    log.forbidden(tid)
+    return "error: forbidden"
+  if not si.isReserved and not user.isSuperuser:
+    log.badRequest(tid)
+    return "error: bad request - identifier status does not support deletion"
+  return None
 
 def mintIdentifier (shoulder, user, metadata={}):
   """
@@ -209,35 +280,9 @@ def createIdentifier (identifier, user, metadata={}, updateIfExists=False):
   if not _acquireIdentifierLock(nqidentifier, user.username):
     return "error: concurrency limit exceeded"
   try:
-    log.begin(tid, "createIdentifier", nqidentifier, user.username, user.pid,
-      user.group.groupname, user.group.pid,
-      *[a for p in metadata.items() for a in p])
-    if not policy.authorizeCreate(user, nqidentifier):
-      log.forbidden(tid)
-      return "error: forbidden"
-    si = ezidapp.models.StoreIdentifier(identifier=nqidentifier,
-      owner=(None if user == ezidapp.models.AnonymousUser else user))
-    si.updateFromUntrustedLegacy(metadata,
-      allowRestrictedSettings=user.isSuperuser)
-    if si.isDoi:
-      s = ezidapp.models.getLongestShoulderMatch(si.identifier)
-      # Should never happen.
-      assert s != None, "no matching shoulder found"
-      if s.isDatacite:
-        if si.datacenter == None: si.datacenter = s.datacenter
-      elif s.isCrossref:
-        if not si.isCrossref:
-          if si.isReserved:
-            si.crossrefStatus = ezidapp.models.StoreIdentifier.CR_RESERVED
-          else:
-            si.crossrefStatus = ezidapp.models.StoreIdentifier.CR_WORKING
-      else:
-        assert False, "unhandled case"
-    si.my_full_clean()
-    if si.owner != user:
-      if not policy.authorizeOwnershipChange(user, user, si.owner):
-        log.badRequest(tid)
-        return "error: bad request - ownership change prohibited"
+    _logBegin(tid, "createIdentifier", nqidentifier, user, metadata)
+    si = _prepareCreate(tid, nqidentifier, user, metadata)
+    if type(si) is str: return si
     with django.db.transaction.atomic():
       si.save()
       ezidapp.models.update_queue.enqueue(si, "create")
@@ -255,10 +300,7 @@ def createIdentifier (identifier, user, metadata={}, updateIfExists=False):
     return "error: internal server error"
   else:
     log.success(tid)
-    if si.isDoi:
-      return "success: %s | %s" % (nqidentifier, si.arkAlias)
-    else:
-      return "success: " + nqidentifier
+    return _createSuccess(si)
   finally:
     _releaseIdentifierLock(nqidentifier, user.username)
 
@@ -287,16 +329,20 @@ def getMetadata (identifier, user=ezidapp.models.AnonymousUser,
   case, the status string resembles:
 
     success: doi:10.5060/FOO in_lieu_of doi:10.5060/FOOBAR
+
+  This function does not lock the identifier; concurrent writes are
+  detected and the read retried.  It is subject to a per-user read
+  throttle that is separate from the throttle on other operations.
   """
   nqidentifier = util.normalizeIdentifier(identifier)
   if nqidentifier == None: return "error: bad request - invalid identifier"
   tid = uuid.uuid1()
-  if not _acquireIdentifierLock(nqidentifier, user.username):
+  if not _lockManager.acquireRead(user.username):
     return "error: concurrency limit exceeded"
   try:
     log.begin(tid, "getMetadata", nqidentifier, user.username, user.pid,
       user.group.groupname, user.group.pid, str(prefixMatch))
-    si = ezidapp.models.getIdentifier(nqidentifier, prefixMatch)
+    si = _readIdentifier(nqidentifier, prefixMatch)
     if not policy.authorizeView(user, si):
       log.forbidden(tid)
       return "error: forbidden"
@@ -315,7 +361,7 @@ def getMetadata (identifier, user=ezidapp.models.AnonymousUser,
     log.error(tid, e)
     return "error: internal server error"
   finally:
-    _releaseIdentifierLock(nqidentifier, user.username)
+    _lockManager.releaseRead(user.username)
 
 def setMetadata (identifier, user, metadata, updateExternalServices=True,
   internalCall=False):
@@ -348,25 +394,10 @@ def setMetadata (identifier, user, metadata, updateExternalServices=True,
     if not _acquireIdentifierLock(nqidentifier, user.username):
       return "error: concurrency limit exceeded"
   try:
-    log.begin(tid, "setMetadata", nqidentifier, user.username, user.pid,
-      user.group.groupname, user.group.pid,
-      *[a for p in metadata.items() for a in p])
+    _logBegin(tid, "setMetadata", nqidentifier, user, metadata)
     si = ezidapp.models.getIdentifier(nqidentifier)
-    if not policy.authorizeUpdate(user, si):
-      log.forbidden(tid)
-      return "error: forbidden"
-    previousOwner = si.owner
-    si.updateFromUntrustedLegacy(metadata,
-      allowRestrictedSettings=user.isSuperuser)
-    if si.isCrossref and not si.isReserved and updateExternalServices:
-      si.crossrefStatus = ezidapp.models.StoreIdentifier.CR_WORKING
-      si.crossrefMessage = ""
-    if "_updated" not in metadata: si.updateTime = ""
-    si.my_full_clean()
-    if si.owner != previousOwner:
-      if not policy.authorizeOwnershipChange(user, previousOwner, si.owner):
-        log.badRequest(tid)
-        return "error: bad request - ownership change prohibited"
+    s = _prepareUpdate(tid, si, user, metadata, updateExternalServices)
+    if s != None: return s
     with django.db.transaction.atomic():
       si.save()
       ezidapp.models.update_queue.enqueue(si, "update", updateExternalServices)
@@ -408,15 +439,10 @@ def deleteIdentifier (identifier, user, updateExternalServices=True):
   if not _acquireIdentifierLock(nqidentifier, user.username):
     return "error: concurrency limit exceeded"
   try:
-    log.begin(tid, "deleteIdentifier", nqidentifier, user.username, user.pid,
-      user.group.groupname, user.group.pid)
+    _logBegin(tid, "deleteIdentifier", nqidentifier, user)
     si = ezidapp.models.getIdentifier(nqidentifier)
-    if not policy.authorizeDelete(user, si):
-      log.forbidden(tid)
-      return "error: forbidden"
-    if not si.isReserved and not user.isSuperuser:
-      log.badRequest(tid)
-      return "error: bad request - identifier status does not support deletion"
+    s = _prepareDelete(tid, si, user)
+    if s != None: return s
     with django.db.transaction.atomic():
       si.delete()
       ezidapp.models.update_queue.enqueue(si, "delete", updateExternalServices)
@@ -431,3 +457,169 @@ def deleteIdentifier (identifier, user, updateExternalServices=True):
     return "success: " + nqidentifier
   finally:
     _releaseIdentifierLock(nqidentifier, user.username)
+
+_batchFunctionNames = { "create": "createIdentifier",
+  "update": "setMetadata", "delete": "deleteIdentifier" }
+
+def batchOperation (operation, records, user, updateIfExists=False,
+  updateExternalServices=True):
+  """
+  Performs an operation on a sequence of identifiers.  'operation'
+  should be one of the strings "create", "update", or "delete".
+  'records' should be an iterable of (identifier, metadata) pairs,
+  where each identifier is qualified, e.g., "doi:10.5060/FOO", and
+  each metadata is a dictionary of element (name, value) pairs
+  (ignored for deletions).  'user' is the requestor and should be an
+  authenticated StoreUser object.  The semantics of the operation and
+  of the 'updateIfExists' and 'updateExternalServices' flags are as in
+  the single-identifier functions above.
+
+  This function is a generator that yields one (identifier, status)
+  pair per record, in record order, where 'status' is the string the
+  corresponding single-identifier function would have returned.
+  Records are processed in chunks: per chunk, all identifiers are
+  locked at once (consuming a single throttle slot), existing
+  identifiers are retrieved in one query, and all database writes are
+  performed in one transaction using multi-row statements.
+  """
+  assert operation in _batchFunctionNames
+  chunk = []
+  chunkIdentifiers = set()
+  for identifier, metadata in records:
+    nqidentifier = util.normalizeIdentifier(identifier)
+    if nqidentifier != None and (nqidentifier in chunkIdentifiers or\
+      len(chunk) >= _batchChunkSize):
+      for r in _batchChunk(operation, chunk, user, updateIfExists,
+        updateExternalServices):
+        yield tuple(r)
+      chunk = []
+      chunkIdentifiers = set()
+    chunk.append((identifier, nqidentifier, metadata))
+    if nqidentifier != None: chunkIdentifiers.add(nqidentifier)
+  for r in _batchChunk(operation, chunk, user, updateIfExists,
+    updateExternalServices):
+    yield tuple(r)
+
+def _batchChunk (operation, chunk, user, updateIfExists,
+  updateExternalServices):
+  # Processes a chunk of batch records, which are (identifier,
+  # normalized identifier, metadata) triples.  Normalized identifiers
+  # are unique within the chunk.  Returns a list of (identifier,
+  # status) pairs.
+  results = [[r[0], None] for r in chunk]
+  identifiers = [r[1] for r in chunk if r[1] != None]
+  for r, c in zip(results, chunk):
+    if c[1] == None: r[1] = "error: bad request - invalid identifier"
+  if len(identifiers) == 0: return results
+  if not _lockManager.acquireMultiple(identifiers, user.username):
+    for r in results:
+      if r[1] == None: r[1] = "error: concurrency limit exceeded"
+    return results
+  # Each element of 'pending' is a (result index, tid, operation,
+  # StoreIdentifier object) tuple describing a write to be performed.
+  pending = []
+  try:
+    try:
+      existing = dict((si.identifier, si) for si in\
+        ezidapp.models.StoreIdentifier.objects.select_related("owner",
+        "owner__group", "ownergroup", "datacenter", "profile").\
+        filter(identifier__in=identifiers))
+    except Exception, e:
+      log.otherError("ezid._batchChunk", e)
+      for r in results:
+        if r[1] == None: r[1] = "error: internal server error"
+      return results
+    for i, (identifier, nqidentifier, metadata) in enumerate(chunk):
+      if nqidentifier == None: continue
+      tid = uuid.uuid1()
+      op = operation
+      try:
+        if op == "create":
+          _logBegin(tid, "createIdentifier", nqidentifier, user, metadata)
+          if nqidentifier in existing:
+            log.badRequest(tid)
+            if updateIfExists:
+              op = "update"
+              tid = uuid.uuid1()
+            else:
+              results[i][1] = "error: bad request - identifier already exists"
+              continue
+          else:
+            si = _prepareCreate(tid, nqidentifier, user, metadata)
+        if op == "update":
+          _logBegin(tid, "setMetadata", nqidentifier, user, metadata)
+          si = existing.get(nqidentifier)
+          if si == None:
+            log.badRequest(tid)
+            results[i][1] = "error: bad request - no such identifier"
+            continue
+          s = _prepareUpdate(tid, si, user, metadata, updateExternalServices)
+          if s != None: si = s
+        elif op == "delete":
+          _logBegin(tid, "deleteIdentifier", nqidentifier, user)
+          si = existing.get(nqidentifier)
+          if si == None:
+            log.badRequest(tid)
+            results[i][1] = "error: bad request - no such identifier"
+            continue
+          s = _prepareDelete(tid, si, user)
+          if s != None: si = s
+        if type(si) is str:
+          results[i][1] = si
+        else:
+          pending.append((i, tid, op, si))
+      except django.core.exceptions.ValidationError, e:
+        log.badRequest(tid)
+        results[i][1] = "error: bad request - " + util.formatValidationError(e)
+      except Exception, e:
+        log.error(tid, e)
+        results[i][1] = "error: internal server error"
+    if len(pending) == 0: return results
+    try:
+      with django.db.transaction.atomic():
+        sm = ezidapp.models.store_identifier
+        sm.createMultiple([p[3] for p in pending if p[2] == "create"])
+        sm.updateMultiple([p[3] for p in pending if p[2] == "update"])
+        sm.deleteMultiple([p[3] for p in pending if p[2] == "delete"])
+        ezidapp.models.update_queue.enqueueMultiple(
+          [(si, op, updateExternalServices) for i, tid, op, si in pending])
+    except django.db.utils.IntegrityError:
+      # Another process created one of our identifiers in the interim.
+      # We fall back to processing the chunk's pending writes
+      # individually, which requires first releasing our locks.  The
+      # individual operations are logged separately; each pending
+      # write's transaction is closed out according to the outcome of
+      # its individual operation.
+      _lockManager.releaseMultiple(identifiers, user.username)
+      identifiers = None
+      for i, tid, op, si in pending:
+        identifier, nqidentifier, metadata = chunk[i]
+        if op == "create":
+          results[i][1] = createIdentifier(nqidentifier, user, metadata,
+            updateIfExists)
+        elif op == "update":
+          results[i][1] = setMetadata(nqidentifier, user, metadata,
+            updateExternalServices)
+        else:
+          results[i][1] = deleteIdentifier(nqidentifier, user,
+            updateExternalServices)
+        if results[i][1].startswith("success"):
+          log.success(tid)
+        else:
+          log.badRequest(tid)
+      return results
+    except Exception, e:
+      for i, tid, op, si in pending:
+        log.error(tid, e)
+        results[i][1] = "error: internal server error"
+      return results
+    for i, tid, op, si in pending:
+      log.success(tid)
+      if op == "create":
+        results[i][1] = _createSuccess(si)
+      else:
+        results[i][1] = "success: " + si.identifier
+    return results
+  finally:
+    if identifiers != None:
+      _lockManager.releaseMultiple(identifiers, user.username)
@@ -0,0 +1,102 @@
+# =============================================================================
+#
+# EZID :: fulltext_parser.py
+#
+# Parsing of fulltext search constraints (see search_backend.py).
+# This module has no dependencies on Django or the rest of EZID.
+#
+# A constraint is parsed into a list of (required, term) tuples, where
+# each term is a word or a quoted phrase (including the quotes).  The
+# primary purposes of parsing are 1) to remove characters that might
+# be interpreted by MySQL as operators and 2) to change the default
+# semantics of MySQL's freetext search from OR to AND.  The latter is
+# accomplished by making every search term required, so that a
+# constraint "foo bar" is transformed into "+foo +bar".  Quoted
+# phrases are treated like atomic terms and are left as is.
+# Additionally, parsing implements an explicit OR operator.  An "OR"
+# placed between two terms has the effect of making those terms
+# optional.  Thus, "foo bar OR baz" becomes "+foo bar baz".  Finally,
+# stopwords are removed.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import collections
+import re
+import threading
+
+# A term is a quoted phrase, which extends to the next double quote
+# or the end of the constraint, or a maximal run of alphanumeric
+# characters.  All other characters outside quotes are discarded,
+# quotes being the only MySQL operator we retain.
+
+_termPattern = re.compile(r'"[^"]*"?|[^\W_]+', re.U)
+
+class Parser (object):
+  """
+  A constraint parser for a given minimum word length and set of
+  stopwords.  Parses are memoized; a parser is safe for use by
+  multiple threads.
+  """
+
+  def __init__ (self, minimumWordLength, stopwords, cacheSize=1000):
+    self.minimumWordLength = minimumWordLength
+    self.stopwords = frozenset(w.lower() for w in stopwords)
+    self._cacheSize = cacheSize
+    self._cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _parse (self, constraint):
+    # Step 1: Tokenize.  An unterminated phrase is terminated.
+    terms = _termPattern.findall(constraint)
+    if len(terms) > 0 and terms[-1].startswith('"') and\
+      (len(terms[-1]) == 1 or not terms[-1].endswith('"')):
+      terms[-1] += '"'
+    # Step 2: OR processing.  An OR that has terms on both sides makes
+    # those terms optional.  All OR terms are discarded.
+    words = []
+    optional = False
+    for i, t in enumerate(terms):
+      if t.upper() == "OR":
+        if len(words) > 0 and i < len(terms)-1:
+          words[-1][0] = False
+          optional = True
+      else:
+        words.append([not optional, t])
+        optional = False
+    # Step 3: Remove all stopwords.  We can't leave MySQL's default
+    # stopwords in because a plus sign in front of a stopword will
+    # cause zero results to be returned.  Also, we need to remove our
+    # own stopwords anyway.
+    return tuple((r, w) for r, w in words if w.startswith('"') or\
+      (len(w) >= self.minimumWordLength and\
+      w.lower() not in self.stopwords))
+
+  def parse (self, constraint):
+    """
+    Parses a constraint, returning a tuple of (required, term) tuples.
+    """
+    self._lock.acquire()
+    try:
+      r = self._cache.get(constraint)
+      if r != None:
+        del self._cache[constraint]
+        self._cache[constraint] = r
+        return r
+    finally:
+      self._lock.release()
+    r = self._parse(constraint)
+    self._lock.acquire()
+    try:
+      self._cache[constraint] = r
+      while len(self._cache) > self._cacheSize:
+        self._cache.popitem(last=False)
+    finally:
+      self._lock.release()
+    return r
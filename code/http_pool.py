@@ -0,0 +1,376 @@
+# =============================================================================
+#
+# EZID :: http_pool.py
+#
+# Persistent (keep-alive) HTTP connection pool.  EZID's clients of
+# external services (DataCite, the noid binder and minters, Crossref)
+# issue requests through this module so that TCP connections and TLS
+# sessions are reused across requests and threads rather than being
+# established anew for every request.
+#
+# Connections are pooled per (scheme, host, port).  At most
+# 'max_connections_per_host' connections to any one host are open at
+# once; a thread needing a connection to a host at its limit waits for
+# one to be returned.  Idle connections are closed after
+# 'idle_timeout' seconds, and a pooled connection is checked for
+# having been closed by the server before it is reused.  Should a
+# request on a reused connection fail nonetheless (the server may
+# close an idle connection at any moment), the request is retried
+# once on a new connection, but only if doing so is safe: if the
+# request is idempotent, or if the failure occurred while the request
+# was being sent (a server can't have acted on a request it didn't
+# fully receive).  A POST whose response was lost is not retried, as
+# the server may have acted on it (e.g., a DataCite registration or a
+# Crossref deposit).
+#
+# As with urllib2, redirects are followed (up to a limit), and proxies
+# are used as directed by the http_proxy, https_proxy, and no_proxy
+# environment variables.  Connections through a proxy are pooled
+# separately; https requests are tunneled through the proxy using
+# CONNECT.
+#
+# Requests may additionally be retried on transient errors, with
+# exponential backoff between attempts.
+#
+# Responses are read in their entirety before connections are
+# returned to the pool.  For compatibility with code written against
+# urllib2, non-2xx responses are raised as urllib2.HTTPError
+# exceptions.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import base64
+import httplib
+import select
+import socket
+import StringIO
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+import config
+
+_lock = threading.Lock()
+_maxConnectionsPerHost = None
+_idleTimeout = None
+_backoffFactor = None
+_maxReattemptDelay = None
+_hosts = {}
+
+# Per urllib2.HTTPRedirectHandler.
+_maxRedirects = 10
+
+_idempotentMethods = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS"]
+
+_statistics = { "opened": 0, "reused": 0, "waitTime": 0.0 }
+
+def _loadConfig ():
+  global _maxConnectionsPerHost, _idleTimeout, _backoffFactor
+  global _maxReattemptDelay
+  _maxConnectionsPerHost =\
+    int(config.get("http_pool.max_connections_per_host"))
+  _idleTimeout = int(config.get("http_pool.idle_timeout"))
+  _backoffFactor = float(config.get("http_pool.backoff_factor"))
+  _maxReattemptDelay = int(config.get("http_pool.max_reattempt_delay"))
+  _lock.acquire()
+  try:
+    hosts = _hosts.values()
+  finally:
+    _lock.release()
+  for h in hosts: h.closeIdle()
+
+_loadConfig()
+config.registerReloadListener(_loadConfig)
+
+def _incrementStatistic (name, value):
+  _lock.acquire()
+  try:
+    _statistics[name] += value
+  finally:
+    _lock.release()
+
+def getStatistics ():
+  """
+  Returns connection statistics accumulated since the previous call as
+  a tuple (number of connections opened, number of connections
+  reused, total seconds spent waiting for a connection).
+  """
+  _lock.acquire()
+  try:
+    s = (_statistics["opened"], _statistics["reused"],
+      _statistics["waitTime"])
+    _statistics["opened"] = 0
+    _statistics["reused"] = 0
+    _statistics["waitTime"] = 0.0
+    return s
+  finally:
+    _lock.release()
+
+def _isDropped (c):
+  # Returns True if a pooled connection has been closed by the server.
+  # An idle connection should never be readable; if it is, the server
+  # has closed it (or, improperly, sent unsolicited data).
+  if c.sock == None: return False
+  try:
+    return len(select.select([c.sock], [], [], 0)[0]) > 0
+  except (select.error, socket.error):
+    return True
+
+class _Host (object):
+  # The pool of connections to a single host.  'proxy' is None or a
+  # (host, port, Proxy-Authorization header value or None) tuple
+  # describing the proxy through which connections are made.  'idle'
+  # is a list of (connection, time returned to pool) tuples, oldest
+  # first.  'numOpen' counts all connections to the host, idle and in
+  # use.
+
+  def __init__ (self, scheme, host, port, proxy):
+    self.scheme = scheme
+    self.host = host
+    self.port = port
+    self.proxy = proxy
+    self.condition = threading.Condition()
+    self.idle = []
+    self.numOpen = 0
+
+  def _newConnection (self, timeout):
+    if self.proxy == None:
+      if self.scheme == "https":
+        return httplib.HTTPSConnection(self.host, self.port, timeout=timeout)
+      else:
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+    elif self.scheme == "https":
+      c = httplib.HTTPSConnection(self.proxy[0], self.proxy[1],
+        timeout=timeout)
+      c.set_tunnel(self.host, self.port, { "Proxy-Authorization":\
+        self.proxy[2] } if self.proxy[2] != None else None)
+      return c
+    else:
+      return httplib.HTTPConnection(self.proxy[0], self.proxy[1],
+        timeout=timeout)
+
+  def checkout (self, timeout, fresh=False):
+    # Returns a tuple (connection, reused).
+    startTime = time.time()
+    toClose = []
+    c = None
+    self.condition.acquire()
+    try:
+      while True:
+        now = time.time()
+        while len(self.idle) > 0 and (fresh or\
+          now-self.idle[0][1] > _idleTimeout):
+          toClose.append(self.idle.pop(0)[0])
+          self.numOpen -= 1
+        while len(self.idle) > 0:
+          c = self.idle.pop()[0]
+          if not _isDropped(c): break
+          toClose.append(c)
+          self.numOpen -= 1
+          c = None
+        if c != None or self.numOpen < _maxConnectionsPerHost: break
+        self.condition.wait()
+      if c == None: self.numOpen += 1
+    finally:
+      self.condition.release()
+    for cc in toClose: cc.close()
+    _incrementStatistic("waitTime", time.time()-startTime)
+    if c != None:
+      _incrementStatistic("reused", 1)
+      c.timeout = timeout
+      if c.sock != None: c.sock.settimeout(timeout)
+      return (c, True)
+    else:
+      _incrementStatistic("opened", 1)
+      return (self._newConnection(timeout), False)
+
+  def checkin (self, c, reusable):
+    if not reusable: c.close()
+    self.condition.acquire()
+    try:
+      if reusable:
+        self.idle.append((c, time.time()))
+      else:
+        self.numOpen -= 1
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def closeIdle (self):
+    self.condition.acquire()
+    try:
+      l = [c for c, t in self.idle]
+      self.idle = []
+      self.numOpen -= len(l)
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+    for c in l: c.close()
+
+def _getHost (scheme, host, port, proxy):
+  _lock.acquire()
+  try:
+    k = (scheme, host, port, proxy)
+    h = _hosts.get(k)
+    if h == None:
+      h = _Host(scheme, host, port, proxy)
+      _hosts[k] = h
+    return h
+  finally:
+    _lock.release()
+
+def _getProxy (scheme, host):
+  # Returns the proxy to use to reach a host as described in _Host
+  # above, or None.  Proxies are determined from the environment as
+  # urllib2 does.
+  p = urllib.getproxies().get(scheme)
+  if p == None or urllib.proxy_bypass(host): return None
+  if "://" not in p: p = "http://" + p
+  u = urlparse.urlsplit(p)
+  auth = None
+  if u.username != None:
+    auth = "Basic " + base64.b64encode("%s:%s" % (urllib.unquote(u.username),
+      urllib.unquote(u.password or "")))
+  return (u.hostname, u.port or 80, auth)
+
+def _target (url, headers):
+  # Returns a tuple (_Host object, request path, request headers) for
+  # a URL.
+  u = urlparse.urlsplit(url)
+  assert u.scheme in ["http", "https"], "unsupported URL scheme: " + url
+  proxy = _getProxy(u.scheme, u.hostname)
+  h = _getHost(u.scheme, u.hostname,
+    u.port or (443 if u.scheme == "https" else 80), proxy)
+  if proxy != None and u.scheme == "http":
+    # Requests sent to an http proxy carry the absolute URL.
+    path = urlparse.urlunsplit((u.scheme, u.netloc, u.path or "/", u.query,
+      ""))
+    if proxy[2] != None:
+      headers = headers.copy()
+      headers["Proxy-Authorization"] = proxy[2]
+  else:
+    path = u.path or "/"
+    if u.query != "": path += "?" + u.query
+  return (h, path, headers)
+
+class Response (object):
+  """
+  A successful HTTP response.  The response body has already been
+  read in its entirety.  Supports the subset of the file-like
+  interface of urllib2 responses used by EZID.
+  """
+
+  def __init__ (self, url, code, msg, headers, body):
+    self.url = url
+    self.code = code
+    self.msg = msg
+    self.headers = headers
+    self.body = body
+
+  def read (self):
+    return self.body
+
+  def readlines (self):
+    return StringIO.StringIO(self.body).readlines()
+
+  def close (self):
+    pass
+
+def _exchange (h, method, url, path, body, headers, timeout):
+  # Performs a single request, returning a Response object or raising
+  # an exception.
+  fresh = False
+  while True:
+    c, reused = h.checkout(timeout, fresh)
+    reusable = False
+    sent = False
+    try:
+      c.request(method, path, body, headers)
+      sent = True
+      r = c.getresponse()
+      data = r.read()
+      reusable = not r.will_close
+      break
+    except (socket.error, httplib.HTTPException), e:
+      if not reused or isinstance(e, socket.timeout): raise
+      if sent and method not in _idempotentMethods: raise
+      # The connection was most likely closed by the server while
+      # idle.  Try again, once, on a new connection.
+      fresh = True
+    finally:
+      h.checkin(c, reusable)
+  if 200 <= r.status < 300:
+    return Response(url, r.status, r.reason, r.msg, data)
+  else:
+    raise urllib2.HTTPError(url, r.status, r.reason, r.msg,
+      StringIO.StringIO(data))
+
+def _issue (method, url, body, headers, timeout):
+  # Performs a request, following redirects as urllib2 does: GET and
+  # HEAD requests are redirected by 301, 302, 303, and 307 responses,
+  # and POST requests by 301, 302, and 303 responses, in which case
+  # the redirected request is a GET without a body.
+  for i in range(_maxRedirects+1):
+    h, path, hh = _target(url, headers)
+    try:
+      return _exchange(h, method, url, path, body, hh, timeout)
+    except urllib2.HTTPError, e:
+      location = e.hdrs.getheader("location") or\
+        e.hdrs.getheader("uri")
+      if i == _maxRedirects or location == None: raise
+      if method in ["GET", "HEAD"] and e.code in [301, 302, 303, 307]:
+        pass
+      elif method == "POST" and e.code in [301, 302, 303]:
+        method = "GET"
+        body = None
+        headers = dict((k, v) for k, v in headers.items()\
+          if k.lower() not in ["content-length", "content-type"])
+      else:
+        raise
+      newUrl = urlparse.urljoin(url, location)
+      if urlparse.urlsplit(newUrl).scheme not in ["http", "https"]: raise
+      url = newUrl
+
+def isTransientError (exception):
+  """
+  The default test of whether a failed request should be retried:
+  returns True if 'exception' is a network error or an HTTP 5xx
+  error.
+  """
+  if isinstance(exception, urllib2.HTTPError):
+    return exception.code >= 500
+  else:
+    return isinstance(exception, (IOError, httplib.HTTPException))
+
+def request (method, url, body=None, headers={}, timeout=None,
+  numAttempts=1, reattemptDelay=0, isTransient=isTransientError):
+  """
+  Issues an HTTP request over a pooled connection, following
+  redirects, and returns a Response object.  'url' must be an http or
+  https URL.  'body', if
+  not None, should be a string; 'headers' should be a dictionary.
+  'timeout' is the socket timeout in seconds; if None, the global
+  default socket timeout applies.  On a non-2xx response a
+  urllib2.HTTPError is raised.  Up to 'numAttempts' attempts are made
+  for as long as the failure is deemed transient by 'isTransient',
+  which is passed the exception raised.  The delay between attempts
+  starts at 'reattemptDelay' seconds and increases exponentially.
+  """
+  assert urlparse.urlsplit(url).scheme in ["http", "https"],\
+    "unsupported URL scheme: " + url
+  if timeout == None: timeout = socket.getdefaulttimeout()
+  for i in range(numAttempts):
+    try:
+      return _issue(method, url, body, headers, timeout)
+    except Exception, e:
+      if i == numAttempts-1 or not isTransient(e): raise
+    time.sleep(min(reattemptDelay*_backoffFactor**i, _maxReattemptDelay))
@@ -0,0 +1,372 @@
+# =============================================================================
+#
+# EZID :: identifier_lock.py
+#
+# Identifier lock manager.  In a multi-threaded environment, ensures
+# that no given identifier is operated on by two threads
+# simultaneously, and enforces a per-user throttle on concurrent
+# operations.
+#
+# The manager's state is partitioned into stripes so that unrelated
+# operations contend on different locks.  Identifiers hash to
+# identifier stripes, each of which records the identifiers locked in
+# the stripe and, per locked identifier, a FIFO queue of threads
+# waiting for it.  Usernames hash to user stripes, each of which
+# records, per user, the number of throttle slots held and a FIFO
+# queue of threads waiting for a slot.  A thread first obtains the
+# lock on its identifier and then a throttle slot from its user, so
+# that, as in the original single-lock implementation, a thread
+# counts against its user's throttle only once it holds its
+# identifier (a thread waiting for a contended identifier does not
+# hold up its user's other operations).  Releasing a lock or slot
+# hands it directly to the first thread waiting for it, so a release
+# wakes at most the waiters it actually unblocks (as opposed to waking
+# every waiting thread in the process).
+#
+# No thread ever waits while holding more than one identifier lock,
+# except when acquiring multiple locks, which is done in sorted order,
+# and no thread waits for an identifier lock while holding a throttle
+# slot.  Hence there can be no deadlock.
+#
+# Read-only operations do not lock identifiers at all.  Instead, they
+# obtain a read slot, which is subject to a separate per-user throttle
+# and hence does not count against write concurrency, and use
+# optimistic concurrency control: a reader takes a snapshot (see
+# 'readSnapshot') before and after reading, and if the two differ, or
+# if the identifier was locked by a writer, a concurrent write may
+# have occurred and the read should be retried.  To this end each
+# identifier stripe maintains a generation number that is incremented
+# every time a lock in the stripe is released.
+#
+# This module has no dependencies on Django or the rest of EZID.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import collections
+import threading
+
+class _Waiter (object):
+  # A waiting thread blocks on its own private lock, which is released
+  # by whichever thread hands it what it's waiting for.
+  def __init__ (self):
+    self.lock = threading.Lock()
+    self.lock.acquire()
+  def wait (self):
+    self.lock.acquire()
+  def wake (self):
+    self.lock.release()
+
+class _UserState (object):
+  # slots: number of throttle slots held (operations in progress)
+  # idWaiting: number of operations waiting for (or holding, but not
+  #   yet holding a throttle slot for) identifier locks
+  # queue: threads waiting for a throttle slot
+  # readers: number of read slots held
+  # readQueue: threads waiting for a read slot
+  def __init__ (self):
+    self.slots = 0
+    self.idWaiting = 0
+    self.queue = collections.deque()
+    self.readers = 0
+    self.readQueue = collections.deque()
+  def isIdle (self):
+    return self.slots == 0 and self.idWaiting == 0 and len(self.queue) == 0\
+      and self.readers == 0 and len(self.readQueue) == 0
+
+class _UserStripe (object):
+  def __init__ (self):
+    self.lock = threading.Lock()
+    self.users = {}
+
+class _IdentifierStripe (object):
+  # 'locked' maps each locked identifier to the queue of threads
+  # waiting for it.
+  def __init__ (self):
+    self.lock = threading.Lock()
+    self.locked = {}
+    self.generation = 0
+
+class LockManager (object):
+  """
+  Identifier lock manager.  'perUserThrottle' is the maximum number of
+  operations a user may have in progress at once; 'perUserThreadLimit'
+  is the maximum number of threads (in progress plus waiting) a user
+  may have before further requests are rejected outright.
+  'perUserReadThrottle' is the maximum number of read-only operations
+  a user may have in progress at once; read-only operations are
+  separately subject to the thread limit.  If the manager is paused,
+  no new throttle or read slots are granted, and hence no new
+  operations are started, but the manager otherwise operates
+  normally.
+  """
+
+  def __init__ (self, perUserThrottle, perUserThreadLimit,
+    perUserReadThrottle, numStripes=64):
+    self._perUserThrottle = perUserThrottle
+    self._perUserThreadLimit = perUserThreadLimit
+    self._perUserReadThrottle = perUserReadThrottle
+    self._paused = False
+    self._userStripes = [_UserStripe() for i in range(numStripes)]
+    self._identifierStripes = [_IdentifierStripe() for i in range(numStripes)]
+
+  def _userStripe (self, user):
+    return self._userStripes[hash(user)%len(self._userStripes)]
+
+  def _identifierStripe (self, identifier):
+    return self._identifierStripes[hash(identifier)%
+      len(self._identifierStripes)]
+
+  def _enter (self, user):
+    # Registers a thread that is about to wait for identifier locks.
+    # Returns False if the user's thread limit has been reached.
+    s = self._userStripe(user)
+    s.lock.acquire()
+    try:
+      u = s.users.get(user)
+      if u == None:
+        u = _UserState()
+        s.users[user] = u
+      if u.slots + u.idWaiting + len(u.queue) >= self._perUserThreadLimit:
+        if u.isIdle(): del s.users[user]
+        return False
+      u.idWaiting += 1
+      return True
+    finally:
+      s.lock.release()
+
+  def _acquireSlot (self, user):
+    # Obtains a throttle slot for a thread previously registered by
+    # '_enter' that now holds its identifier locks, waiting as
+    # necessary.
+    s = self._userStripe(user)
+    s.lock.acquire()
+    try:
+      u = s.users[user]
+      u.idWaiting -= 1
+      if not self._paused and len(u.queue) == 0 and\
+        u.slots < self._perUserThrottle:
+        u.slots += 1
+        return
+      w = _Waiter()
+      u.queue.append(w)
+    finally:
+      s.lock.release()
+    # The slot is transferred to us by the thread that wakes us.
+    w.wait()
+
+  def _dispatch (self, u):
+    # Hands free throttle and read slots to waiting threads.  Must be
+    # called with the user's stripe lock held.  Returns the threads to
+    # wake.
+    l = []
+    while not self._paused and len(u.queue) > 0 and\
+      u.slots < self._perUserThrottle:
+      u.slots += 1
+      l.append(u.queue.popleft())
+    while not self._paused and len(u.readQueue) > 0 and\
+      u.readers < self._perUserReadThrottle:
+      u.readers += 1
+      l.append(u.readQueue.popleft())
+    return l
+
+  def _releaseSlot (self, user):
+    s = self._userStripe(user)
+    s.lock.acquire()
+    try:
+      u = s.users[user]
+      u.slots -= 1
+      l = self._dispatch(u)
+      if u.isIdle(): del s.users[user]
+    finally:
+      s.lock.release()
+    for w in l: w.wake()
+
+  def _lockIdentifier (self, identifier):
+    s = self._identifierStripe(identifier)
+    s.lock.acquire()
+    try:
+      q = s.locked.get(identifier)
+      if q == None:
+        s.locked[identifier] = collections.deque()
+        return
+      w = _Waiter()
+      q.append(w)
+    finally:
+      s.lock.release()
+    # Ownership of the identifier is transferred to us by the thread
+    # that wakes us.
+    w.wait()
+
+  def _unlockIdentifier (self, identifier):
+    s = self._identifierStripe(identifier)
+    w = None
+    s.lock.acquire()
+    try:
+      s.generation += 1
+      q = s.locked[identifier]
+      if len(q) > 0:
+        w = q.popleft()
+      else:
+        del s.locked[identifier]
+    finally:
+      s.lock.release()
+    if w != None: w.wake()
+
+  def acquire (self, identifier, user):
+    """
+    Acquires the lock on an identifier on behalf of a user, waiting
+    as necessary.  Returns True on success, or False if the user has
+    exceeded its thread limit.
+    """
+    return self.acquireMultiple([identifier], user)
+
+  def acquireMultiple (self, identifiers, user):
+    """
+    Acquires the locks on a list of identifiers on behalf of a user as
+    a single operation, i.e., using a single throttle slot.  Returns
+    True on success, or False if the user has exceeded its thread
+    limit.
+    """
+    if not self._enter(user): return False
+    for identifier in sorted(set(identifiers)):
+      self._lockIdentifier(identifier)
+    self._acquireSlot(user)
+    return True
+
+  def release (self, identifier, user):
+    """
+    Releases an identifier lock previously acquired by 'acquire'.
+    """
+    self.releaseMultiple([identifier], user)
+
+  def releaseMultiple (self, identifiers, user):
+    """
+    Releases identifier locks previously acquired by
+    'acquireMultiple'.
+    """
+    for identifier in set(identifiers): self._unlockIdentifier(identifier)
+    self._releaseSlot(user)
+
+  def acquireRead (self, user):
+    """
+    Acquires a read slot on behalf of a user, waiting as necessary.
+    Returns True on success, or False if the user has exceeded its
+    thread limit.
+    """
+    s = self._userStripe(user)
+    s.lock.acquire()
+    try:
+      u = s.users.get(user)
+      if u == None:
+        u = _UserState()
+        s.users[user] = u
+      if not self._paused and len(u.readQueue) == 0 and\
+        u.readers < self._perUserReadThrottle:
+        u.readers += 1
+        return True
+      if u.readers + len(u.readQueue) >= self._perUserThreadLimit:
+        if u.isIdle(): del s.users[user]
+        return False
+      w = _Waiter()
+      u.readQueue.append(w)
+    finally:
+      s.lock.release()
+    # The slot is transferred to us by the thread that wakes us.
+    w.wait()
+    return True
+
+  def releaseRead (self, user):
+    """
+    Releases a read slot previously acquired by 'acquireRead'.
+    """
+    s = self._userStripe(user)
+    s.lock.acquire()
+    try:
+      u = s.users[user]
+      u.readers -= 1
+      l = self._dispatch(u)
+      if u.isIdle(): del s.users[user]
+    finally:
+      s.lock.release()
+    for w in l: w.wake()
+
+  def readSnapshot (self, identifiers):
+    """
+    Returns an opaque snapshot of the lock state of a list of
+    identifiers, or None if any identifier is currently locked.  A
+    read of the identifiers bracketed by two equal, non-None snapshots
+    did not overlap any write performed under this manager's locks.
+    """
+    snapshot = []
+    for identifier in identifiers:
+      s = self._identifierStripe(identifier)
+      s.lock.acquire()
+      try:
+        if identifier in s.locked: return None
+        snapshot.append(s.generation)
+      finally:
+        s.lock.release()
+    return tuple(snapshot)
+
+  def _dispatchAll (self):
+    for s in self._userStripes:
+      l = []
+      s.lock.acquire()
+      try:
+        for u in s.users.values(): l.extend(self._dispatch(u))
+      finally:
+        s.lock.release()
+      for w in l: w.wake()
+
+  def setLimits (self, perUserThrottle, perUserThreadLimit,
+    perUserReadThrottle):
+    """
+    Changes the per-user throttles and thread limit.
+    """
+    self._perUserThrottle = perUserThrottle
+    self._perUserThreadLimit = perUserThreadLimit
+    self._perUserReadThrottle = perUserReadThrottle
+    self._dispatchAll()
+
+  def getStatus (self):
+    """
+    Returns a tuple consisting of two dictionaries and a boolean flag.
+    The first dictionary maps usernames to the number of operations
+    (including read-only operations) currently being performed by that
+    user; the second similarly maps usernames to numbers of waiting
+    requests.  The boolean flag indicates if the manager is paused.
+    Users with zero counts are omitted from the dictionaries.
+    """
+    active = {}
+    waiting = {}
+    for s in self._userStripes:
+      s.lock.acquire()
+      try:
+        for user, u in s.users.items():
+          n = u.slots + u.readers
+          if n > 0: active[user] = n
+          n = len(u.queue) + u.idWaiting + len(u.readQueue)
+          if n > 0: waiting[user] = n
+      finally:
+        s.lock.release()
+    return (active, waiting, self._paused)
+
+  def pause (self, newValue):
+    """
+    Sets or unsets the paused flag and returns the flag's previous
+    value.
+    """
+    oldValue = self._paused
+    self._paused = newValue
+    # The flag is set before dispatching so that any thread that
+    # enqueues itself after we've visited its stripe sees the new
+    # value.
+    if not newValue: self._dispatchAll()
+    return oldValue
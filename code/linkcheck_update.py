@@ -27,7 +27,9 @@ import uuid
 
 import config
 import ezidapp.models
+import ezidapp.models.search_identifier_summary
 import log
+import search_util
 
 _enabled = None
 _resultsUploadCycle = None
@@ -87,11 +89,20 @@ def _linkcheckUpdateDaemon ():
           # the table and ensure that the object still exists.
           try:
             with django.db.transaction.atomic(using="search"):
-              si2 = ezidapp.models.SearchIdentifier.objects.get(
-                identifier=si.identifier)
+              si2 = ezidapp.models.SearchIdentifier.objects.\
+                select_for_update().get(identifier=si.identifier)
+              before = ezidapp.models.search_identifier_summary.classOf(si2)
               si2.linkIsBroken = newValue
               si2.computeHasIssues()
               si2.save(update_fields=["linkIsBroken", "hasIssues"])
+              ezidapp.models.search_identifier_summary.adjust({ before: 1 },
+                { ezidapp.models.search_identifier_summary.classOf(si2): 1 })
+            # Cached issue and broken link counts are now stale.
+            search_util.invalidateResultCache(
+              list(ezidapp.models.SearchUser.objects.filter(
+              id=si2.owner_id).values_list("username", flat=True)),
+              list(ezidapp.models.SearchGroup.objects.filter(
+              id=si2.ownergroup_id).values_list("groupname", flat=True)))
           except ezidapp.models.SearchIdentifier.DoesNotExist:
             pass
         si = siGenerator.next()
@@ -14,6 +14,7 @@
 # -----------------------------------------------------------------------------
 
 import base64
+import django.http
 
 # Some things in life are just destined to remain a mystery.  If the
 # EZID administrator is logged in and viewing a Django admin page, and
@@ -24,6 +25,7 @@ import base64
 # Why?!
 
 import config
+import search_util
 
 class ExceptionScrubberMiddleware:
   def process_exception (self, request, exception):
@@ -37,3 +39,13 @@ class ExceptionScrubberMiddleware:
       except:
         s = "********"
       request.META["HTTP_AUTHORIZATION"] = s
+
+class SearchLimitMiddleware:
+  # Maps searches refused or cancelled due to resource limits to
+  # "service unavailable" responses.
+  def process_exception (self, request, exception):
+    if isinstance(exception, search_util.SearchLimitException):
+      r = django.http.HttpResponse("error: service unavailable - %s\n" %\
+        str(exception), status=503, content_type="text/plain; charset=UTF-8")
+      r["Retry-After"] = str(exception.retryAfter)
+      return r
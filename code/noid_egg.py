@@ -30,10 +30,9 @@
 
 import base64
 import re
-import time
-import urllib2
 
 import config
+import http_pool
 import util
 
 _server = None
@@ -54,11 +53,10 @@ _loadConfig()
 config.registerReloadListener(_loadConfig)
 
 def _issue (method, operations):
-  r = urllib2.Request(_server + "?-")
-  r.get_method = lambda: method
-  r.add_header("Authorization", _authorization)
+  headers = { "Authorization": _authorization }
+  body = None
   if len(operations) > 0:
-    r.add_header("Content-Type", "text/plain")
+    headers["Content-Type"] = "text/plain"
     l = []
     for o in operations:
       # o = (identifier, operation [,element [, value]])
@@ -66,20 +64,9 @@ def _issue (method, operations):
       if len(o) > 2: s += " " + util.encode4(o[2])
       if len(o) > 3: s += " " + util.encode3(o[3])
       l.append(s)
-    r.add_data("\n".join(l))
-  for i in range(_numAttempts):
-    c = None
-    try:
-      c = urllib2.urlopen(r)
-      s = c.readlines()
-    except:
-      if i == _numAttempts-1: raise
-    else:
-      break
-    finally:
-      if c: c.close()
-    time.sleep(_reattemptDelay)
-  return s
+    body = "\n".join(l)
+  return http_pool.request(method, _server + "?-", body, headers,
+    numAttempts=_numAttempts, reattemptDelay=_reattemptDelay).readlines()
 
 def _error (operation, s):
   return ("unexpected return from noid egg '%s' operation, " +\
@@ -0,0 +1,120 @@
+# =============================================================================
+#
+# EZID :: noid_engine.py
+#
+# Identifier generation per the noid template and check character
+# algorithms <https://metacpan.org/pod/Noid>.  This module is the
+# computational core of EZID's local minter (see noid_nog.py): given a
+# template and a counter value, it produces the corresponding
+# identifier.  It has no dependencies on Django or the rest of EZID,
+# and performs no I/O; counter state is maintained by the caller.
+#
+# A template takes the form MASK, where the first character of MASK
+# is the generation mode ("r", random; "s", sequential; "z",
+# sequential and unbounded), followed by one or more of the
+# characters "d" (a decimal digit) and "e" (an "extended digit," i.e.,
+# one of the 29 characters in 0123456789bcdfghjkmnpqrstvwxz),
+# optionally followed by "k" (a check character).  For example,
+# "reedeedk".  Identifiers consist of a prefix (e.g., "99999/fk4")
+# followed by the generated characters and check character, if any.
+#
+# Caution: in every mode, a local minter's counter starts at 0, and
+# hence a local minter put in place of a noid minter that has already
+# minted on a shoulder will mint the same identifiers again unless its
+# counter is first advanced past them using the ezidsetmintercounter
+# management command.  In the sequential modes, setting the counter to
+# the noid minter's counter value suffices, as identifiers are
+# generated in the same order.  But noid's random mode draws
+# identifiers in an order determined by Perl's random number
+# generator, which cannot be reproduced here.  Instead, random mode
+# applies a fixed, prefix-specific permutation to the counter, which
+# yields identifiers that are similarly unpredictable and likewise
+# never repeat until the template's capacity is exhausted, but in a
+# different order.  Hence no counter value makes it safe to continue
+# minting on a shoulder previously served by a noid minter in random
+# mode; a local minter should be used only for a new shoulder.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import fractions
+import hashlib
+import re
+
+_xdigits = "0123456789bcdfghjkmnpqrstvwxz"
+_ordinals = dict((c, i) for i, c in enumerate(_xdigits))
+_radices = { "d": 10, "e": len(_xdigits) }
+
+def checkChar (s):
+  """
+  Returns the noid check character for a string, which should
+  include the NAAN, e.g., "13030/fk35717n0".  Each character's ordinal
+  (its position in the extended digit alphabet, or zero for
+  characters outside that alphabet) is multiplied by the character's
+  1-based position in the string; the check character is the extended
+  digit indexed by the sum of products modulo 29.
+  """
+  return _xdigits[sum(_ordinals.get(c, 0)*(i+1) for i, c in enumerate(s))%\
+    len(_xdigits)]
+
+def isValidTemplate (template):
+  """
+  Returns True if a string is a syntactically valid template.
+  """
+  return re.match("[rsz][de]+k?$", template) != None
+
+class Template (object):
+  """
+  A parsed template, e.g., "reedeedk".
+  """
+
+  def __init__ (self, template):
+    assert isValidTemplate(template), "invalid minter template: " + template
+    self.mode = template[0]
+    self.hasCheckChar = template.endswith("k")
+    self.mask = template[1:-1] if self.hasCheckChar else template[1:]
+    self.capacity = reduce(lambda a, c: a*_radices[c], self.mask, 1)
+
+  def isExhausted (self, n):
+    """
+    Returns True if counter value 'n' (numbered from 0) exceeds the
+    template's capacity.  Unbounded templates are never exhausted.
+    """
+    return self.mode != "z" and n >= self.capacity
+
+  def _permute (self, n, prefix):
+    # A bijection on [0, capacity): n -> (a*n+b) mod capacity, where a
+    # is coprime to the capacity.  The coefficients are derived from
+    # the prefix so that different shoulders' sequences are unrelated.
+    h = int(hashlib.md5(prefix).hexdigest(), 16)
+    a = (h >> 64)%self.capacity or 1
+    while fractions.gcd(a, self.capacity) != 1: a += 1
+    b = h%self.capacity
+    return (a*n+b)%self.capacity
+
+  def generate (self, n, prefix):
+    """
+    Returns the identifier corresponding to counter value 'n'
+    (numbered from 0) under prefix 'prefix', which should include the
+    NAAN, e.g., "99999/fk4".
+    """
+    assert not self.isExhausted(n), "minter template exhausted"
+    if self.mode == "r": n = self._permute(n, prefix)
+    s = []
+    for c in reversed(self.mask):
+      n, d = divmod(n, _radices[c])
+      s.append(_xdigits[d])
+    # In unbounded mode, the mask is extended leftward by repeating
+    # its first character as necessary.
+    while n > 0:
+      n, d = divmod(n, _radices[self.mask[0]])
+      s.append(_xdigits[d])
+    id = prefix + "".join(reversed(s))
+    if self.hasCheckChar: id += checkChar(id)
+    return id
@@ -6,6 +6,26 @@
 # Because EZID interacts with multiple nog minters, the interface is
 # expressed as a class.
 #
+# Identifiers are minted in batches and cached.  A minter's cache is
+# refilled by a background thread when it falls to a low watermark, so
+# that minting normally never waits on the minter server.  The cache's
+# high watermark (and hence the refill batch size) adapts to the rate
+# at which identifiers are minted from the minter.  Minted identifiers
+# are recorded in the store database as reservations before being
+# cached, and are reloaded by the next server process should this one
+# stop before using them (see ezidapp/models/minter_reservation.py).
+#
+# Minter servers are configured in the [minter_server_*] sections of
+# the configuration file; a minter belongs to the server whose URL
+# its URL begins with.  A server may be a remote noid nog server or
+# EZID's built-in "local" engine, which mints using the server's noid
+# template (see noid_engine.py) and counters stored in the store
+# database (see ezidapp/models/minter_counter.py).  The last two path
+# components of a local minter's URL give the identifier prefix, e.g.,
+# the minter at .../99999/fk4 mints identifiers 99999/fk4....  A local
+# minter's counter starts at 0; see the caution in noid_engine.py
+# before pointing an existing shoulder at the local engine.
+#
 # Author:
 #   Greg Janee <gjanee@ucop.edu>
 #
@@ -16,28 +36,44 @@
 # -----------------------------------------------------------------------------
 
 import base64
+import collections
+import django.db
+import math
+import re
 import threading
 import time
-import urllib2
 
 import config
+import http_pool
+import noid_engine
 
 _lock = threading.Lock()
 _minterServers = None
+_localMinterServers = None
 _numAttempts = None
 _reattemptDelay = None
 _minters = None
 _cacheSize = None
+_maxCacheSize = None
+_lowWatermark = None
+_cacheHorizon = None
 
 def _loadConfig ():
-  global _minterServers, _numAttempts, _reattemptDelay, _minters, _cacheSize
+  global _minterServers, _localMinterServers, _numAttempts, _reattemptDelay
+  global _minters, _cacheSize, _maxCacheSize, _lowWatermark, _cacheHorizon
   d = {}
+  ld = {}
   for ms in config.get("shoulders.minter_servers").split(","):
     p = "minter_server_" + ms
-    d[config.get(p + ".url")] = "Basic " +\
-      base64.b64encode(config.get(p + ".username") + ":" +\
-      config.get(p + ".password"))
+    if config.get(p + ".engine") == "local":
+      ld[config.get(p + ".url")] =\
+        noid_engine.Template(config.get(p + ".template"))
+    else:
+      d[config.get(p + ".url")] = "Basic " +\
+        base64.b64encode(config.get(p + ".username") + ":" +\
+        config.get(p + ".password"))
   _minterServers = d
+  _localMinterServers = ld
   _numAttempts = int(config.get("shoulders.minter_num_attempts"))
   _reattemptDelay = int(config.get("shoulders.minter_reattempt_delay"))
   _lock.acquire()
@@ -46,16 +82,18 @@ def _loadConfig ():
   finally:
     _lock.release()
   _cacheSize = int(config.get("shoulders.minter_cache_size"))
+  _maxCacheSize = int(config.get("shoulders.minter_cache_max_size"))
+  _lowWatermark = float(config.get("shoulders.minter_cache_low_watermark"))
+  _cacheHorizon = int(config.get("shoulders.minter_cache_horizon"))
 
 _loadConfig()
 config.registerReloadListener(_loadConfig)
 
-def _addAuthorization (request):
+def _authorizationHeaders (url):
   d = _minterServers
   for ms in d:
-    if request.get_full_url().startswith(ms):
-      request.add_header("Authorization", d[ms])
-      break
+    if url.startswith(ms): return { "Authorization": d[ms] }
+  return {}
 
 class Minter (object):
   """
@@ -67,56 +105,131 @@ class Minter (object):
     Creates an interface to the noid nog minter at the supplied URL.
     """
     self.url = url
-    self.cache = []
-    self.lock = threading.Lock()
+    # For a local minter, 'template' is the noid template and 'prefix'
+    # the identifier prefix; otherwise, 'template' is None.
+    self.template = None
+    for ms, t in _localMinterServers.items():
+      if url.startswith(ms):
+        l = [c for c in url.split("/") if c != ""]
+        # The prefix's NAAN is either a true ARK NAAN or, for a DOI
+        # shoulder, a shadow ARK NAAN, e.g., "b5060".
+        assert len(l) >= 2 and\
+          re.match("[0-9bcdfghjkmnpqrstvwxz]\\d{4}$", l[-2]) != None,\
+          "local minter URL lacks identifier prefix: " + url
+        self.template = t
+        self.prefix = l[-2] + "/" + l[-1]
+        break
+    # 'cache' holds (reservation ID, identifier) tuples.  'loaded'
+    # indicates if previously reserved identifiers have been loaded.
+    # 'error' is the exception raised by the most recent refill, if it
+    # failed.  'rate' is the estimated minting rate in identifiers per
+    # second, and 'numMinted' the number of identifiers minted since
+    # 'sampleTime'.
+    self.cache = collections.deque()
+    self.condition = threading.Condition()
+    self.loaded = False
+    self.refilling = False
+    self.error = None
+    self.highWatermark = _cacheSize
+    self.rate = None
+    self.numMinted = 0
+    self.sampleTime = time.time()
+
+  def _startRefill (self):
+    # Must be called with the condition held.  Updates the minting
+    # rate estimate and high watermark, and starts a refill thread.
+    now = time.time()
+    if self.loaded and now > self.sampleTime:
+      r = self.numMinted/(now-self.sampleTime)
+      self.rate = r if self.rate == None else (self.rate+r)/2
+      self.highWatermark = max(_cacheSize, min(_maxCacheSize,
+        int(math.ceil(self.rate*_cacheHorizon))))
+    self.numMinted = 0
+    self.sampleTime = now
+    self.refilling = True
+    self.error = None
+    t = threading.Thread(target=self._refill,
+      args=(max(1, self.highWatermark-len(self.cache)),))
+    t.setDaemon(True)
+    t.start()
+
+  def _fetch (self, n):
+    # Mints 'n' identifiers from the minter server or, for a local
+    # minter, by reserving a block of counter values.
+    if self.template != None:
+      import ezidapp.models.minter_counter
+      first = ezidapp.models.minter_counter.reserve(self.url, n)
+      return [self.template.generate(i, self.prefix)\
+        for i in range(first, first+n)]
+    url = "%s?mint%%20%d" % (self.url, n)
+    s = http_pool.request("GET", url, headers=_authorizationHeaders(url),
+      numAttempts=_numAttempts, reattemptDelay=_reattemptDelay).readlines()
+    assert len(s) >= n+1 and\
+      all(l.startswith("id:") or l.startswith("s:") for l in s[:n]) and\
+      s[-2] == "nog-status: 0\n",\
+      "unexpected return from minter, output follows\n" + "".join(s)
+    return [l.split(":")[1].strip() for l in s[:n]]
+
+  def _refill (self, n):
+    import ezidapp.models.minter_reservation
+    entries = []
+    loaded = self.loaded
+    error = None
+    try:
+      if not loaded:
+        entries = ezidapp.models.minter_reservation.getReservations(self.url)
+        loaded = True
+      if len(entries) < n:
+        entries.extend(ezidapp.models.minter_reservation.reserve(self.url,
+          self._fetch(n-len(entries))))
+    except Exception, e:
+      error = e
+    finally:
+      django.db.connections["default"].close()
+    self.condition.acquire()
+    try:
+      self.cache.extend(entries)
+      self.loaded = loaded
+      self.error = error
+      self.refilling = False
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
 
   def mintIdentifier (self):
     """
     Mints and returns a scheme-less ARK identifier, e.g.,
     "13030/fk35717n0h".  Raises an exception on error.
     """
-    self.lock.acquire()
-    try:
-      cs = _cacheSize
-      if len(self.cache) == 0:
-        r = urllib2.Request("%s?mint%%20%d" % (self.url, cs))
-        _addAuthorization(r)
-        for i in range(_numAttempts):
-          c = None
-          try:
-            c = urllib2.urlopen(r)
-            s = c.readlines()
-          except:
-            if i == _numAttempts-1: raise
-          else:
-            break
-          finally:
-            if c: c.close()
-          time.sleep(_reattemptDelay)
-        assert len(s) >= cs+1 and\
-          all(l.startswith("id:") or l.startswith("s:") for l in s[:cs]) and\
-          s[-2] == "nog-status: 0\n",\
-          "unexpected return from minter, output follows\n" + "".join(s)
-        self.cache = [l.split(":")[1].strip() for l in s[:cs]]
-      id = self.cache[0]
-      self.cache = self.cache[1:]
-      return id
-    finally:
-      self.lock.release()
+    import ezidapp.models.minter_reservation
+    while True:
+      self.condition.acquire()
+      try:
+        while len(self.cache) == 0:
+          if not self.refilling: self._startRefill()
+          self.condition.wait()
+          if len(self.cache) == 0 and not self.refilling and\
+            self.error != None:
+            raise self.error
+        rid, id = self.cache.popleft()
+        self.numMinted += 1
+        if not self.refilling and len(self.cache) <=\
+          int(math.ceil(self.highWatermark*_lowWatermark)):
+          self._startRefill()
+      finally:
+        self.condition.release()
+      # The identifier may have been claimed by another server process
+      # that loaded the same reservations.
+      if ezidapp.models.minter_reservation.claim(rid): return id
 
   def ping (self):
     """
     Tests the minter, returning "up" or "down".
     """
+    if self.template != None: return "up"
     try:
-      r = urllib2.Request(self.url)
-      _addAuthorization(r)
-      c = None
-      try:
-        c = urllib2.urlopen(r)
-        s = c.readlines()
-      finally:
-        if c: c.close()
+      s = http_pool.request("GET", self.url,
+        headers=_authorizationHeaders(self.url)).readlines()
       assert len(s) >= 2 and s[-2] == "nog-status: 0\n"
       return "up"
     except Exception:
@@ -124,7 +237,8 @@ class Minter (object):
 
 def getMinter (url):
   """
-  Returns a Minter object for a noid nog minter at the supplied URL.
+  Returns a Minter object for a noid nog minter (or local minter) at
+  the supplied URL.
   """
   _lock.acquire()
   try:
@@ -0,0 +1,210 @@
+# =============================================================================
+#
+# EZID :: notification.py
+#
+# Wakeup notifications for daemon threads.  A daemon thread that
+# processes a queue creates a Listener on a named channel (by
+# convention, the name of the queue's model, e.g., "UpdateQueue") and,
+# when the queue is empty, waits on the listener with its idle sleep
+# as a timeout.  Code that adds to the queue signals the channel, and
+# the daemon wakes immediately.  Notifications are advisory only: a
+# lost notification merely delays processing until the daemon's
+# timeout expires, so daemons must continue to check their queues on
+# timeout.
+#
+# A listener remembers whether its channel has been signaled since the
+# listener last waited, so a notification that arrives while the
+# daemon is busy is not lost.  Multiple notifications coalesce.
+#
+# Two backends are supported.  The "thread" backend delivers
+# notifications only to listeners in the same process.  The "socket"
+# backend delivers notifications across processes (e.g., when multiple
+# server processes share the database): each listener binds a Unix
+# datagram socket in a shared directory, and signaling a channel sends
+# a one-byte datagram to each socket belonging to the channel.
+# Channels created with local=True always use the thread backend; they
+# are intended for coordinating threads within a process.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.db
+import errno
+import os
+import os.path
+import select
+import socket
+import threading
+import uuid
+
+_lock = threading.Lock()
+_backend = None
+_socketDirectory = None
+_channels = {}
+
+def _loadConfig (acquireLock=True):
+  global _backend, _socketDirectory
+  import config
+  if acquireLock: _lock.acquire()
+  try:
+    _backend = config.get("daemons.notification_backend")
+    assert _backend in ["thread", "socket"],\
+      "invalid notification backend: " + _backend
+    _socketDirectory = config.get("daemons.notification_socket_directory")
+    if _backend == "socket" and not os.path.isdir(_socketDirectory):
+      os.makedirs(_socketDirectory)
+  finally:
+    if acquireLock: _lock.release()
+
+def _ensureConfigLoaded ():
+  # This module is used by models, and hence can't register a reload
+  # listener at import time without creating a circular import.
+  if _backend is None:
+    import config
+    _lock.acquire()
+    try:
+      if _backend is None:
+        _loadConfig(acquireLock=False)
+        config.registerReloadListener(_loadConfig)
+    finally:
+      _lock.release()
+
+def _useSockets (local):
+  _ensureConfigLoaded()
+  return not local and _backend == "socket"
+
+class _Channel (object):
+  # An in-process channel.  'generation' is incremented every time the
+  # channel is signaled.
+  def __init__ (self):
+    self.condition = threading.Condition()
+    self.generation = 0
+
+def _getChannel (name):
+  _lock.acquire()
+  try:
+    c = _channels.get(name)
+    if c == None:
+      c = _Channel()
+      _channels[name] = c
+    return c
+  finally:
+    _lock.release()
+
+def _socketPrefix (channel):
+  return os.path.join(_socketDirectory, channel + ".")
+
+class Listener (object):
+  """
+  A listener on a notification channel.  A listener should be used by
+  a single thread only.
+  """
+
+  def __init__ (self, channel, local=False):
+    assert "." not in channel and "/" not in channel
+    self._socket = None
+    if _useSockets(local):
+      self._path = "%s%d.%s" % (_socketPrefix(channel), os.getpid(),
+        uuid.uuid1().hex[:12])
+      self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self._socket.setblocking(0)
+      self._socket.bind(self._path)
+    else:
+      self._channel = _getChannel(channel)
+      self._generation = self._channel.generation
+
+  def wait (self, timeout):
+    """
+    Waits until the channel has been signaled since the last call to
+    this method (or since the listener was created), or until
+    'timeout' seconds have elapsed.  Returns True in the former case,
+    False in the latter.
+    """
+    if self._socket != None:
+      if len(select.select([self._socket], [], [], timeout)[0]) == 0:
+        return False
+      # Drain all pending notifications.
+      try:
+        while True: self._socket.recv(16)
+      except socket.error, e:
+        if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]: raise
+      return True
+    else:
+      c = self._channel
+      c.condition.acquire()
+      try:
+        if c.generation == self._generation: c.condition.wait(timeout)
+        signaled = (c.generation != self._generation)
+        self._generation = c.generation
+        return signaled
+      finally:
+        c.condition.release()
+
+  def close (self):
+    """
+    Releases the listener's resources.
+    """
+    if self._socket != None:
+      self._socket.close()
+      self._socket = None
+      try:
+        os.unlink(self._path)
+      except OSError:
+        pass
+
+def _signalSockets (channel):
+  prefix = _socketPrefix(channel)
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  try:
+    s.setblocking(0)
+    for f in os.listdir(_socketDirectory):
+      path = os.path.join(_socketDirectory, f)
+      if not path.startswith(prefix): continue
+      try:
+        s.sendto("!", path)
+      except socket.error, e:
+        if e.errno in [errno.ECONNREFUSED, errno.ENOENT]:
+          # The socket was left behind by a defunct listener.
+          try:
+            os.unlink(path)
+          except OSError:
+            pass
+        # Otherwise (most likely, the listener's receive buffer is
+        # full), the listener already has notifications pending.
+  finally:
+    s.close()
+
+def signalNow (channel, local=False):
+  """
+  Signals a notification channel immediately.
+  """
+  if _useSockets(local):
+    try:
+      _signalSockets(channel)
+    except (socket.error, OSError):
+      # Notifications are advisory; listeners will eventually time
+      # out and check their queues regardless.
+      pass
+  else:
+    c = _getChannel(channel)
+    c.condition.acquire()
+    try:
+      c.generation += 1
+      c.condition.notifyAll()
+    finally:
+      c.condition.release()
+
+def signal (channel, local=False):
+  """
+  Signals a notification channel when the current transaction on the
+  default database commits, or immediately if no transaction is in
+  progress.  Signaling before commit would wake listeners before the
+  queue entries they're being notified of are visible to them.
+  """
+  django.db.connection.on_commit(lambda: signalNow(channel, local))
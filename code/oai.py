@@ -14,16 +14,20 @@
 #
 # -----------------------------------------------------------------------------
 
+import collections
 import django.conf
 import django.db.models
 import django.http
 import hashlib
 import lxml.etree
+import re
+import threading
 import time
 
 import config
 import datacite
 import ezidapp.models
+import log
 import util
 
 _enabled = None
@@ -31,14 +35,27 @@ _baseUrl = None
 _repositoryName = None
 _adminEmail = None
 _batchSize = None
+_chunkSize = None
+_cacheTtl = None
+_lock = threading.Lock()
+_cache = collections.OrderedDict()
+_maxCacheSize = 1000
 
 def _loadConfig ():
   global _enabled, _baseUrl, _repositoryName, _adminEmail, _batchSize
+  global _chunkSize, _cacheTtl
   _enabled = (config.get("oai.enabled").lower() == "true")
   _baseUrl = config.get("DEFAULT.ezid_base_url")
   _repositoryName = config.get("oai.repository_name")
   _adminEmail = config.get("oai.admin_email")
   _batchSize = int(config.get("oai.batch_size"))
+  _chunkSize = int(config.get("oai.chunk_size"))
+  _lock.acquire()
+  try:
+    _cacheTtl = int(config.get("oai.cache_ttl"))
+    _cache.clear()
+  finally:
+    _lock.release()
 
 _loadConfig()
 config.registerReloadListener(_loadConfig)
@@ -52,7 +69,7 @@ def _parseTime (s):
   except:
     return None
 
-def _buildResponse (oaiRequest, body):
+def _buildResponse (oaiRequest, body, fragments=[]):
   root = lxml.etree.Element(_q("OAI-PMH"),
     nsmap={ None: "http://www.openarchives.org/OAI/2.0/" })
   root.attrib["{http://www.w3.org/2001/XMLSchema-instance}schemaLocation"] =\
@@ -69,8 +86,29 @@ def _buildResponse (oaiRequest, body):
     e.attrib["verb"] = oaiRequest[0]
     for k, v in oaiRequest[1].items(): e.attrib[k] = v
   root.append(body)
-  return lxml.etree.tostring(root.getroottree(), encoding="UTF-8",
+  r = lxml.etree.tostring(root.getroottree(), encoding="UTF-8",
     xml_declaration=True)
+  if len(fragments) > 0:
+    # Record metadata, being already serialized, is spliced into the
+    # empty metadata elements in the body.  (Such an element can't
+    # otherwise appear verbatim, as text and attribute values are
+    # escaped.)
+    l = r.split("<metadata/>")
+    assert len(l) == len(fragments)+1, "metadata element mismatch"
+    r = l[0] + "".join("<metadata>%s</metadata>%s" % (f.encode("UTF-8"),
+      l[i+1]) for i, f in enumerate(fragments))
+  return r
+
+def _streamResponse (oaiRequest, body, content):
+  # Like _buildResponse, but returns a generator that yields the
+  # response in pieces.  'body' should be an empty element; 'content'
+  # should be a generator that yields the serialized contents of the
+  # body.
+  tag = body.tag.split("}")[1]
+  head, tail = _buildResponse(oaiRequest, body).split("<%s/>" % tag)
+  yield head + "<%s>" % tag
+  for c in content: yield c
+  yield "</%s>" % tag + tail
 
 def _error (oaiRequest, code, message=None):
   e = lxml.etree.Element(_q("error"))
@@ -131,31 +169,168 @@ def _buildRequest (request):
         return _error(None, "badArgument", "missing required argument: " + k)
   return r
 
-def _buildResumptionToken (from_, until, prefix, cursor, total):
-  # The semantics of a resumption token: return identifiers whose
-  # update times are in the range (from_, until].  'until' may be None.
+def _buildResumptionToken (from_, until, prefix, set_, cursor, total):
+  # The semantics of a resumption token: return identifiers in set
+  # 'set_' (empty meaning all identifiers) whose update times are in
+  # the range (from_, until].  'until' may be None.
   if until is not None:
     until = str(until)
   else:
     until = ""
-  hash = hashlib.sha1("%d,%s,%s,%d,%d,%s" % (from_, until, prefix, cursor,
-    total, django.conf.settings.SECRET_KEY)).hexdigest()[::4]
-  return "%d,%s,%s,%d,%d,%s" % (from_, until, prefix, cursor, total, hash)
+  hash = hashlib.sha1("%d,%s,%s,%s,%d,%d,%s" % (from_, until, prefix,
+    set_, cursor, total, django.conf.settings.SECRET_KEY)).hexdigest()[::4]
+  return "%d,%s,%s,%s,%d,%d,%s" % (from_, until, prefix, set_, cursor,
+    total, hash)
 
 def _unpackResumptionToken (token):
   try:
-    from_, until, prefix, cursor, total, hash1 = token.split(",")
-    hash2 = hashlib.sha1("%s,%s,%s,%s,%s,%s" % (from_, until, prefix, cursor,
-      total, django.conf.settings.SECRET_KEY)).hexdigest()[::4]
+    l = token.split(",")
+    # Tokens issued before sets were supported lack the set field.
+    if len(l) == 6: l.insert(3, "")
+    from_, until, prefix, set_, cursor, total, hash1 = l
+    if len(token.split(",")) == 6:
+      hash2 = hashlib.sha1("%s,%s,%s,%s,%s,%s" % (from_, until, prefix,
+        cursor, total, django.conf.settings.SECRET_KEY)).hexdigest()[::4]
+    else:
+      hash2 = hashlib.sha1("%s,%s,%s,%s,%s,%s,%s" % (from_, until, prefix,
+        set_, cursor, total, django.conf.settings.SECRET_KEY))\
+        .hexdigest()[::4]
     assert hash1 == hash2
     if len(until) > 0:
       until = int(until)
     else:
       until = None
-    return (int(from_), until, prefix, int(cursor), int(total))
+    return (int(from_), until, prefix, set_, int(cursor), int(total))
   except:
     return None
 
+# Sets.  Identifiers are grouped into three set hierarchies:
+#
+#   group:GROUPNAME       identifiers owned by a group
+#   realm:REALM           identifiers owned by groups in a realm
+#   shoulder:SCHEME:...   identifiers beginning with a shoulder, e.g.,
+#                         shoulder:ark:13030:c7 for ark:/13030/c7 and
+#                         shoulder:doi:10.5072:FK2 for doi:10.5072/FK2
+#
+# Set specs are restricted to a limited character set; characters in
+# realm names outside that set are replaced with underscores.
+# Shoulder sets are hierarchical in the natural way: any prefix of a
+# shoulder set spec (e.g., shoulder:ark:13030) may also be harvested,
+# though only sets corresponding to shoulders are listed.
+
+_setSpecComponent = "[A-Za-z0-9\\-_.!~*'()]+"
+_setSpecPattern = re.compile("%s(:%s)*$" % (_setSpecComponent,
+  _setSpecComponent))
+
+def _mangle (s):
+  return re.sub("[^A-Za-z0-9\\-_.!~*'()]", "_", s)
+
+def _shoulderSetSpec (prefix):
+  # Returns the set spec corresponding to a shoulder, or None if the
+  # shoulder can't be represented.
+  scheme, rest = prefix.split(":", 1)
+  if scheme == "ark": rest = rest[1:]
+  l = rest.split("/")
+  if l[-1] == "": l = l[:-1]
+  s = ":".join(["shoulder", scheme] + l)
+  if _setSpecPattern.match(s):
+    return s
+  else:
+    return None
+
+def _shoulderPrefix (components):
+  # Inverts _shoulderSetSpec.  'components' is the list of set spec
+  # components following "shoulder".  Returns None if the components
+  # don't describe a shoulder (or shoulder prefix).
+  if components[0] == "ark" and len(components) > 1:
+    return "ark:/%s/%s" % (components[1], "/".join(components[2:]))
+  elif components[0] == "doi" and len(components) > 1:
+    return "doi:%s/%s" % (components[1], "/".join(components[2:]))
+  elif components[0] == "uuid" and len(components) == 1:
+    return "uuid:"
+  else:
+    return None
+
+def _setFilter (set_):
+  # Returns a Q object that restricts SearchIdentifier objects to those
+  # in set 'set_', or None if the set spec is invalid.
+  if not _setSpecPattern.match(set_): return None
+  l = set_.split(":")
+  if l[0] == "group" and len(l) == 2:
+    return django.db.models.Q(ownergroup__groupname=l[1])
+  elif l[0] == "realm" and len(l) == 2:
+    return django.db.models.Q(ownergroup__realm__in=[r.id for r in\
+      ezidapp.models.SearchRealm.objects.all() if _mangle(r.name) == l[1]])
+  elif l[0] == "shoulder" and len(l) >= 2:
+    p = _shoulderPrefix(l[1:])
+    if p == None: return None
+    return django.db.models.Q(identifier__startswith=p)
+  else:
+    return None
+
+def _memberSets (identifier):
+  # Returns the specs of the (lowest-level) sets an identifier belongs
+  # to.  The identifier's ownergroup and realm must be loaded.
+  l = []
+  if identifier.ownergroup != None:
+    l.append("group:" + identifier.ownergroup.groupname)
+    l.append("realm:" + _mangle(identifier.ownergroup.realm.name))
+  s = ezidapp.models.getLongestShoulderMatch(identifier.identifier)
+  if s != None:
+    s = _shoulderSetSpec(s.prefix)
+    if s != None: l.append(s)
+  return l
+
+def _cached (key, function):
+  # Returns the value cached under 'key' if it has not expired;
+  # otherwise, calls 'function' and caches and returns its value.
+  # The cache holds repository-wide aggregates that would otherwise
+  # be recomputed by every Identify request and every harvest: a
+  # value that is briefly out of date is harmless, as OAI-PMH
+  # considers both the earliest datestamp and the complete list size
+  # to be advisory.
+  now = time.time()
+  _lock.acquire()
+  try:
+    if key in _cache:
+      v, expiry = _cache.pop(key)
+      if expiry > now:
+        _cache[key] = (v, expiry)
+        return v
+  finally:
+    _lock.release()
+  v = function()
+  if _cacheTtl > 0:
+    _lock.acquire()
+    try:
+      _cache[key] = (v, now+_cacheTtl)
+      while len(_cache) > _maxCacheSize: _cache.popitem(last=False)
+    finally:
+      _lock.release()
+  return v
+
+def _earliestDatestamp ():
+  def compute ():
+    l = [ezidapp.models.SearchIdentifier.objects.filter(oaiVisible=True)\
+      .aggregate(django.db.models.Min("updateTime"))["updateTime__min"],
+      ezidapp.models.SearchIdentifierTombstone.objects\
+      .aggregate(django.db.models.Min("deleteTime"))["deleteTime__min"]]
+    return min([t for t in l if t != None] or [0])
+  return _cached("earliest", compute)
+
+def _completeListSize (from_, until, set_, querySets):
+  # Returns the number of records matching harvest QuerySets
+  # 'querySets' (of identifiers and tombstones), which cover set
+  # 'set_' and the update time range (from_, until], or -1 if the
+  # number is not to be reported.  Incremental harvests, which supply
+  # a different range nearly every time, would defeat caching, and
+  # counting the records in a range may take time proportional to the
+  # size of the repository; thus the number is reported for complete
+  # harvests only, and is cached per set.  (OAI-PMH makes the complete
+  # list size optional.)
+  if from_ != 0 or until != None: return -1
+  return _cached(("size", set_), lambda: sum(q.count() for q in querySets))
+
 def _buildDublinCoreRecord (identifier):
   root = lxml.etree.Element(
     "{http://www.openarchives.org/OAI/2.0/oai_dc/}dc",
@@ -180,29 +355,74 @@ def _buildDublinCoreRecord (identifier):
         lxml.etree.SubElement(root, q(e)).text = util.sanitizeXmlSafeCharset(getattr(km, e)).strip()
   return root
 
+def serializeMetadata (identifier, prefix):
+  """
+  Returns the record metadata for a SearchIdentifier object in the
+  given metadata format ("oai_dc" or "datacite") serialized as a
+  Unicode string, i.e., the would-be contents of the OAI-PMH
+  <metadata> element.  Raises an exception if the metadata can't be
+  converted.
+  """
+  if prefix == "oai_dc":
+    me = _buildDublinCoreRecord(identifier)
+  elif prefix == "datacite":
+    me = datacite.upgradeDcmsRecord(identifier.dataciteMetadata(),
+      returnString=False)
+  else:
+    assert False, "unhandled case"
+  return lxml.etree.tostring(me, encoding=unicode)
+
+# The SearchIdentifier fields holding precomputed record metadata.
+_recordFields = { "oai_dc": "oaiDublinCoreRecord",
+  "datacite": "oaiDataciteRecord" }
+
+def _metadata (identifier, prefix):
+  # Returns serialized record metadata, preferring the precomputed
+  # copy.  Metadata is computed on the fly for identifiers last
+  # written before precomputation was introduced, or whose
+  # precomputation failed.
+  r = getattr(identifier, _recordFields[prefix])
+  if r == "": r = serializeMetadata(identifier, prefix)
+  return r
+
 def _doGetRecord (oaiRequest):
   id = util.normalizeIdentifier(oaiRequest[1]["identifier"])
   if id == None: return _error(oaiRequest, "idDoesNotExist")
   try:
-    identifier = ezidapp.models.SearchIdentifier.objects.get(identifier=id)
+    identifier = ezidapp.models.SearchIdentifier.objects.\
+      select_related("ownergroup__realm").get(identifier=id)
   except ezidapp.models.SearchIdentifier.DoesNotExist:
-    return _error(oaiRequest, "idDoesNotExist")
-  if not identifier.oaiVisible: return _error(oaiRequest, "idDoesNotExist")
-  if oaiRequest[1]["metadataPrefix"] == "oai_dc":
-    me = _buildDublinCoreRecord(identifier)
-  elif oaiRequest[1]["metadataPrefix"] == "datacite":
-    me = datacite.upgradeDcmsRecord(identifier.dataciteMetadata(),
-      returnString=False)
-  else:
+    identifier = None
+  if oaiRequest[1]["metadataPrefix"] not in _recordFields:
     return _error(oaiRequest, "cannotDisseminateFormat")
+  if identifier == None or not identifier.oaiVisible:
+    try:
+      tombstone = ezidapp.models.SearchIdentifierTombstone.objects.\
+        select_related("ownergroup__realm").get(identifier=id)
+    except ezidapp.models.SearchIdentifierTombstone.DoesNotExist:
+      return _error(oaiRequest, "idDoesNotExist")
+    root = lxml.etree.Element(_q("GetRecord"))
+    h = lxml.etree.SubElement(lxml.etree.SubElement(root, _q("record")),
+      _q("header"))
+    h.attrib["status"] = "deleted"
+    lxml.etree.SubElement(h, _q("identifier")).text =\
+      oaiRequest[1]["identifier"]
+    lxml.etree.SubElement(h, _q("datestamp")).text =\
+      util.formatTimestampZulu(tombstone.deleteTime)
+    for spec in _memberSets(tombstone):
+      lxml.etree.SubElement(h, _q("setSpec")).text = spec
+    return _buildResponse(oaiRequest, root)
+  me = _metadata(identifier, oaiRequest[1]["metadataPrefix"])
   root = lxml.etree.Element(_q("GetRecord"))
   r = lxml.etree.SubElement(root, _q("record"))
   h = lxml.etree.SubElement(r, _q("header"))
   lxml.etree.SubElement(h, _q("identifier")).text = oaiRequest[1]["identifier"]
   lxml.etree.SubElement(h, _q("datestamp")).text =\
     util.formatTimestampZulu(identifier.updateTime)
-  lxml.etree.SubElement(r, _q("metadata")).append(me)
-  return _buildResponse(oaiRequest, root)
+  for spec in _memberSets(identifier):
+    lxml.etree.SubElement(h, _q("setSpec")).text = spec
+  lxml.etree.SubElement(r, _q("metadata"))
+  return _buildResponse(oaiRequest, root, [me])
 
 def _doIdentify (oaiRequest):
   e = lxml.etree.Element(_q("Identify"))
@@ -210,12 +430,9 @@ def _doIdentify (oaiRequest):
   lxml.etree.SubElement(e, _q("baseURL")).text = _baseUrl + "/oai"
   lxml.etree.SubElement(e, _q("protocolVersion")).text = "2.0"
   lxml.etree.SubElement(e, _q("adminEmail")).text = _adminEmail
-  t = ezidapp.models.SearchIdentifier.objects.filter(oaiVisible=True)\
-    .aggregate(django.db.models.Min("updateTime"))["updateTime__min"]
-  if t == None: t = 0
   lxml.etree.SubElement(e, _q("earliestDatestamp")).text =\
-    util.formatTimestampZulu(t)
-  lxml.etree.SubElement(e, _q("deletedRecord")).text = "no"
+    util.formatTimestampZulu(_earliestDatestamp())
+  lxml.etree.SubElement(e, _q("deletedRecord")).text = "persistent"
   lxml.etree.SubElement(e, _q("granularity")).text = "YYYY-MM-DDThh:mm:ssZ"
   return _buildResponse(oaiRequest, e)
 
@@ -223,12 +440,14 @@ def _doHarvest (oaiRequest, batchSize, includeMetadata):
   if "resumptionToken" in oaiRequest[1]:
     r = _unpackResumptionToken(oaiRequest[1]["resumptionToken"])
     if r == None: return _error(oaiRequest, "badResumptionToken")
-    from_, until, prefix, cursor, total = r
+    from_, until, prefix, set_, cursor, total = r
   else:
     prefix = oaiRequest[1]["metadataPrefix"]
     if prefix not in ["oai_dc", "datacite"]:
       return _error(oaiRequest, "cannotDisseminateFormat")
-    if "set" in oaiRequest[1]: return _error(oaiRequest, "noSetHierarchy")
+    set_ = oaiRequest[1].get("set", "")
+    if set_ != "" and _setFilter(set_) == None:
+      return _error(oaiRequest, "badArgument", "illegal set")
     if "from" in oaiRequest[1]:
       from_ = _parseTime(oaiRequest[1]["from"])
       if from_ == None:
@@ -254,8 +473,24 @@ def _doHarvest (oaiRequest, batchSize, includeMetadata):
   q = ezidapp.models.SearchIdentifier.objects.filter(oaiVisible=True)\
     .filter(updateTime__gt=from_)
   if until != None: q = q.filter(updateTime__lte=until)
-  q = q.select_related("profile").order_by("updateTime")
-  ids = list(q[:batchSize])
+  tq = ezidapp.models.SearchIdentifierTombstone.objects\
+    .filter(deleteTime__gt=from_)
+  if until != None: tq = tq.filter(deleteTime__lte=until)
+  if set_ != "":
+    q = q.filter(_setFilter(set_))
+    tq = tq.filter(_setFilter(set_))
+  # Only row IDs and update (or deletion) times are retrieved up front;
+  # records are retrieved in chunks as the response is streamed (see
+  # _streamRecords below).  Live identifiers and tombstones are merged
+  # into a single sequence of (time, deleted, row ID) tuples ordered
+  # by time.  The first batchSize tuples of the merge are necessarily
+  # drawn from the first batchSize tuples of each table.
+  ids = [(t, False, id) for t, id in q.order_by("updateTime", "id")\
+    .values_list("updateTime", "id")[:batchSize]] +\
+    [(t, True, id) for t, id in tq.order_by("deleteTime", "id")\
+    .values_list("deleteTime", "id")[:batchSize]]
+  ids.sort()
+  ids = ids[:batchSize]
   # Note a bug in the protocol itself: if a resumption token was
   # supplied, we are required to return a (possibly empty) token, but
   # the only way to return a resumption token is to return at least
@@ -283,7 +518,7 @@ def _doHarvest (oaiRequest, batchSize, includeMetadata):
   if len(ids) == batchSize:
     last = None
     for i in range(len(ids)-2, -1, -1):
-      if ids[i].updateTime < ids[-1].updateTime:
+      if ids[i][0] < ids[-1][0]:
         last = i
         break
     if last == None:
@@ -291,34 +526,84 @@ def _doHarvest (oaiRequest, batchSize, includeMetadata):
       return _doHarvest(oaiRequest, batchSize*2, includeMetadata)
   else:
     last = len(ids)-1
-  e = lxml.etree.Element(_q(oaiRequest[0]))
-  for i in range(last+1):
-    if includeMetadata:
-      r = lxml.etree.SubElement(e, _q("record"))
-      h = lxml.etree.SubElement(r, _q("header"))
-    else:
-      h = lxml.etree.SubElement(e, _q("header"))
-    lxml.etree.SubElement(h, _q("identifier")).text = ids[i].identifier
-    lxml.etree.SubElement(h, _q("datestamp")).text =\
-      util.formatTimestampZulu(ids[i].updateTime)
-    if includeMetadata:
-      if prefix == "oai_dc":
-        me = _buildDublinCoreRecord(ids[i])
-      elif prefix == "datacite":
-        me = datacite.upgradeDcmsRecord(ids[i].dataciteMetadata(),
-          returnString=False)
-      else:
-        assert False, "unhandled case"
-      lxml.etree.SubElement(r, _q("metadata")).append(me)
+  rt = None
   if "resumptionToken" in oaiRequest[1] or len(ids) == batchSize:
-    if total == None: total = q.count()
-    rt = lxml.etree.SubElement(e, _q("resumptionToken"))
-    rt.attrib["cursor"] = str(cursor)
-    rt.attrib["completeListSize"] = str(total)
+    # The complete list size is computed once per harvest and carried
+    # in the resumption token thereafter (as -1 if it is not reported).
+    if total == None:
+      total = _completeListSize(from_, until, set_, [q, tq])
     if len(ids) == batchSize:
-      rt.text = _buildResumptionToken(ids[last].updateTime, until, prefix,
+      token = _buildResumptionToken(ids[last][0], until, prefix, set_,
         cursor+last+1, total)
-  return _buildResponse(oaiRequest, e)
+    else:
+      token = ""
+    rt = "<resumptionToken cursor=\"%d\"%s>%s" % (cursor,
+      " completeListSize=\"%d\"" % total if total >= 0 else "",
+      util.xmlEscape(token)) + "</resumptionToken>"
+  return _streamResponse(oaiRequest, lxml.etree.Element(_q(oaiRequest[0])),
+    _streamRecords([(deleted, id) for t, deleted, id in ids[:last+1]],
+    prefix, includeMetadata, rt))
+
+def _streamHeader (identifier, datestamp, deleted):
+  return "<header%s><identifier>%s</identifier><datestamp>%s</datestamp>" %\
+    (" status=\"deleted\"" if deleted else "",
+    util.xmlEscape(identifier.identifier),
+    util.formatTimestampZulu(datestamp)) +\
+    "".join("<setSpec>%s</setSpec>" % util.xmlEscape(spec)\
+    for spec in _memberSets(identifier)) + "</header>"
+
+def _streamRecords (ids, prefix, includeMetadata, resumptionToken):
+  # Generates the serialized contents of a ListIdentifiers or
+  # ListRecords response: the headers or records of the identifiers
+  # and tombstones identified by the given (deleted, row ID) tuples,
+  # in order, followed by the serialized resumption token, if not
+  # None.  Rows are retrieved in chunks.  An identifier that has been
+  # deleted or has ceased to be OAI-visible in the interim is silently
+  # skipped.  As the response status has already been sent, an
+  # identifier whose metadata can't be converted is logged and
+  # skipped rather than being allowed to truncate the response.
+  for j in range(0, len(ids), _chunkSize):
+    chunk = ids[j:j+_chunkSize]
+    # Citation metadata is needed only if record metadata must be
+    # computed on the fly, i.e., if the precomputed copy is empty (see
+    # the ezidpopulateoairecords management command); such rows are
+    # retrieved separately so that the metadata isn't fetched by a
+    # deferred-field query per row.
+    qs = ezidapp.models.SearchIdentifier.objects\
+      .filter(id__in=[id for deleted, id in chunk if not deleted],
+      oaiVisible=True).select_related("profile", "ownergroup__realm")\
+      .defer("keywords", *[f for p, f in _recordFields.items()\
+      if not includeMetadata or p != prefix])
+    if includeMetadata:
+      field = _recordFields[prefix]
+      qs = list(qs.exclude(**{ field: "" }).defer("cm")) +\
+        list(qs.filter(**{ field: "" }))
+    else:
+      qs = qs.defer("cm")
+    d = dict(((False, i.id), i) for i in qs)
+    d.update(((True, i.id), i) for i in ezidapp.models\
+      .SearchIdentifierTombstone.objects\
+      .filter(id__in=[id for deleted, id in chunk if deleted])\
+      .select_related("ownergroup__realm"))
+    l = []
+    for k in chunk:
+      if k not in d: continue
+      if k[0]:
+        h = _streamHeader(d[k], d[k].deleteTime, True)
+        l.append("<record>%s</record>" % h if includeMetadata else h)
+      else:
+        h = _streamHeader(d[k], d[k].updateTime, False)
+        if includeMetadata:
+          try:
+            me = _metadata(d[k], prefix)
+          except Exception, e:
+            log.otherError("oai._streamRecords", e)
+            continue
+          l.append("<record>%s<metadata>%s</metadata></record>" % (h, me))
+        else:
+          l.append(h)
+    yield "".join(l).encode("UTF-8")
+  if resumptionToken != None: yield resumptionToken
 
 def _doListMetadataFormats (oaiRequest):
   e = lxml.etree.Element(_q("ListMetadataFormats"))
@@ -339,8 +624,21 @@ def _doListMetadataFormats (oaiRequest):
 def _doListSets (oaiRequest):
   if "resumptionToken" in oaiRequest[1]:
     return _error(oaiRequest, "badResumptionToken")
-  else:
-    return _error(oaiRequest, "noSetHierarchy")
+  sets = []
+  for g in ezidapp.models.SearchGroup.objects.all():
+    sets.append(("group:" + g.groupname, "Group " + g.groupname))
+  for r in ezidapp.models.SearchRealm.objects.all():
+    sets.append(("realm:" + _mangle(r.name), "Realm " + r.name))
+  for s in ezidapp.models.getAllShoulders():
+    if not s.isTest:
+      spec = _shoulderSetSpec(s.prefix)
+      if spec != None: sets.append((spec, s.name))
+  e = lxml.etree.Element(_q("ListSets"))
+  for spec, name in sorted(set(sets)):
+    se = lxml.etree.SubElement(e, _q("set"))
+    lxml.etree.SubElement(se, _q("setSpec")).text = spec
+    lxml.etree.SubElement(se, _q("setName")).text = name
+  return _buildResponse(oaiRequest, e)
 
 def dispatch (request):
   """
@@ -370,7 +668,11 @@ def dispatch (request):
       r = _doListSets(oaiRequest)
     else:
       assert False, "unhandled case"
-  response = django.http.HttpResponse(r,
-    content_type="text/xml; charset=UTF-8")
-  response["Content-Length"] = len(r)
+  if type(r) is str:
+    response = django.http.HttpResponse(r,
+      content_type="text/xml; charset=UTF-8")
+    response["Content-Length"] = len(r)
+  else:
+    response = django.http.StreamingHttpResponse(r,
+      content_type="text/xml; charset=UTF-8")
   return response
@@ -14,6 +14,7 @@
 #
 # -----------------------------------------------------------------------------
 
+import collections
 import django.db
 import django.db.transaction
 import httplib
@@ -24,6 +25,7 @@ import urllib2
 
 import ezidapp.models
 import log
+import notification
 import util
 
 class _StateHolder (object):
@@ -49,12 +51,18 @@ class _StateHolder (object):
     self.enabledFlagHolder = enabledFlagHolder
     self.threadNameHolder = threadNameHolder
     # State variables.  'loadedRows' is an in-memory cache of (a
-    # portion of) the queue table; permanent errors and duplicate
-    # identifiers have been removed.  Rows being actively processed by
-    # a worker thread have a 'beingProcessed' attribute added.
+    # portion of) the queue table; permanent errors have been removed
+    # and redundant rows coalesced, so no identifier appears twice.
+    # Rows being actively processed by a worker thread have a
+    # 'beingProcessed' attribute added.
     self.loadedRows = []
     self.lock = threading.Lock()
 
+# The maximum number of rows deleted per database statement when
+# coalescing the queue.
+
+_deleteBatchSize = 500
+
 class _AbortException (Exception):
   pass
 
@@ -118,20 +126,60 @@ def _nextUnprocessedLoadedRows (sh):
           rows.append(r)
   return rows
 
+def _coalesce (rows):
+  # Given the pending rows for an identifier in queue order, returns a
+  # tuple (row, redundantRows, modified): the single row that
+  # accomplishes the same as the entire sequence (or None if nothing
+  # need be done), the rows that can be deleted, and a flag indicating
+  # if the returned row was modified and must be saved.  Only the last
+  # row matters, as it carries the identifier's current metadata, with
+  # two exceptions.  If the identifier has not yet been created at the
+  # registrar, the last row must be a creation.  And if the identifier
+  # has not yet been created and is subsequently deleted, nothing need
+  # be done... though only if creation has not been attempted, as a
+  # failed attempt may have had partial effect.
+  latest = rows[-1]
+  if len(rows) == 1: return (latest, [], False)
+  Q = ezidapp.models.RegistrationQueue
+  if rows[0].operation == Q.CREATE:
+    if latest.operation == Q.DELETE:
+      if rows[0].error == "": return (None, rows, False)
+    elif latest.operation == Q.UPDATE:
+      latest.operation = Q.CREATE
+      return (latest, rows[:-1], True)
+  return (latest, rows[:-1], False)
+
 def _loadRows (sh, limit=1000):
-  qs = _queue(sh).objects.all().order_by("seq")[:limit]
-  seen = set()
+  # Redundant rows, i.e., all but the last row for each identifier in
+  # the load window, are deleted before any rows are handed to the
+  # worker threads.  Identifiers whose first row has encountered a
+  # permanent error are left alone entirely.
+  qs = list(_queue(sh).objects.all().order_by("seq")[:limit])
+  identifierRows = collections.OrderedDict()
+  for r in qs: identifierRows.setdefault(r.identifier, []).append(r)
   rows = []
-  for r in qs:
-    if r.identifier not in seen:
-      if not r.errorIsPermanent: rows.append(r)
-      seen.add(r.identifier)
+  redundant = []
+  modified = []
+  for l in identifierRows.values():
+    if l[0].errorIsPermanent: continue
+    r, rr, m = _coalesce(l)
+    if r != None: rows.append(r)
+    redundant.extend(rr)
+    if m: modified.append(r)
+  if len(redundant) > 0:
+    _checkAbort(sh)
+    with django.db.transaction.atomic():
+      for r in modified: r.save()
+      seqs = [r.seq for r in redundant]
+      for i in range(0, len(seqs), _deleteBatchSize):
+        _queue(sh).objects.filter(seq__in=seqs[i:i+_deleteBatchSize]).delete()
   if len(rows) == 0 and len(qs) == limit:
     # Incredibly unlikely, but just in case: if our query returned a
     # full set of rows but we ended up selecting none (because they
-    # all had permanent errors or are duplicates), try increasing the
-    # limit.  In the limiting case, the entire table will be returned.
-    return _loadRows(sh, limit*2)
+    # all had permanent errors or were redundant), try again,
+    # increasing the limit if no rows were removed.  In the limiting
+    # case, the entire table will be returned.
+    return _loadRows(sh, limit if len(redundant) > 0 else limit*2)
   n = len(rows)
   _setLoadedRows(sh, rows)
   return n
@@ -140,20 +188,39 @@ def _sleep (sh, duration=None):
   django.db.connections["default"].close()
   time.sleep(duration or sh.idleSleep)
 
+def _wait (sh, listener):
+  # Waits for a notification, but no longer than the idle sleep.  The
+  # database connection is closed only if we've been idle.
+  if not listener.wait(sh.idleSleep):
+    django.db.connections["default"].close()
+
+# The daemon thread waits on the queue's channel for identifiers to be
+# enqueued.  Having loaded rows, it signals the worker threads on the
+# local "rows" channel; worker threads signal the daemon on the local
+# "done" channel as they finish processing rows.
+
+def _channel (sh, name=None):
+  return sh.queueModel.__name__ + (("-" + name) if name else "")
+
 def _daemonThread (sh):
+  queueListener = notification.Listener(_channel(sh))
+  doneListener = notification.Listener(_channel(sh, "done"), local=True)
   _sleep(sh)
   while True:
     try:
       while True:
         n = _loadRows(sh)
         if n > 0: break
-        _sleep(sh)
-      while _loadedRowsLength(sh) > 0: _sleep(sh)
+        _wait(sh, queueListener)
+      notification.signalNow(_channel(sh, "rows"), local=True)
+      while _loadedRowsLength(sh) > 0: _wait(sh, doneListener)
     except _AbortException:
       break
     except Exception, e:
       log.otherError("register_async._daemonThread/" + sh.registrar, e)
       _sleep(sh)
+  queueListener.close()
+  doneListener.close()
 
 def callWrapper (sh, rows, methodName, function, *args):
   """
@@ -186,12 +253,13 @@ def _workerThread (sh):
   # chance to load the row cache and to prevent the workers from
   # running synchronously.
   time.sleep(sh.idleSleep*(random.random()+1))
+  listener = notification.Listener(_channel(sh, "rows"), local=True)
   while True:
     try:
       while True:
         rows = _nextUnprocessedLoadedRows(sh)
         if len(rows) > 0: break
-        _sleep(sh)
+        _wait(sh, listener)
       try:
         if len(rows) == 1:
           f = sh.functions["single"][rows[0].operation]
@@ -225,11 +293,13 @@ def _workerThread (sh):
             r.seq = t
       finally:
         _deleteLoadedRows(sh, rows)
+        notification.signalNow(_channel(sh, "done"), local=True)
     except _AbortException:
       break
     except Exception, e:
       log.otherError("register_async._workerThread/" + sh.registrar, e)
       _sleep(sh)
+  listener.close()
 
 def enqueueIdentifier (model, identifier, operation, blob):
   """
@@ -243,6 +313,21 @@ def enqueueIdentifier (model, identifier, operation, blob):
   e = model(enqueueTime=int(time.time()), identifier=identifier, metadata=blob,
     operation=ezidapp.models.RegistrationQueue.operationLabelToCode(operation))
   e.save()
+  notification.signal(model.__name__)
+
+def enqueueIdentifiers (model, entries):
+  """
+  Adds multiple identifiers to the asynchronous registration queue
+  named by 'model' using multi-row inserts.  'entries' should be a
+  list of (identifier, operation, blob) tuples as in
+  enqueueIdentifier; identifiers are enqueued in list order.
+  """
+  t = int(time.time())
+  model.objects.bulk_create([model(enqueueTime=t, identifier=identifier,
+    metadata=blob,
+    operation=ezidapp.models.RegistrationQueue.operationLabelToCode(operation))\
+    for identifier, operation, blob in entries], batch_size=100)
+  notification.signal(model.__name__)
 
 def launch (registrar, queueModel, createFunction, updateFunction,
   deleteFunction, batchCreateFunction, batchUpdateFunction,
@@ -0,0 +1,167 @@
+# =============================================================================
+#
+# EZID :: search_backend.py
+#
+# Fulltext search backends.  The search database's fulltext columns
+# (resourceCreator, resourceTitle, resourcePublisher, and keywords)
+# are searched by one of the following backends, as selected by the
+# 'search.backend' configuration option:
+#
+#   mysql
+#     MySQL FULLTEXT indexes (see .../etc/search-mysql-addendum.sql).
+#
+#   sqlite
+#     An SQLite FTS table (see ezidapp/models/search_identifier.py),
+#     which is maintained incrementally as identifiers are written to
+#     the search database by backproc.py.
+#
+#   basic
+#     Substring matching.  This requires no index, but entails a scan
+#     of all identifiers in a query's scope; it is suitable for small
+#     databases only.
+#
+# If the option is "auto", the mysql backend is used if the search
+# database is MySQL and the "fulltextSearchSupported" database setting
+# is True; the sqlite backend is used if the search database is SQLite
+# and has an FTS table; and otherwise the basic backend is used.
+#
+# All backends interpret a constraint the same way (see
+# fulltext_parser.py): terms (words and quoted phrases) are required,
+# but terms separated by "OR" are optional.  A match must contain all
+# required terms or, if there are no required terms, any of the
+# optional terms.  (Under MySQL, optional terms additionally affect
+# relevance, which we don't use.)
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.conf
+import django.db
+import django.db.models
+import django.db.models.expressions
+import operator
+import threading
+
+import config
+import ezidapp.models.search_identifier
+import fulltext_parser
+
+_lock = threading.Lock()
+_backendOption = None
+_backend = None
+_parser = None
+
+def _loadConfig ():
+  global _backendOption, _backend, _parser
+  _lock.acquire()
+  try:
+    _backendOption = config.get("search.backend")
+    assert _backendOption in ["auto", "mysql", "sqlite", "basic"],\
+      "invalid search backend: " + _backendOption
+    # Backend selection may require a database query, and hence is
+    # deferred until first use.
+    _backend = None
+    _parser = fulltext_parser.Parser(
+      int(config.get("search.minimum_word_length")),
+      (config.get("search.stopwords") + " " +\
+      config.get("search.extra_stopwords")).split())
+  finally:
+    _lock.release()
+
+_loadConfig()
+config.registerReloadListener(_loadConfig)
+
+def _parseFulltextConstraint (constraint):
+  # See fulltext_parser.py.
+  return _parser.parse(constraint)
+
+def _mysqlFilter (column, constraint):
+  words = _parseFulltextConstraint(constraint)
+  if len(words) > 0:
+    q = " ".join("%s%s" % ("+" if w[0] else "", w[1]) for w in words)
+  else:
+    # If a constraint has no search terms (e.g., consists of all
+    # stopwords), MySQL returns zero results.  To mimic this behavior
+    # we return an arbitrary constraint having the same behavior.
+    q = "+x"
+  return django.db.models.Q(**{ (column + "__search"): q })
+
+def _ftsQuery (words):
+  # Returns an FTS query string (valid under both FTS4 and FTS5), or
+  # None if there are no terms.  Every term is quoted so that words
+  # such as "NEAR" are not interpreted as operators.
+  required = []
+  optional = []
+  for r, w in words:
+    w = w.strip('"')
+    if w == "": continue
+    (required if r else optional).append('"%s"' % w)
+  if len(required) > 0:
+    return " ".join(required)
+  elif len(optional) > 0:
+    return " OR ".join(optional)
+  else:
+    return None
+
+def _sqliteFilter (column, constraint):
+  q = _ftsQuery(_parseFulltextConstraint(constraint))
+  if q == None: return django.db.models.Q(pk__in=[])
+  return django.db.models.Q(pk__in=django.db.models.expressions.RawSQL(
+    "SELECT rowid FROM %s WHERE %s MATCH %%s" %\
+    (ezidapp.models.search_identifier.fulltextTable, column), [q]))
+
+def _basicFilter (column, constraint):
+  required = []
+  optional = []
+  for r, w in _parseFulltextConstraint(constraint):
+    w = w.strip('"')
+    if w == "": continue
+    (required if r else optional).append(
+      django.db.models.Q(**{ (column + "__icontains"): w }))
+  if len(required) > 0:
+    return reduce(operator.and_, required)
+  elif len(optional) > 0:
+    return reduce(operator.or_, optional)
+  else:
+    return django.db.models.Q(pk__in=[])
+
+_backends = { "mysql": _mysqlFilter, "sqlite": _sqliteFilter,
+  "basic": _basicFilter }
+
+def _selectBackend ():
+  if _backendOption != "auto": return _backendOption
+  vendor = django.db.connections["search"].vendor
+  if vendor == "mysql" and\
+    django.conf.settings.DATABASES["search"].get("fulltextSearchSupported"):
+    return "mysql"
+  elif vendor == "sqlite" and\
+    ezidapp.models.search_identifier.hasFulltextTable():
+    return "sqlite"
+  else:
+    return "basic"
+
+def getBackend ():
+  """
+  Returns the name of the backend in use.
+  """
+  global _backend
+  _lock.acquire()
+  try:
+    if _backend == None: _backend = _selectBackend()
+    return _backend
+  finally:
+    _lock.release()
+
+def fulltextFilter (column, constraint):
+  """
+  Returns a Q object that restricts SearchIdentifier objects to those
+  whose fulltext column 'column' (e.g., "resourceTitle") satisfies a
+  constraint such as '"green eggs" OR ham'.
+  """
+  return _backends[getBackend()](column, constraint)
@@ -13,10 +13,14 @@
 #
 # -----------------------------------------------------------------------------
 
+import base64
+import collections
 import django.conf
 import django.db
 import django.db.models
 import django.db.utils
+import hashlib
+import json
 import operator
 import re
 import threading
@@ -26,29 +30,54 @@ import uuid
 
 import config
 import ezidapp.models
+import ezidapp.models.search_identifier
 import log
+import search_backend
 import util
 
 _lock = threading.Lock()
 _reconnectDelay = None
-_fulltextSupported = None
-_minimumWordLength = None
-_stopwords = None
 _maxTargetLength = None
+_maxTargetPathLength = None
 _numActiveSearches = 0
+_resultCacheSize = None
+_resultCacheTtl = None
+_resultCache = collections.OrderedDict()
+_countEstimateThreshold = None
+_countSampleSize = None
+_maxSearchesPerUser = None
+_maxAnonymousSearches = None
+_searchTimeout = None
+_busyRetryAfter = None
+_streamChunkSize = None
 
 def _loadConfig ():
-  global _reconnectDelay, _fulltextSupported, _minimumWordLength
-  global _stopwords, _maxTargetLength
+  global _reconnectDelay, _maxTargetLength, _maxTargetPathLength
+  global _resultCacheSize, _resultCacheTtl
+  global _countEstimateThreshold, _countSampleSize, _maxSearchesPerUser
+  global _maxAnonymousSearches, _searchTimeout, _busyRetryAfter
+  global _streamChunkSize
   _reconnectDelay = int(config.get("databases.reconnect_delay"))
-  _fulltextSupported =\
-    django.conf.settings.DATABASES["search"]["fulltextSearchSupported"]
-  if _fulltextSupported:
-    _minimumWordLength = int(config.get("search.minimum_word_length"))
-    _stopwords = (config.get("search.stopwords") + " " +\
-      config.get("search.extra_stopwords")).split()
   _maxTargetLength = ezidapp.models.SearchIdentifier._meta.\
     get_field("searchableTarget").max_length
+  _maxTargetPathLength = ezidapp.models.SearchIdentifier._meta.\
+    get_field("targetPath").max_length
+  _countEstimateThreshold = int(config.get("search.count_estimate_threshold"))
+  _countSampleSize = int(config.get("search.count_sample_size"))
+  _maxSearchesPerUser =\
+    int(config.get("search.max_concurrent_searches_per_user"))
+  _maxAnonymousSearches =\
+    int(config.get("search.max_concurrent_anonymous_searches"))
+  _searchTimeout = int(config.get("search.timeout"))
+  _busyRetryAfter = int(config.get("search.busy_retry_after"))
+  _streamChunkSize = int(config.get("search.stream_chunk_size"))
+  _lock.acquire()
+  try:
+    _resultCacheSize = int(config.get("search.result_cache_size"))
+    _resultCacheTtl = int(config.get("search.result_cache_ttl"))
+    _resultCache.clear()
+  finally:
+    _lock.release()
 
 _loadConfig()
 config.registerReloadListener(_loadConfig)
@@ -101,82 +130,51 @@ def ping ():
 _fulltextFields = ["resourceCreator", "resourceTitle", "resourcePublisher",
   "keywords"]
 
-def _processFulltextConstraint (constraint):
-  # The primary purposes of this function are 1) to remove characters
-  # that might be interpreted by MySQL as operators and 2) to change
-  # the default semantics of MySQL's freetext search from OR to AND.
-  # The latter is accomplished by making every search term required,
-  # so that a constraint "foo bar" is transformed into "+foo +bar".
-  # Quoted phrases are treated like atomic terms and are left as is.
-  # Additionally, this function implements an explicit OR operator.
-  # An "OR" placed between two terms has the effect of making those
-  # terms optional.  Thus, "foo bar OR baz" becomes "+foo bar baz".
-  # Finally, stopwords are removed.
-  #
-  # Step 1: Parse the constraint into words and quoted phrases.  MySQL
-  # interprets some characters as operators, and will return an error
-  # if a query is malformed according to its less-than-well-defined
-  # rules.  For safety we remove all operators that are outside double
-  # quotes (i.e., quotes are the only MySQL operator we retain).
-  inQuote = False
-  inWord = False
-  words = []
-  for c in constraint:
-    if c == '"':
-      if inQuote:
-        words[-1].append(c)
-        inQuote = False
-      else:
-        words.append([])
-        words[-1].append(c)
-        inQuote = True
-        inWord = False
-    elif c.isalnum():
-      if inQuote or inWord:
-        words[-1].append(c)
-      else:
-        words.append([])
-        words[-1].append(c)
-        inWord = True
-    else:
-      if inQuote:
-        words[-1].append(c)
-      else:
-        inWord = False
-  if inQuote: words[-1].append('"')
-  # Step 2.  OR processing.  All OR terms are ultimately discarded.
-  words = [[True, "".join(w)] for w in words]
-  i = 0
-  while i < len(words):
-    if words[i][1].upper() == "OR":
-      if i > 0 and i < len(words)-1:
-        words[i-1][0] = False
-        words[i+1][0] = False
-      del words[i]
-    else:
-      i += 1
-  # Step 3.  Remove all stopwords.  We can't leave MySQL's default
-  # stopwords in because a plus sign in front of a stopword will cause
-  # zero results to be returned.  Also, we need to remove our own
-  # stopwords anyway.
-  i = 0
-  while i < len(words):
-    if not words[i][1].startswith('"') and\
-      (len(words[i][1]) < _minimumWordLength or (words[i][1]).lower() in _stopwords):
-      del words[i]
-    else:
-      i += 1
-  if len(words) > 0:
-    return " ".join("%s%s" % ("+" if w[0] else "", w[1]) for w in words)
+defaultSelectRelated = ["owner", "ownergroup"]
+defaultDefer = ["cm", "keywords", "target", "searchableTarget", "targetHost",
+  "targetReversedHost", "targetPath", "resourceCreatorPrefix",
+  "resourceTitlePrefix", "resourcePublisherPrefix", "oaiDublinCoreRecord",
+  "oaiDataciteRecord"]
+
+def _orderingColumn (orderBy):
+  # Maps a search column, optionally prefixed with a minus sign, to a
+  # tuple (descending, SearchIdentifier field path).
+  descending = orderBy.startswith("-")
+  if descending: orderBy = orderBy[1:]
+  if orderBy in ["identifier", "createTime", "updateTime", "status",
+    "exported", "isTest", "hasMetadata", "publicSearchVisible",
+    "linkIsBroken", "hasIssues"]:
+    return (descending, orderBy)
+  elif orderBy == "identifierType":
+    return (descending, "identifier")
+  elif orderBy == "owner":
+    return (descending, "owner__username")
+  elif orderBy == "ownergroup":
+    return (descending, "ownergroup__groupname")
+  elif orderBy == "profile":
+    return (descending, "profile__label")
+  elif orderBy == "resourceCreator":
+    return (descending, "resourceCreatorPrefix")
+  elif orderBy == "resourceTitle":
+    return (descending, "resourceTitlePrefix")
+  elif orderBy == "resourcePublisher":
+    return (descending, "resourcePublisherPrefix")
+  elif orderBy == "resourcePublicationYear":
+    return (descending, "searchablePublicationYear")
+  elif orderBy == "resourceType":
+    return (descending, "searchableResourceType")
   else:
-    # If a constraint has no search terms (e.g., consists of all
-    # stopwords), MySQL returns zero results.  To mimic this behavior
-    # we return an arbitrary constraint having the same behavior.
-    return "+x"
+    assert False, "column does not support ordering"
 
-defaultSelectRelated = ["owner", "ownergroup"]
-defaultDefer = ["cm", "keywords", "target", "searchableTarget",
-  "resourceCreatorPrefix", "resourceTitlePrefix", "resourcePublisherPrefix"]
+def isValidOrdering (orderBy):
+  """
+  Returns True if 'orderBy' names a search column, optionally
+  prefixed with a minus sign, by which results may be ordered.
+  """
+  try:
+    return _orderingColumn(orderBy) != None
+  except AssertionError:
+    return False
 
 def formulateQuery (constraints, orderBy=None,
   selectRelated=defaultSelectRelated, defer=defaultDefer):
@@ -219,6 +217,14 @@ def formulateQuery (constraints, orderBy=None,
                       |   |   |            | registered with Crossref
   crossrefStatus      | Y |   | str        | Crossref status code
   target              |   |   | str        | URL
+  targetHost          |   |   | str        | host name, e.g.,
+                      |   |   |            | "example.org"; matches
+                      |   |   |            | target URLs at the host or
+                      |   |   |            | any subdomain thereof
+  targetPrefix        |   |   | str        | URL; matches target URLs at
+                      |   |   |            | the same host whose path
+                      |   |   |            | begins with the URL's path,
+                      |   |   |            | regardless of scheme
   profile             | Y | Y | str        | profile label, e.g., "erc"
   isTest              |   | Y | bool       |
   resourceCreator     |   | Y | str        | limited fulltext-style boolean
@@ -325,20 +331,30 @@ def formulateQuery (constraints, orderBy=None,
         if len(v) > _maxTargetLength: q &= django.db.models.Q(target=v)
         qlist.append(q)
       filters.append(reduce(operator.or_, qlist))
+    elif column == "targetHost":
+      rhost = ".".join(reversed(value.strip().lower().strip(".").split(".")))\
+        + "."
+      filters.append(django.db.models.Q(targetReversedHost__startswith=rhost))
+    elif column == "targetPrefix":
+      # The scheme is optional.
+      if "//" not in value: value = "//" + value
+      host, rhost, path = ezidapp.models.search_identifier.normalizeTarget(
+        value)
+      u = urlparse.urlsplit(value)
+      if u.path == "" and u.query == "": path = ""
+      q = django.db.models.Q(targetReversedHost=rhost,
+        targetPath__startswith=path)
+      if len(path) == _maxTargetPathLength:
+        # The path is too long to have been stored in full.
+        q &= django.db.models.Q(target__contains=(u.path +\
+          ("?" + u.query if u.query != "" else "")))
+      filters.append(q)
     elif column == "profile":
       if isinstance(value, basestring): value = [value]
       filters.append(reduce(operator.or_,
         [django.db.models.Q(profile__label=v) for v in value]))
     elif column in _fulltextFields:
-      if _fulltextSupported:
-        filters.append(django.db.models.Q(**{ (column + "__search"):\
-          _processFulltextConstraint(value) }))
-      else:
-        value = value.split()
-        if len(value) > 0:
-          filters.append(reduce(operator.and_,
-            [django.db.models.Q(**{ (column + "__icontains"): v })\
-            for v in value]))
+      filters.append(search_backend.fulltextFilter(column, value))
     elif column == "resourcePublicationYear":
       if value[0] != None:
         if value[1] != None:
@@ -367,44 +383,152 @@ def formulateQuery (constraints, orderBy=None,
   if len(selectRelated) > 0: qs = qs.select_related(*selectRelated)
   if len(defer) > 0: qs = qs.defer(*defer)
   if orderBy != None:
-    prefix = ""
-    if orderBy.startswith("-"):
-      prefix = "-"
-      orderBy = orderBy[1:]
-    if orderBy in ["identifier", "createTime", "updateTime", "status",
-      "exported", "isTest", "hasMetadata", "publicSearchVisible",
-      "linkIsBroken", "hasIssues"]:
-      pass
-    elif orderBy == "identifierType":
-      orderBy = "identifier"
-    elif orderBy == "owner":
-      orderBy = "owner__username"
-    elif orderBy == "ownergroup":
-      orderBy = "ownergroup__groupname"
-    elif orderBy == "profile":
-      orderBy = "profile__label"
-    elif orderBy == "resourceCreator":
-      orderBy = "resourceCreatorPrefix"
-    elif orderBy == "resourceTitle":
-      orderBy = "resourceTitlePrefix"
-    elif orderBy == "resourcePublisher":
-      orderBy = "resourcePublisherPrefix"
-    elif orderBy == "resourcePublicationYear":
-      orderBy = "searchablePublicationYear"
-    elif orderBy == "resourceType":
-      orderBy = "searchableResourceType"
+    descending, column = _orderingColumn(orderBy)
+    prefix = "-" if descending else ""
+    # Ties are broken by row ID so that the ordering is total, as
+    # required by keyset pagination (see executeSearchPage below).
+    # (The row ID, unlike the identifier, is implicitly part of every
+    # InnoDB secondary index, and hence breaking ties by it doesn't
+    # preclude using an index for ordering.)
+    if column == "identifier":
+      qs = qs.order_by(prefix + column)
     else:
-      assert False, "column does not support ordering"
-    qs = qs.order_by(prefix + orderBy)
+      qs = qs.order_by(prefix + column, prefix + "id")
   return qs
 
-def _modifyActiveCount (delta):
+class SearchLimitException (Exception):
+  """
+  Raised when a search is refused because the requestor has too many
+  searches in progress, or is cancelled because it exceeded the
+  search time limit.  'retryAfter' is the number of seconds after
+  which the search may be retried.
+  """
+  def __init__ (self, message, retryAfter):
+    Exception.__init__(self, message)
+    self.retryAfter = retryAfter
+
+# Searches in progress are counted per user; anonymous users are
+# counted collectively.  A thread's nested searches (e.g., a search
+# retried with modified constraints) are counted once.  Streamed
+# searches (see executeSearchStream below) may outlive the request
+# that created them and may be resumed or closed by another thread,
+# so they take a search slot of their own rather than participating
+# in the thread's nesting.
+
+_activeSearchesByUser = {}
+_threadState = threading.local()
+
+def _acquireSearchSlot (user):
+  # Counts a search against the requestor's limit, raising
+  # SearchLimitException if the limit has been reached.  Returns the
+  # key to pass to _releaseSearchSlot.
   global _numActiveSearches
+  if user == ezidapp.models.AnonymousUser:
+    username, limit = (None, _maxAnonymousSearches)
+  else:
+    username, limit = (user.username, _maxSearchesPerUser)
   _lock.acquire()
   try:
-    _numActiveSearches += delta
+    n = _activeSearchesByUser.get(username, 0)
+    if n >= limit:
+      raise SearchLimitException("too many concurrent searches",
+        _busyRetryAfter)
+    _activeSearchesByUser[username] = n+1
+    _numActiveSearches += 1
   finally:
     _lock.release()
+  return username
+
+def _releaseSearchSlot (username):
+  global _numActiveSearches
+  _lock.acquire()
+  try:
+    n = _activeSearchesByUser[username]
+    if n > 1:
+      _activeSearchesByUser[username] = n-1
+    else:
+      del _activeSearchesByUser[username]
+    _numActiveSearches -= 1
+  finally:
+    _lock.release()
+
+def _beginSearch (user):
+  depth = getattr(_threadState, "depth", 0)
+  if depth == 0: _threadState.username = _acquireSearchSlot(user)
+  _threadState.depth = depth+1
+
+def _endSearch ():
+  _threadState.depth -= 1
+  if _threadState.depth == 0: _releaseSearchSlot(_threadState.username)
+
+# MySQL (5.7.8 and later) and MariaDB name their statement time
+# limits differently; the variable in effect is determined on first
+# use.  The values are (variable name, units per second, timeout error
+# code).
+
+_mysqlTimeoutVariables = [("max_execution_time", 1000, 3024),
+  ("max_statement_time", 1, 1969)]
+_mysqlTimeoutVariable = None
+
+def _setMysqlTimeout (cursor, timeout):
+  # Sets the connection's statement time limit (0 meaning none).
+  # Returns the applicable timeout error code, or None if time limits
+  # are not supported.
+  global _mysqlTimeoutVariable
+  if _mysqlTimeoutVariable == None:
+    for v in _mysqlTimeoutVariables:
+      try:
+        cursor.execute("SET SESSION %s = %d" % (v[0], timeout*v[1]))
+        _mysqlTimeoutVariable = v
+        return v[2]
+      except django.db.DatabaseError:
+        pass
+    _mysqlTimeoutVariable = ()
+    return None
+  elif _mysqlTimeoutVariable == ():
+    return None
+  else:
+    v = _mysqlTimeoutVariable
+    cursor.execute("SET SESSION %s = %d" % (v[0], timeout*v[1]))
+    return v[2]
+
+def _withTimeout (function):
+  # Calls 'function', which should perform search database queries,
+  # and returns the result.  If the queries exceed the search time
+  # limit they are cancelled and SearchLimitException is raised.
+  # Under MySQL, the statement time limit is set for the duration of
+  # the call; under SQLite, the connection is interrupted by a timer.
+  if _searchTimeout <= 0: return function()
+  connection = django.db.connections["search"]
+  if connection.vendor == "mysql":
+    cursor = connection.cursor()
+    errorCode = _setMysqlTimeout(cursor, _searchTimeout)
+    try:
+      return function()
+    except django.db.DatabaseError, e:
+      if errorCode != None and len(e.args) > 0 and e.args[0] == errorCode:
+        raise SearchLimitException("search timed out", _busyRetryAfter)
+      raise
+    finally:
+      if errorCode != None: _setMysqlTimeout(cursor, 0)
+  elif connection.vendor == "sqlite":
+    connection.ensure_connection()
+    interrupted = []
+    def interrupt ():
+      interrupted.append(True)
+      connection.connection.interrupt()
+    t = threading.Timer(_searchTimeout, interrupt)
+    t.start()
+    try:
+      return function()
+    except django.db.OperationalError:
+      if len(interrupted) > 0:
+        raise SearchLimitException("search timed out", _busyRetryAfter)
+      raise
+    finally:
+      t.cancel()
+  else:
+    return function()
 
 def numActiveSearches ():
   """
@@ -416,26 +540,161 @@ def numActiveSearches ():
   finally:
     _lock.release()
 
+# The result cache maps search keys (see _cacheKey below) to (result,
+# scopes, expiration time) tuples, least recently used first.  A
+# result's scopes identify the identifiers that can possibly appear in
+# it: ("owner", username), ("ownergroup", groupname), and, for
+# searches over publicly visible identifiers, ("public",).  A search
+# constrained in none of these ways lies in the global scope,
+# ("all",).  When identifiers are written to the search database,
+# results in the affected scopes, and all results in the global
+# scope, are invalidated (see invalidateResultCache below).
+# The cache is per-process, and identifiers that change ownership are
+# not removed from results cached for their former owners, so results
+# may be stale by up to the TTL.
+
+def _normalizeConstraintValue (value):
+  if isinstance(value, list):
+    return tuple(sorted(value))
+  else:
+    return value
+
+def _cacheKey (kind, constraints, orderBy, from_, to, selectRelated, defer):
+  return (kind, tuple(sorted((k, _normalizeConstraintValue(v))\
+    for k, v in constraints.items())), orderBy, from_, to,
+    tuple(selectRelated), tuple(defer))
+
+def _cacheScopes (constraints):
+  # Returns the scopes of a search.  A search constrained to an owner
+  # and to publicly visible identifiers lies in both scopes; this is
+  # conservative, but harmless.
+  scopes = set()
+  for column in ["owner", "ownergroup"]:
+    if column in constraints:
+      v = constraints[column]
+      if isinstance(v, basestring): v = [v]
+      scopes.update((column, n) for n in v)
+  if constraints.get("publicSearchVisible") == True: scopes.add(("public",))
+  if len(scopes) == 0: scopes.add(("all",))
+  return scopes
+
+def _cacheGet (key):
+  # Returns the cached result for a key, or None.
+  _lock.acquire()
+  try:
+    v = _resultCache.get(key)
+    if v == None: return None
+    if v[2] <= time.time():
+      del _resultCache[key]
+      return None
+    # Move the entry to the most recently used end.
+    del _resultCache[key]
+    _resultCache[key] = v
+    return v[0]
+  finally:
+    _lock.release()
+
+def _cachePut (key, result, constraints):
+  if _resultCacheSize <= 0: return
+  scopes = _cacheScopes(constraints)
+  _lock.acquire()
+  try:
+    _resultCache.pop(key, None)
+    _resultCache[key] = (result, scopes, time.time()+_resultCacheTtl)
+    while len(_resultCache) > _resultCacheSize:
+      _resultCache.popitem(last=False)
+  finally:
+    _lock.release()
+
+def invalidateResultCache (usernames=[], groupnames=[], public=False):
+  """
+  Removes cached search results that may include identifiers owned by
+  any of the users in 'usernames' or by any of the groups in
+  'groupnames'.  If 'public' is True, cached results of searches over
+  publicly visible identifiers are removed as well.  This function
+  should be called after identifiers have been written to the search
+  database.  Cached results of unscoped searches are removed
+  regardless.
+  """
+  scopes = set(("owner", n) for n in usernames)
+  scopes.update(("ownergroup", n) for n in groupnames)
+  if public: scopes.add(("public",))
+  if len(scopes) == 0: return
+  scopes.add(("all",))
+  _lock.acquire()
+  try:
+    for key in [k for k, v in _resultCache.items()\
+      if not v[1].isdisjoint(scopes)]:
+      del _resultCache[key]
+  finally:
+    _lock.release()
+
 def _isMysqlFulltextError (exception):
   return isinstance(exception, django.db.utils.InternalError) and\
     exception.args == (188, "FTS query exceeds result cache limit")
 
+# The search columns that correspond to SearchIdentifierSummary class
+# descriptor fields.  A count whose constraints are limited to these
+# columns can be computed from the summary table.
+
+_summaryColumns = ["owner", "ownergroup", "status", "hasIssues",
+  "linkIsBroken", "crossref", "crossrefStatus"]
+
+def _summaryCount (constraints):
+  # Returns the number of results of a query as computed from the
+  # summary table, or None if the query's constraints preclude that.
+  if not all(k in _summaryColumns for k in constraints) or\
+    ("owner" not in constraints and "ownergroup" not in constraints):
+    return None
+  qs = ezidapp.models.SearchIdentifierSummary.objects.all()
+  for column, value in constraints.items():
+    if column in ["hasIssues", "linkIsBroken"]:
+      qs = qs.filter(**{ column: value })
+    elif column == "crossref":
+      if value:
+        qs = qs.exclude(crossrefStatus="")
+      else:
+        qs = qs.filter(crossrefStatus="")
+    else:
+      if isinstance(value, basestring): value = [value]
+      if column == "owner":
+        qs = qs.filter(owner__username__in=value)
+      elif column == "ownergroup":
+        qs = qs.filter(ownergroup__groupname__in=value)
+      elif column == "status":
+        qs = qs.filter(status__in=[ezidapp.models.Identifier.\
+          statusDisplayToCode.get(v, v) for v in value])
+      else:
+        qs = qs.filter(crossrefStatus__in=value)
+  return qs.aggregate(total=django.db.models.Sum("count"))["total"] or 0
+
 def executeSearchCountOnly (user, constraints,
   selectRelated=defaultSelectRelated, defer=defaultDefer):
   """
   Executes a search database query, returning just the number of
   results.  'user' is the requestor, and should be an authenticated
   StoreUser object or AnonymousUser.  'constraints', 'selectRelated',
-  and 'defer' are as in formulateQuery above.
+  and 'defer' are as in formulateQuery above.  If the constraints are
+  limited to owner, ownergroup, status, hasIssues, linkIsBroken,
+  crossref, and crossrefStatus, the count is computed from the
+  identifier summary table; otherwise, it may be served from the
+  result cache.
   """
   tid = uuid.uuid1()
+  _beginSearch(user)
   try:
-    _modifyActiveCount(1)
     qs = formulateQuery(constraints, selectRelated=selectRelated, defer=defer)
     log.begin(tid, "search/count", "-", user.username, user.pid,
       user.group.groupname, user.group.pid, *reduce(operator.__concat__,
       [[k, unicode(v)] for k, v in constraints.items()]))
-    c = qs.count()
+    c = _summaryCount(constraints)
+    if c == None:
+      key = _cacheKey("count", constraints, None, None, None, selectRelated,
+        defer)
+      c = _cacheGet(key)
+      if c == None:
+        c = _withTimeout(qs.count)
+        _cachePut(key, c, constraints)
   except Exception, e:
     # MySQL's FULLTEXT engine chokes on a too-frequently-occurring
     # word (call it a "bad" word) that is not on its own stopword
@@ -460,7 +719,184 @@ def executeSearchCountOnly (user, constraints,
     log.success(tid, str(c))
     return c
   finally:
-    _modifyActiveCount(-1)
+    _endSearch()
+
+# Facets, i.e., the search columns whose values can be tallied by
+# executeSearchFacets, and the corresponding SearchIdentifier fields.
+
+_facetFields = { "status": "status",
+  "resourceType": "searchableResourceType", "profile": "profile__label",
+  "resourcePublicationYear": "searchablePublicationYear",
+  "owner": "owner__username" }
+
+defaultFacets = ["status", "resourceType", "profile",
+  "resourcePublicationYear"]
+
+def _facetValue (facet, value):
+  # Converts a database value to a constraint value.
+  if facet == "status":
+    return dict(ezidapp.models.SearchIdentifier._meta.get_field("status")\
+      .choices).get(value, value)
+  elif facet == "resourceType":
+    for k, v in ezidapp.models.validation.resourceTypes.items():
+      if v == value: return k
+    return value
+  else:
+    return value
+
+def executeSearchFacets (user, constraints, facets=defaultFacets):
+  """
+  Executes a search database query, returning counts of the results by
+  the values of one or more columns.  'facets' should be a list of
+  columns drawn from: status, resourceType, profile,
+  resourcePublicationYear, and owner.  The return is a dictionary
+  mapping each column to a list of (value, count) tuples in
+  descending count order.  Values are expressed as constraint values
+  (see formulateQuery above), e.g., "public" for status and "Image"
+  for resourceType, and can therefore be used to narrow the query;
+  NULL values (e.g., identifiers having no publication year) are not
+  counted.  All facets are computed by a single aggregate query.
+  'user' is the requestor, and should be an authenticated StoreUser
+  object or AnonymousUser.  'constraints' is as in formulateQuery
+  above.  The counts may be served from the result cache.
+  """
+  tid = uuid.uuid1()
+  _beginSearch(user)
+  try:
+    qs = formulateQuery(constraints, selectRelated=[], defer=[])
+    log.begin(tid, "search/facets", "-", user.username, user.pid,
+      user.group.groupname, user.group.pid, ",".join(facets),
+      *reduce(operator.__concat__,
+      [[k, unicode(v)] for k, v in constraints.items()]))
+    key = _cacheKey("facets", constraints, None, None, None, facets, [])
+    r = _cacheGet(key)
+    if r == None:
+      counts = dict((f, {}) for f in facets)
+      for row in _withTimeout(lambda: list(qs.order_by().values(
+        *[_facetFields[f] for f in facets]).annotate(
+        facetCount=django.db.models.Count("id")))):
+        for f in facets:
+          v = row[_facetFields[f]]
+          if v != None:
+            counts[f][v] = counts[f].get(v, 0) + row["facetCount"]
+      r = dict((f, sorted([(_facetValue(f, v), n) for v, n in\
+        counts[f].items()], key=lambda t: (-t[1], t[0]))) for f in facets)
+      _cachePut(key, r, constraints)
+  except Exception, e:
+    # See executeSearchCountOnly above.
+    if _isMysqlFulltextError(e) and\
+      any('"' in constraints.get(f, "") for f in _fulltextFields):
+      constraints2 = constraints.copy()
+      for f in _fulltextFields:
+        if f in constraints2:
+          constraints2[f] = constraints2[f].replace('"', " ")
+      log.success(tid, "-1")
+      return executeSearchFacets(user, constraints2, facets)
+    else:
+      log.error(tid, e)
+      raise
+  else:
+    log.success(tid, str(sum(len(l) for l in r.values())))
+    return r
+  finally:
+    _endSearch()
+
+def _explainRows (qs):
+  # Returns MySQL's estimate of the number of SearchIdentifier rows
+  # that must be examined to evaluate a QuerySet.
+  sql, params = qs.query.sql_with_params()
+  cursor = django.db.connections["search"].cursor()
+  cursor.execute("EXPLAIN " + sql, params)
+  columns = [c[0] for c in cursor.description]
+  rows = [dict(zip(columns, r)) for r in cursor.fetchall()]
+  table = ezidapp.models.SearchIdentifier._meta.db_table
+  return max([r["rows"] or 0 for r in rows if r["table"] == table] or [0])
+
+def _estimateCount (constraints):
+  # Returns an estimate of the number of results of a query known to
+  # have more than _countEstimateThreshold results.  MySQL's own row
+  # estimate is used if it's plausible.  But MySQL is unable to
+  # estimate the selectivity of FULLTEXT matches, and in that case we
+  # estimate the number of identifiers in the query's scope (i.e.,
+  # subject to its owner, ownergroup, and publicSearchVisible
+  # constraints only) and scale that by the fraction of a sample of
+  # in-scope identifiers that satisfy the full query.  The sample is
+  # drawn from row IDs spaced evenly across the scope's ID range so
+  # that it is not biased toward older identifiers.
+  qs = formulateQuery(constraints, selectRelated=[], defer=[]).order_by()
+  n = _explainRows(qs)
+  if n > _countEstimateThreshold: return n
+  scope = formulateQuery(dict((k, v) for k, v in constraints.items()\
+    if k in ["owner", "ownergroup", "publicSearchVisible"]),
+    selectRelated=[], defer=[]).order_by()
+  r = scope.aggregate(lo=django.db.models.Min("id"),
+    hi=django.db.models.Max("id"))
+  if r["lo"] == None: return _countEstimateThreshold+1
+  step = max((r["hi"]-r["lo"]+1)/float(_countSampleSize), 1.0)
+  candidates = sorted(set(int(r["lo"]+i*step) for i in range(_countSampleSize)\
+    if r["lo"]+i*step <= r["hi"]))
+  sample = list(scope.filter(id__in=candidates).values_list("id", flat=True))
+  if len(sample) == 0: return _countEstimateThreshold+1
+  m = qs.filter(id__in=sample).count()
+  return max(int(_explainRows(scope)*float(m)/len(sample)),
+    _countEstimateThreshold+1)
+
+def executeSearchCountEstimate (user, constraints,
+  selectRelated=defaultSelectRelated, defer=defaultDefer):
+  """
+  Executes a search database query, returning a tuple (number of
+  results, approximate).  If the number of results exceeds the
+  configured threshold, the number is estimated and 'approximate' is
+  True; otherwise, the number is exact.  Exact counts can always be
+  obtained using executeSearchCountOnly.  'user' is the requestor, and
+  should be an authenticated StoreUser object or AnonymousUser.
+  'constraints', 'selectRelated', and 'defer' are as in formulateQuery
+  above.  Counts computable from the identifier summary table (see
+  executeSearchCountOnly) are always exact; other counts may be served
+  from the result cache.
+  """
+  if _countEstimateThreshold <= 0 or\
+    django.db.connections["search"].vendor != "mysql" or\
+    all(k in _summaryColumns for k in constraints):
+    return (executeSearchCountOnly(user, constraints, selectRelated, defer),
+      False)
+  tid = uuid.uuid1()
+  _beginSearch(user)
+  try:
+    qs = formulateQuery(constraints, selectRelated=selectRelated, defer=defer)
+    log.begin(tid, "search/estimate", "-", user.username, user.pid,
+      user.group.groupname, user.group.pid, *reduce(operator.__concat__,
+      [[k, unicode(v)] for k, v in constraints.items()]))
+    key = _cacheKey("estimate", constraints, None, None, None, selectRelated,
+      defer)
+    r = _cacheGet(key)
+    if r == None:
+      # Counting is cheap if bounded.
+      c = _withTimeout(qs[:_countEstimateThreshold+1].count)
+      if c <= _countEstimateThreshold:
+        r = (c, False)
+      else:
+        r = (_withTimeout(lambda: _estimateCount(constraints)), True)
+      _cachePut(key, r, constraints)
+  except Exception, e:
+    # See executeSearchCountOnly above.
+    if _isMysqlFulltextError(e) and\
+      any('"' in constraints.get(f, "") for f in _fulltextFields):
+      constraints2 = constraints.copy()
+      for f in _fulltextFields:
+        if f in constraints2:
+          constraints2[f] = constraints2[f].replace('"', " ")
+      log.success(tid, "-1")
+      return executeSearchCountEstimate(user, constraints2, selectRelated,
+        defer)
+    else:
+      log.error(tid, e)
+      raise
+  else:
+    log.success(tid, "%s%d" % ("~" if r[1] else "", r[0]))
+    return r
+  finally:
+    _endSearch()
 
 def executeSearch (user, constraints, from_, to, orderBy=None,
   selectRelated=defaultSelectRelated, defer=defaultDefer):
@@ -469,19 +905,29 @@ def executeSearch (user, constraints, from_, to, orderBy=None,
   'user' is the requestor, and should be an authenticated StoreUser
   object or AnonymousUser.  'from_' and 'to' are range bounds, and
   must be supplied.  'constraints', 'orderBy', 'selectRelated', and
-  'defer' are as in formulateQuery above.
+  'defer' are as in formulateQuery above.  The QuerySet may be served
+  from the result cache, and hence may be shared with other callers;
+  it must not be modified.
   """
   tid = uuid.uuid1()
+  _beginSearch(user)
   try:
-    _modifyActiveCount(1)
     qs = formulateQuery(constraints, orderBy=orderBy,
       selectRelated=selectRelated, defer=defer)
     log.begin(tid, "search/results", "-", user.username, user.pid,
       user.group.groupname, user.group.pid, str(orderBy), str(from_), str(to),
       *reduce(operator.__concat__,
       [[k, unicode(v)] for k, v in constraints.items()]))
-    qs = qs[from_:to]
-    c = len(qs)
+    key = _cacheKey("results", constraints, orderBy, from_, to, selectRelated,
+      defer)
+    cached = _cacheGet(key)
+    if cached != None:
+      qs = cached
+      c = len(qs)
+    else:
+      qs = qs[from_:to]
+      c = _withTimeout(lambda: len(qs))
+      _cachePut(key, qs, constraints)
   except Exception, e:
     # MySQL's FULLTEXT engine chokes on a too-frequently-occurring
     # word (call it a "bad" word) that is not on its own stopword
@@ -507,4 +953,234 @@ def executeSearch (user, constraints, from_, to, orderBy=None,
     log.success(tid, str(c))
     return qs
   finally:
-    _modifyActiveCount(-1)
+    _endSearch()
+
+def _cursorDigest (constraints, orderBy):
+  # Returns a digest of a query, for binding cursors to queries.
+  # Quotes in fulltext constraints are disregarded so that cursors
+  # survive the unquoting performed on MySQL FULLTEXT errors.
+  constraints = dict((k, v.replace('"', " ") if k in _fulltextFields else v)\
+    for k, v in constraints.items())
+  return hashlib.sha1(repr(_cacheKey("page", constraints, orderBy, None, None,
+    [], []))).hexdigest()[::4]
+
+def _buildCursor (constraints, orderBy, forward, value, id):
+  # A cursor denotes the rows following (if 'forward' is True) or
+  # preceding (if False) the row having ordering value 'value' and
+  # row ID 'id'.
+  s = base64.urlsafe_b64encode(json.dumps([orderBy, forward, value, id,
+    _cursorDigest(constraints, orderBy)]))
+  hash = hashlib.sha1("%s,%s" % (s,
+    django.conf.settings.SECRET_KEY)).hexdigest()[::4]
+  return "%s.%s" % (s, hash)
+
+def _unpackCursor (cursor, constraints, orderBy):
+  # Returns a tuple (forward, value, id), or None if the cursor is
+  # invalid or belongs to a different query.
+  try:
+    s, hash1 = cursor.split(".")
+    hash2 = hashlib.sha1("%s,%s" % (s,
+      django.conf.settings.SECRET_KEY)).hexdigest()[::4]
+    assert hash1 == hash2
+    o, forward, value, id, digest = json.loads(base64.urlsafe_b64decode(
+      str(s)))
+    assert o == orderBy and digest == _cursorDigest(constraints, orderBy)
+    return (forward, value, id)
+  except:
+    return None
+
+def isValidCursor (cursor, constraints, orderBy=None):
+  """
+  Returns True if 'cursor' is a cursor returned by executeSearchPage
+  for the given constraints and ordering.
+  """
+  return _unpackCursor(cursor, constraints, orderBy) != None
+
+# Columns by which results may be ordered that may be NULL.  MySQL
+# (like SQLite) sorts NULLs first in ascending order.
+
+_nullableOrderingColumns = ["ownergroup__groupname", "profile__label",
+  "searchablePublicationYear"]
+
+def _seekFilter (column, descending, value, id):
+  # Returns a filter that selects the rows following the row having
+  # ordering value 'value' and row ID 'id' in the ordering on
+  # (column, id).
+  op = "__lt" if descending else "__gt"
+  if column == "id": return django.db.models.Q(**{ ("id" + op): id })
+  nullable = column in _nullableOrderingColumns
+  if value == None:
+    q = django.db.models.Q(**{ (column + "__isnull"): True, ("id" + op): id })
+    if not descending:
+      q |= django.db.models.Q(**{ (column + "__isnull"): False })
+  else:
+    q = django.db.models.Q(**{ (column + op): value }) |\
+      django.db.models.Q(**{ column: value, ("id" + op): id })
+    if nullable and descending:
+      q |= django.db.models.Q(**{ (column + "__isnull"): True })
+  return q
+
+def _orderingValue (row, column):
+  v = row
+  for a in column.split("__"):
+    if v == None: break
+    v = getattr(v, a)
+  return v
+
+def executeSearchPage (user, constraints, pageSize, cursor=None, offset=0,
+  orderBy=None, selectRelated=defaultSelectRelated, defer=defaultDefer):
+  """
+  Executes a search database query using keyset (a.k.a. seek)
+  pagination, returning a tuple (results, next cursor, previous
+  cursor).  'results' is a list of at most 'pageSize'
+  SearchIdentifier objects.  Rather than skipping over preceding
+  results as executeSearch does, the query seeks directly to the page
+  based on the ordering column value and row ID of the last (or first)
+  row of the adjacent page, so that the cost of retrieving a page is
+  independent of its depth.  'cursor' should be None to retrieve the
+  first page, or a next or previous cursor returned by a previous
+  call to this function having the same constraints and ordering (see
+  isValidCursor above).  Cursors are opaque, URL-safe strings; the
+  next (previous) cursor is None if there is no next (previous)
+  page.  In the absence of a cursor, 'offset' results are skipped as
+  in executeSearch, which allows jumping to an arbitrary page (at the
+  cost of an offset query).  'user', 'constraints', 'orderBy',
+  'selectRelated', and 'defer' are as in executeSearch above.
+  """
+  tid = uuid.uuid1()
+  _beginSearch(user)
+  try:
+    if orderBy != None:
+      descending, column = _orderingColumn(orderBy)
+      defer = [f for f in defer if f != column]
+    else:
+      descending, column = (False, "id")
+    qs = formulateQuery(constraints, orderBy=orderBy,
+      selectRelated=selectRelated, defer=defer)
+    if orderBy == None: qs = qs.order_by("id")
+    log.begin(tid, "search/page", "-", user.username, user.pid,
+      user.group.groupname, user.group.pid, str(orderBy), str(pageSize),
+      str(cursor), str(offset), *reduce(operator.__concat__,
+      [[k, unicode(v)] for k, v in constraints.items()]))
+    key = _cacheKey("page", constraints, orderBy, cursor or offset, pageSize,
+      selectRelated, defer)
+    r = _cacheGet(key)
+    if r == None:
+      forward = True
+      if cursor == None:
+        qs = qs[offset:]
+      else:
+        c = _unpackCursor(cursor, constraints, orderBy)
+        assert c != None, "invalid cursor"
+        forward, value, id = c
+        if forward:
+          qs = qs.filter(_seekFilter(column, descending, value, id))
+        else:
+          qs = qs.filter(_seekFilter(column, not descending, value, id))\
+            .reverse()
+      # One additional row is retrieved to determine if there are more
+      # rows beyond the page.
+      results = _withTimeout(lambda: list(qs[:pageSize+1]))
+      more = len(results) > pageSize
+      results = results[:pageSize]
+      if not forward: results.reverse()
+      next = previous = None
+      if len(results) > 0:
+        if (forward and more) or not forward:
+          next = _buildCursor(constraints, orderBy, True,
+            _orderingValue(results[-1], column), results[-1].id)
+        if (forward and (cursor != None or offset > 0)) or\
+          (not forward and more):
+          previous = _buildCursor(constraints, orderBy, False,
+            _orderingValue(results[0], column), results[0].id)
+      r = (results, next, previous)
+      _cachePut(key, r, constraints)
+  except Exception, e:
+    # See executeSearchCountOnly above.
+    if _isMysqlFulltextError(e) and\
+      any('"' in constraints.get(f, "") for f in _fulltextFields):
+      constraints2 = constraints.copy()
+      for f in _fulltextFields:
+        if f in constraints2:
+          constraints2[f] = constraints2[f].replace('"', " ")
+      log.success(tid, "-1")
+      return executeSearchPage(user, constraints2, pageSize, cursor, offset,
+        orderBy, selectRelated, defer)
+    else:
+      log.error(tid, e)
+      raise
+  else:
+    log.success(tid, str(len(r[0])))
+    return r
+  finally:
+    _endSearch()
+
+def executeSearchStream (user, constraints,
+  selectRelated=defaultSelectRelated, defer=defaultDefer):
+  """
+  Executes a search database query, returning a generator that yields
+  all results as SearchIdentifier objects in row ID order.  Results
+  are retrieved in fixed-size chunks using keyset pagination, so that
+  memory usage is independent of the number of results; the time
+  limit applies to each chunk individually.  No search is performed
+  until the first result is requested; from then on, the search
+  counts against the requestor's concurrent search limit until the
+  generator is exhausted, raises an exception, or is closed.  Hence
+  a caller that retrieves any results must ensure that the generator
+  is closed if it is abandoned (for a Django streaming response, by
+  passing it, or an iterable whose close method closes it, as the
+  response content).  The first request for a result raises
+  SearchLimitException if the requestor has too many searches in
+  progress.  Note that if the generator is consumed by a streaming
+  response, exceptions raised after the response has begun (e.g., a
+  search timeout) propagate to the server, not to Django middleware
+  such as SearchLimitMiddleware; callers must report such errors
+  in-band.  'user', 'constraints', 'selectRelated', and 'defer' are as
+  in executeSearch above.  Results are never served from the result
+  cache.  As in the other search functions, a query that MySQL's
+  FULLTEXT engine rejects is retried with quotes removed from fulltext
+  constraints; if that happens after the first chunk, the remainder
+  of the results are those of the retried query.
+  """
+  tid = uuid.uuid1()
+  n = 0
+  # Not _beginSearch: see _acquireSearchSlot above.
+  username = _acquireSearchSlot(user)
+  try:
+    qs = formulateQuery(constraints, selectRelated=selectRelated,
+      defer=defer).order_by("id")
+    log.begin(tid, "search/stream", "-", user.username, user.pid,
+      user.group.groupname, user.group.pid, *reduce(operator.__concat__,
+      [[k, unicode(v)] for k, v in constraints.items()]))
+    lastId = None
+    while True:
+      chunk = qs if lastId == None else qs.filter(id__gt=lastId)
+      try:
+        results = _withTimeout(lambda: list(chunk[:_streamChunkSize]))
+      except Exception, e:
+        # See executeSearchCountOnly above.
+        if _isMysqlFulltextError(e) and\
+          any('"' in constraints.get(f, "") for f in _fulltextFields):
+          constraints = constraints.copy()
+          for f in _fulltextFields:
+            if f in constraints:
+              constraints[f] = constraints[f].replace('"', " ")
+          qs = formulateQuery(constraints, selectRelated=selectRelated,
+            defer=defer).order_by("id")
+          continue
+        raise
+      for r in results: yield r
+      n += len(results)
+      if len(results) < _streamChunkSize: break
+      lastId = results[-1].id
+  except GeneratorExit:
+    # The consumer stopped early, e.g., because the client went away.
+    log.success(tid, str(n))
+    raise
+  except Exception, e:
+    log.error(tid, e)
+    raise
+  else:
+    log.success(tid, str(n))
+  finally:
+    _releaseSearchSlot(username)
@@ -24,6 +24,7 @@ import threading
 import time
 import uuid
 
+import backproc
 import binder_async
 import config
 import crossref
@@ -32,6 +33,7 @@ import datacite_async
 import download
 import ezid
 import ezidapp.models
+import http_pool
 import log
 import search_util
 
@@ -71,6 +73,8 @@ def _statusDaemon ():
       as_ = search_util.numActiveSearches()
       no = log.getOperationCount()
       log.resetOperationCount()
+      bps = backproc.getStatistics()
+      hps = http_pool.getStatistics()
       log.status("pid=%d" % os.getpid(),
         "threads=%d" % threading.activeCount(),
         "paused" if isPaused else "running",
@@ -84,7 +88,11 @@ def _statusDaemon ():
         (cqs[2]+cqs[3], cqs[0], cqs[1]),
         "downloadQueueLength=%d" % doql,
         "activeSearches=%d" % as_,
-        "operationCount=%d" % no)
+        "operationCount=%d" % no,
+        "backprocThroughput:%s=%s" % ("/".join(st for st, n, t in bps),
+        "/".join("%.0f" % (n/t if t > 0 else 0) for st, n, t in bps)),
+        "httpConnections:opened/reused=%d/%d" % hps[:2],
+        "httpConnectionWaitTime=%.1f" % hps[2])
       if _cloudwatchEnabled:
         import boto3
         # Disable annoying boto3 logging.
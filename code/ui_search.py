@@ -8,6 +8,7 @@ from django.utils.translation import ugettext as _
 import userauth
 import math
 import locale
+import log
 import util
 import operator
 import re
@@ -136,7 +137,8 @@ def hasBrokenLinks(d, request):
   c = _buildAuthorityConstraints(request, "issues", user_id, group_id)
   c['hasIssues'] = True
   c['linkIsBroken'] = True
-  return search_util.executeSearch(userauth.getUser(request, returnAnonymous=True), c, 0, 1)
+  return search_util.executeSearchCountOnly(
+    userauth.getUser(request, returnAnonymous=True), c) > 0
 
 # search function is executed from the following areas, s_type determines search parameters:
 # Public Search (default):     ui_search   "public"
@@ -190,11 +192,26 @@ def search(d, request, noConstraintsReqd=False, s_type="public"):
         ezidapp.models.Identifier.CR_WORKING,
         ezidapp.models.Identifier.CR_WARNING, 
         ezidapp.models.Identifier.CR_FAILURE]
-    d['total_results'] = search_util.executeSearchCountOnly(
-      userauth.getUser(request, returnAnonymous=True), c)
+    # Counts for very large result sets are estimated unless the user asks
+    # for an exact count ("exact_count=t")
+    if request.GET.get('exact_count') == 't':
+      d['total_results'] = search_util.executeSearchCountOnly(
+        userauth.getUser(request, returnAnonymous=True), c)
+      d['total_results_approximate'] = False
+    else:
+      d['total_results'], d['total_results_approximate'] =\
+        search_util.executeSearchCountEstimate(
+        userauth.getUser(request, returnAnonymous=True), c)
     d['total_results_str'] = format(d['total_results'], "n") 
+    if d['total_results_approximate']:
+      d['total_results_str'] = _("about") + " " + d['total_results_str']
+      q = request.GET.copy()
+      q['exact_count'] = 't'
+      d['exact_count_query'] = q.urlencode()
     d['total_pages'] = int(math.ceil(float(d['total_results'])/float(d['ps'])))
-    if d['p'] > d['total_pages']: d['p'] = d['total_pages']
+    # An estimated count may fall short, so pages beyond it are allowed
+    if d['p'] > d['total_pages'] and not d['total_results_approximate']:
+      d['p'] = d['total_pages']
     d['p'] = max(d['p'], 1)
     if d['order_by']:
       orderColumn = FIELDS_MAPPED[d['order_by']][0]
@@ -204,8 +221,14 @@ def search(d, request, noConstraintsReqd=False, s_type="public"):
     d['results'] = []
     rec_beg = (d['p']-1)*d['ps']
     rec_end = d['p']*d['ps']
-    for id in search_util.executeSearch(userauth.getUser(request,
-      returnAnonymous=True), c, rec_beg, rec_end, orderColumn):
+    # Next/previous page requests carry a cursor that allows seeking directly
+    # to the page; other page requests fall back to offsets.
+    cursor = request.GET.get('cursor', '')
+    if not search_util.isValidCursor(cursor, c, orderColumn): cursor = None
+    ids, d['next_cursor'], d['prev_cursor'] = search_util.executeSearchPage(
+      userauth.getUser(request, returnAnonymous=True), c, d['ps'], cursor,
+      0 if cursor else rec_beg, orderColumn)
+    for id in ids:
       if s_type in ('public', 'manage'):
         result = {
           "c_create_time": id.createTime,
@@ -243,6 +266,13 @@ def search(d, request, noConstraintsReqd=False, s_type="public"):
           result["c_crossref_msg"] = id.crossrefMessage 
       d['results'].append(result)
     # end of result iteration loop 
+    # Facets are a convenience; if they can't be computed (too many
+    # searches in progress, a database error) the page is shown without them
+    if s_type in ('public', 'manage') and d['total_results'] > 0:
+      try:
+        d['facets'] = _facets(request, c, s_type)
+      except Exception, e:
+        log.otherError("ui_search.search/facets", e)
     if s_type == "public":
       rec_range = '0' 
       if d['total_results'] > 0:
@@ -271,6 +301,47 @@ def search(d, request, noConstraintsReqd=False, s_type="public"):
     d['search_success'] = False 
   return d
 
+# Facets displayed for narrowing searches, mapped to 1) UI display and 2) the
+# form field(s) that constrain them
+FACETS_MAPPED = {
+  'status':                  [_("ID Status"),        ['id_status']],
+  'resourceType':            [_("Object Type"),      ['object_type']],
+  'profile':                 [_("Metadata Profile"), ['profile']],
+  'resourcePublicationYear': [_("Object Publication Date"),
+                              ['pubyear_from', 'pubyear_to']],
+  'owner':                   [_("ID Owner"),         ['owner_selected']],
+}
+_facetsByType = {
+  'public': ['resourceType', 'resourcePublicationYear'],
+  'manage': ['status', 'resourceType', 'profile',
+             'resourcePublicationYear'] }
+MAX_FACET_VALUES = 10
+
+def _facets(request, c, s_type):
+  """
+  Counts of results by facet value, each with the query string that narrows
+  the search to that value. Returns list of
+  (facet display name, [(value, count, query)])
+  """
+  facets = list(_facetsByType[s_type])
+  if 'ownergroup' in c: facets.append('owner')
+  counts = search_util.executeSearchFacets(userauth.getUser(request,
+    returnAnonymous=True), c, facets)
+  r = []
+  for f in facets:
+    if len(counts[f]) < 2: continue    # Nothing to narrow
+    values = []
+    for v, n in counts[f][:MAX_FACET_VALUES]:
+      q = request.GET.copy()
+      for k in ['p', 'cursor', 'exact_count']:
+        if k in q: del q[k]
+      for k in FACETS_MAPPED[f][1]:
+        q[k] = ('user_' + v) if f == 'owner' else v
+      if s_type == 'manage': q['filtered'] = 't'
+      values.append((v, n, q.urlencode()))
+    r.append((FACETS_MAPPED[f][0], values))
+  return r
+
 def _pageLayout(d, REQUEST, s_type="public"):
   """
   Track user preferences for selected fields, field order, page, and page size
@@ -336,7 +407,7 @@ def _buildConstraints(c, REQUEST, s_type="public"):
     'object_type': 'resourceType'}
   if s_type != "public":
     cmap_managePage = {'target': 'target', 'id_status': 'status',
-      'harvesting': 'exported', 'hasMetadata': 'hasMetadata'}
+      'harvesting': 'exported', 'hasMetadata': 'hasMetadata', 'profile': 'profile'}
     cmap.update(cmap_managePage)
   for k,v in cmap.iteritems(): 
     # Handle boolean values
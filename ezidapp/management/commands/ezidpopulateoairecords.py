@@ -0,0 +1,37 @@
+import django.core.management.base
+import os.path
+
+# The following must precede any EZID module imports:
+execfile(os.path.join(os.path.dirname(os.path.dirname(
+  os.path.dirname(os.path.dirname(__file__)))), "tools", "offline.py"))
+
+import django.db.models
+
+import ezidapp.models
+import oai
+
+class Command (django.core.management.base.BaseCommand):
+  help = "Populate the precomputed OAI-PMH record metadata of OAI-visible " +\
+    "identifiers in the search database that lack it"
+  def handle (self, *args, **options):
+    lastId = 0
+    while True:
+      rows = list(ezidapp.models.SearchIdentifier.objects\
+        .filter(id__gt=lastId, oaiVisible=True)\
+        .filter(django.db.models.Q(oaiDublinCoreRecord="") |\
+        django.db.models.Q(oaiDataciteRecord=""))\
+        .select_related("profile").order_by("id")[:1000])
+      if len(rows) == 0: break
+      for si in rows:
+        try:
+          dc = oai.serializeMetadata(si, "oai_dc")
+          dd = oai.serializeMetadata(si, "datacite")
+        except Exception, e:
+          self.stderr.write("%s: %s\n" % (si.identifier, str(e)))
+          continue
+        # The update is conditional so as not to clobber a concurrent
+        # update of the identifier.
+        ezidapp.models.SearchIdentifier.objects\
+          .filter(id=si.id, updateTime=si.updateTime)\
+          .update(oaiDublinCoreRecord=dc, oaiDataciteRecord=dd)
+      lastId = rows[-1].id
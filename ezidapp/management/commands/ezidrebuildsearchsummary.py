@@ -0,0 +1,13 @@
+import django.core.management.base
+import os.path
+
+# The following must precede any EZID module imports:
+execfile(os.path.join(os.path.dirname(os.path.dirname(
+  os.path.dirname(os.path.dirname(__file__)))), "tools", "offline.py"))
+
+import ezidapp.models.search_identifier_summary
+
+class Command (django.core.management.base.BaseCommand):
+  help = "Rebuild the search database identifier summary table"
+  def handle (self, *args, **options):
+    ezidapp.models.search_identifier_summary.rebuild()
@@ -0,0 +1,37 @@
+import django.core.management.base
+import django.db.transaction
+import os.path
+
+# The following must precede any EZID module imports:
+execfile(os.path.join(os.path.dirname(os.path.dirname(
+  os.path.dirname(os.path.dirname(__file__)))), "tools", "offline.py"))
+
+import ezidapp.models.minter_counter
+
+class Command (django.core.management.base.BaseCommand):
+  help = "Set the counter of a local minter, e.g., to continue minting " +\
+    "on a shoulder previously served by a noid minter"
+  def add_arguments (self, parser):
+    parser.add_argument("minter", help="the minter's URL")
+    parser.add_argument("value", type=long,
+      help="the next counter value to use (counter values are numbered " +\
+      "from 0)")
+    parser.add_argument("--force", action="store_true", default=False,
+      help="allow the counter to be decreased")
+  def handle (self, *args, **options):
+    if options["value"] < 0:
+      raise django.core.management.base.CommandError("negative value")
+    MinterCounter = ezidapp.models.minter_counter.MinterCounter
+    with django.db.transaction.atomic():
+      c = list(MinterCounter.objects.select_for_update()\
+        .filter(minter=options["minter"]))
+      if len(c) == 0:
+        MinterCounter.objects.create(minter=options["minter"],
+          value=options["value"])
+      else:
+        # Decreasing a counter causes identifiers to be minted again.
+        if options["value"] < c[0].value and not options["force"]:
+          raise django.core.management.base.CommandError(
+            "counter is at %d; use --force to decrease it" % c[0].value)
+        c[0].value = options["value"]
+        c[0].save()
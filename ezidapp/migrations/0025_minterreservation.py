@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0024_downloadqueue_filesize'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinterReservation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('minter', models.URLField(max_length=255, db_index=True)),
+                ('identifier', models.CharField(max_length=255)),
+            ],
+        ),
+    ]
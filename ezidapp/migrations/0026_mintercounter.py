@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0025_minterreservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinterCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('minter', models.URLField(unique=True, max_length=255)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import django.db
+
+# Creates and populates the SQLite fulltext (FTS) table described in
+# ezidapp/models/search_identifier.py.  FTS5 is used if available,
+# else FTS4.  Nothing is done under other databases.
+
+_table = "ezidapp_searchidentifier_fts"
+_fields = "resourceCreator, resourceTitle, resourcePublisher, keywords"
+
+def createFulltextTable (apps, schema_editor):
+    c = schema_editor.connection
+    if c.vendor != "sqlite": return
+    cursor = c.cursor()
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, " % (_table,
+            _fields) + "tokenize=unicode61)")
+    except django.db.OperationalError:
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts4(%s, " % (_table,
+            _fields) + "tokenize=unicode61)")
+    cursor.execute("INSERT INTO %s (rowid, %s) SELECT id, %s FROM " % (_table,
+        _fields, _fields) + "ezidapp_searchidentifier")
+
+def dropFulltextTable (apps, schema_editor):
+    c = schema_editor.connection
+    if c.vendor != "sqlite": return
+    c.cursor().execute("DROP TABLE IF EXISTS %s" % _table)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0026_mintercounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(createFulltextTable, dropFulltextTable,
+            hints={ "model_name": "searchidentifier" }),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.core.validators
+import django.db.models.deletion
+import ezidapp.models.custom_fields
+
+# Populates the summary table described in
+# ezidapp/models/search_identifier_summary.py.
+
+_fields = ["owner_id", "ownergroup_id", "status", "hasIssues",
+    "linkIsBroken", "crossrefStatus"]
+
+def populateSummary (apps, schema_editor):
+    SearchIdentifier = apps.get_model("ezidapp", "SearchIdentifier")
+    SearchIdentifierSummary = apps.get_model("ezidapp",
+        "SearchIdentifierSummary")
+    SearchIdentifierSummary.objects.bulk_create(
+        [SearchIdentifierSummary(count=r["identifierCount"],
+        **dict((f, r[f]) for f in _fields))\
+        for r in SearchIdentifier.objects.order_by().values(*_fields)\
+        .annotate(identifierCount=models.Count("id"))], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0027_searchidentifier_fulltext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchIdentifierSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(max_length=1, choices=[(b'R', b'reserved'), (b'P', b'public'), (b'U', b'unavailable')])),
+                ('hasIssues', models.BooleanField()),
+                ('linkIsBroken', models.BooleanField()),
+                ('crossrefStatus', models.CharField(blank=True, max_length=1, choices=[(b'R', b'awaiting status change to public'), (b'B', b'registration in progress'), (b'S', b'successfully registered'), (b'W', b'registered with warning'), (b'F', b'registration failure')])),
+                ('count', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('owner', ezidapp.models.custom_fields.NonValidatingForeignKey(to='ezidapp.SearchUser', on_delete=django.db.models.deletion.PROTECT)),
+                ('ownergroup', ezidapp.models.custom_fields.NonValidatingForeignKey(on_delete=django.db.models.deletion.PROTECT, default=None, blank=True, to='ezidapp.SearchGroup', null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchidentifiersummary',
+            unique_together=set([('owner', 'ownergroup', 'status', 'hasIssues', 'linkIsBroken', 'crossrefStatus')]),
+        ),
+        migrations.RunPython(populateSummary, migrations.RunPython.noop,
+            hints={ "model_name": "searchidentifiersummary" }),
+    ]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import urlparse
+
+# Fills in the target host and path fields of existing identifiers.
+# Identifiers are read in chunks by row ID, and each chunk is written
+# back with a few UPDATE statements that set the fields using CASE
+# expressions rather than an UPDATE per identifier.
+
+_readChunkSize = 1000
+# Each identifier contributes 7 query parameters to an UPDATE, which
+# is kept under SQLite's limit of 999.
+_updateChunkSize = 100
+
+def _normalizeTarget (url, maxLength):
+    # A frozen copy of ezidapp.models.search_identifier.normalizeTarget
+    # as of this migration.
+    try:
+        u = urlparse.urlsplit(url)
+        host = (u.hostname or "").rstrip(".")
+    except ValueError:
+        host = ""
+    if host == "": return ("", "", "")
+    path = u.path or "/"
+    if u.query != "": path += "?" + u.query
+    return (host[:maxLength],
+        (".".join(reversed(host.split("."))) + ".")[:maxLength],
+        path[:maxLength])
+
+def _update (SearchIdentifier, values):
+    # 'values' is a list of (id, host, reversed host, path) tuples.
+    def case (i):
+        return models.Case(*[models.When(id=v[0], then=models.Value(v[i]))\
+            for v in values], output_field=models.CharField())
+    SearchIdentifier.objects.filter(id__in=[v[0] for v in values])\
+        .update(targetHost=case(1), targetReversedHost=case(2),
+        targetPath=case(3))
+
+def populateTargetFields (apps, schema_editor):
+    SearchIdentifier = apps.get_model("ezidapp", "SearchIdentifier")
+    maxLength = SearchIdentifier._meta.get_field("targetPath").max_length
+    lastId = 0
+    while True:
+        rows = list(SearchIdentifier.objects.filter(id__gt=lastId)\
+            .order_by("id").values_list("id", "target")[:_readChunkSize])
+        if len(rows) == 0: break
+        values = []
+        for id, target in rows:
+            host, rhost, path = _normalizeTarget(target, maxLength)
+            if host != "": values.append((id, host, rhost, path))
+        for i in range(0, len(values), _updateChunkSize):
+            _update(SearchIdentifier, values[i:i+_updateChunkSize])
+        lastId = rows[-1][0]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0028_searchidentifiersummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchidentifier',
+            name='targetHost',
+            field=models.CharField(default='', max_length=255, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='searchidentifier',
+            name='targetPath',
+            field=models.CharField(default='', max_length=255, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='searchidentifier',
+            name='targetReversedHost',
+            field=models.CharField(default='', max_length=255, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AlterIndexTogether(
+            name='searchidentifier',
+            index_together=set([('publicSearchVisible', 'resourceCreatorPrefix'), ('owner', 'crossrefStatus'), ('owner', 'resourceCreatorPrefix'), ('publicSearchVisible', 'resourcePublisherPrefix'), ('ownergroup', 'hasMetadata'), ('owner', 'hasMetadata'), ('owner', 'hasIssues'), ('owner', 'profile'), ('owner', 'createTime'), ('owner', 'status'), ('publicSearchVisible', 'createTime'), ('searchableTarget',), ('ownergroup', 'searchableResourceType'), ('ownergroup', 'identifier'), ('ownergroup', 'profile'), ('ownergroup', 'exported'), ('owner', 'exported'), ('ownergroup', 'resourceTitlePrefix'), ('publicSearchVisible', 'resourceTitlePrefix'), ('owner', 'resourceTitlePrefix'), ('owner', 'identifier'), ('ownergroup', 'createTime'), ('ownergroup', 'isTest'), ('publicSearchVisible', 'updateTime'), ('publicSearchVisible', 'searchableResourceType'), ('publicSearchVisible', 'identifier'), ('owner', 'searchablePublicationYear'), ('owner', 'updateTime'), ('publicSearchVisible', 'searchablePublicationYear'), ('oaiVisible', 'updateTime'), ('ownergroup', 'resourceCreatorPrefix'), ('ownergroup', 'hasIssues'), ('ownergroup', 'updateTime'), ('owner', 'resourcePublisherPrefix'), ('ownergroup', 'crossrefStatus'), ('ownergroup', 'status'), ('owner', 'isTest'), ('ownergroup', 'resourcePublisherPrefix'), ('owner', 'searchableResourceType'), ('ownergroup', 'searchablePublicationYear'), ('targetReversedHost', 'targetPath')]),
+        ),
+        migrations.RunPython(populateTargetFields, migrations.RunPython.noop,
+            hints={ "model_name": "searchidentifier" }),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Existing identifiers' OAI-PMH record metadata is left empty, as
+# computing it requires the full EZID environment.  It should be
+# filled in by running the ezidpopulateoairecords management command
+# after migrating; in the meantime it is computed on demand (see
+# oai.py).
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0029_searchidentifier_target'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchidentifier',
+            name='oaiDataciteRecord',
+            field=models.TextField(default='', editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='searchidentifier',
+            name='oaiDublinCoreRecord',
+            field=models.TextField(default='', editable=False),
+            preserve_default=False,
+        ),
+    ]
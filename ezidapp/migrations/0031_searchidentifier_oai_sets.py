@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0030_searchidentifier_oai_records'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='searchidentifier',
+            index_together=set([('publicSearchVisible', 'resourceCreatorPrefix'), ('owner', 'crossrefStatus'), ('owner', 'resourceCreatorPrefix'), ('publicSearchVisible', 'resourcePublisherPrefix'), ('ownergroup', 'hasMetadata'), ('owner', 'hasMetadata'), ('owner', 'hasIssues'), ('owner', 'profile'), ('owner', 'createTime'), ('owner', 'status'), ('publicSearchVisible', 'createTime'), ('searchableTarget',), ('ownergroup', 'searchableResourceType'), ('ownergroup', 'identifier'), ('ownergroup', 'profile'), ('ownergroup', 'exported'), ('owner', 'exported'), ('ownergroup', 'resourceTitlePrefix'), ('publicSearchVisible', 'resourceTitlePrefix'), ('owner', 'resourceTitlePrefix'), ('owner', 'identifier'), ('ownergroup', 'createTime'), ('ownergroup', 'isTest'), ('publicSearchVisible', 'updateTime'), ('publicSearchVisible', 'searchableResourceType'), ('publicSearchVisible', 'identifier'), ('owner', 'searchablePublicationYear'), ('owner', 'updateTime'), ('publicSearchVisible', 'searchablePublicationYear'), ('oaiVisible', 'updateTime'), ('ownergroup', 'resourceCreatorPrefix'), ('ownergroup', 'hasIssues'), ('ownergroup', 'updateTime'), ('owner', 'resourcePublisherPrefix'), ('ownergroup', 'crossrefStatus'), ('ownergroup', 'status'), ('owner', 'isTest'), ('ownergroup', 'resourcePublisherPrefix'), ('owner', 'searchableResourceType'), ('ownergroup', 'searchablePublicationYear'), ('targetReversedHost', 'targetPath'), ('oaiVisible', 'ownergroup', 'updateTime'), ('oaiVisible', 'identifier')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import ezidapp.models.custom_fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0031_searchidentifier_oai_sets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchIdentifierTombstone',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('identifier', models.CharField(unique=True, max_length=255)),
+                ('deleteTime', models.IntegerField()),
+                ('ownergroup', ezidapp.models.custom_fields.NonValidatingForeignKey(on_delete=django.db.models.deletion.SET_NULL, default=None, blank=True, to='ezidapp.SearchGroup', null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='searchidentifiertombstone',
+            index_together=set([('deleteTime',), ('ownergroup', 'deleteTime')]),
+        ),
+    ]
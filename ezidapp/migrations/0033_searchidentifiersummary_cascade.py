@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import ezidapp.models.custom_fields
+
+def deleteEmptyClasses (apps, schema_editor):
+    SearchIdentifierSummary = apps.get_model("ezidapp",
+        "SearchIdentifierSummary")
+    SearchIdentifierSummary.objects.filter(count=0).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezidapp', '0032_searchidentifiertombstone'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='searchidentifiersummary',
+            name='owner',
+            field=ezidapp.models.custom_fields.NonValidatingForeignKey(to='ezidapp.SearchUser'),
+        ),
+        migrations.AlterField(
+            model_name='searchidentifiersummary',
+            name='ownergroup',
+            field=ezidapp.models.custom_fields.NonValidatingForeignKey(default=None, blank=True, to='ezidapp.SearchGroup', null=True),
+        ),
+        migrations.RunPython(deleteEmptyClasses, migrations.RunPython.noop,
+            hints={ "model_name": "searchidentifiersummary" }),
+    ]
@@ -8,6 +8,8 @@ from download_queue import DownloadQueue
 from group import Group
 from identifier import Identifier
 from link_checker import LinkChecker
+from minter_counter import MinterCounter
+from minter_reservation import MinterReservation
 from new_account_worksheet import NewAccountWorksheet
 from profile import Profile
 from realm import Realm
@@ -15,6 +17,8 @@ from registration_queue import RegistrationQueue
 from search_datacenter import SearchDatacenter
 from search_group import SearchGroup
 from search_identifier import SearchIdentifier
+from search_identifier_summary import SearchIdentifierSummary
+from search_identifier_tombstone import SearchIdentifierTombstone
 from search_profile import SearchProfile
 from search_realm import SearchRealm
 from search_user import SearchUser
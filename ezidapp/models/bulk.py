@@ -0,0 +1,102 @@
+# =============================================================================
+#
+# EZID :: ezidapp/models/bulk.py
+#
+# Multi-row database write operations not provided by Django.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.db
+
+# The maximum number of rows written per database statement.
+
+_maxBatchSize = 100
+
+def _connection (model):
+  return django.db.connections[django.db.router.db_for_write(model)]
+
+def _batchSize (connection, numParametersPerRow, objects):
+  return max(1, min(_maxBatchSize,
+    connection.ops.bulk_batch_size([None]*numParametersPerRow, objects)))
+
+def _dbValue (field, object, connection, add):
+  return field.get_db_prep_save(field.pre_save(object, add), connection)
+
+def update (model, objects):
+  # Writes multiple existing model instances using multi-row UPDATE
+  # statements of the form:
+  #
+  #   UPDATE ... SET f1 = CASE id WHEN ... THEN ... END, f2 = ...
+  #   WHERE id IN (...)
+  #
+  # All non-primary key fields are written.  This function should be
+  # called within a database transaction.
+  if len(objects) == 0: return
+  meta = model._meta
+  fields = [f for f in meta.concrete_fields if not f.primary_key]
+  connection = _connection(model)
+  qn = connection.ops.quote_name
+  batchSize = _batchSize(connection, 2*len(fields)+1, objects)
+  cursor = connection.cursor()
+  for i in range(0, len(objects), batchSize):
+    batch = objects[i:i+batchSize]
+    clauses = []
+    params = []
+    for f in fields:
+      clauses.append("%s = CASE %s%s END" % (qn(f.column), qn(meta.pk.column),
+        " WHEN %s THEN %s"*len(batch)))
+      for o in batch:
+        params.append(o.pk)
+        params.append(_dbValue(f, o, connection, False))
+    params.extend(o.pk for o in batch)
+    cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (qn(meta.db_table),
+      ", ".join(clauses), qn(meta.pk.column), ", ".join(["%s"]*len(batch))),
+      params)
+
+def supportsUpsert (model):
+  # Returns True if 'upsert' can be used with the database the model
+  # is stored in.
+  return _connection(model).vendor == "mysql"
+
+def upsert (model, objects, preservedFields=[], updateExpressions={}):
+  # Inserts or updates multiple model instances using MySQL multi-row
+  # INSERT ... ON DUPLICATE KEY UPDATE statements.  Rows are matched
+  # on the model's unique keys other than the primary key, which is
+  # never written.  When updating an existing row, fields listed in
+  # 'preservedFields' retain their existing values, and fields keyed
+  # in 'updateExpressions' are set to the corresponding SQL
+  # expressions (in which "VALUES(column)" refers to the new value and
+  # plain "column" to the existing value) instead of the new values.
+  # This function should be called within a database transaction.
+  if len(objects) == 0: return
+  assert supportsUpsert(model)
+  meta = model._meta
+  fields = [f for f in meta.concrete_fields if not f.primary_key]
+  connection = _connection(model)
+  qn = connection.ops.quote_name
+  assignments = []
+  for f in fields:
+    if f.name in preservedFields: continue
+    if f.name in updateExpressions:
+      assignments.append("%s = %s" % (qn(f.column),
+        updateExpressions[f.name]))
+    else:
+      assignments.append("%s = VALUES(%s)" % (qn(f.column), qn(f.column)))
+  batchSize = _batchSize(connection, len(fields), objects)
+  cursor = connection.cursor()
+  for i in range(0, len(objects), batchSize):
+    batch = objects[i:i+batchSize]
+    params = []
+    for o in batch:
+      params.extend(_dbValue(f, o, connection, True) for f in fields)
+    cursor.execute("INSERT INTO %s (%s) VALUES %s ON DUPLICATE KEY UPDATE %s" %\
+      (qn(meta.db_table), ", ".join(qn(f.column) for f in fields),
+      ", ".join(["(%s)" % ", ".join(["%s"]*len(fields))]*len(batch)),
+      ", ".join(assignments)), params)
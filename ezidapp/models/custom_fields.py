@@ -60,6 +60,12 @@ class NonValidatingForeignKey (django.db.models.ForeignKey):
   def validate (self, value, model_instance):
     pass
 
+def serializeStoreIdentifier (si):
+  # Returns a StoreIdentifier object in blob form (see
+  # StoreIdentifierObjectField).  Callers storing the same object in
+  # multiple places should call this once and store the blob.
+  return zlib.compress(django.core.serializers.serialize("json", [si]))
+
 class StoreIdentifierObjectField (django.db.models.BinaryField):
   # Stores a StoreIdentifier object as a gzipped
   # Django/JSON-serialized string (hereinafter "blob").  The object
@@ -77,7 +83,7 @@ class StoreIdentifierObjectField (django.db.models.BinaryField):
         if type(value) in [str, buffer]:
           v = value
         else:
-          v = zlib.compress(django.core.serializers.serialize("json", [value]))
+          v = serializeStoreIdentifier(value)
         return super(StoreIdentifierObjectField, self).get_db_prep_save(
           v, *args, **kwargs)
       except Exception, e:
@@ -0,0 +1,53 @@
+# =============================================================================
+#
+# EZID :: ezidapp/models/minter_counter.py
+#
+# Database model for the counters of EZID's local minters (see
+# noid_nog.py and noid_engine.py).  Counter values are reserved in
+# blocks using atomic, row-level updates, so that multiple server
+# processes can mint from the same minter without coordination.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.db
+import django.db.models
+import django.db.transaction
+
+class MinterCounter (django.db.models.Model):
+  # Describes the state of a local minter.
+
+  minter = django.db.models.URLField(max_length=255, unique=True)
+  # The absolute URL of the minter, as recorded in shoulders.
+
+  value = django.db.models.BigIntegerField(default=0)
+  # The next unreserved counter value.  Counter values are numbered
+  # from 0.
+
+  def __unicode__ (self):
+    return self.minter
+
+def reserve (minter, n):
+  # Atomically reserves 'n' consecutive counter values for a minter,
+  # creating the minter's counter if necessary.  Returns the first
+  # value reserved.  The update locks the counter's row until the
+  # transaction commits, so the value read back reflects our update
+  # alone.
+  while True:
+    with django.db.transaction.atomic():
+      if MinterCounter.objects.filter(minter=minter).\
+        update(value=django.db.models.F("value")+n) == 1:
+        return MinterCounter.objects.get(minter=minter).value-n
+      try:
+        with django.db.transaction.atomic():
+          MinterCounter.objects.create(minter=minter, value=n)
+        return 0
+      except django.db.IntegrityError:
+        # Another process created the counter first; try again.
+        pass
@@ -0,0 +1,71 @@
+# =============================================================================
+#
+# EZID :: ezidapp/models/minter_reservation.py
+#
+# Database model for identifiers that have been minted by noid nog
+# minters but not yet used.  Identifiers are minted in batches and
+# cached (see noid_nog.py); by recording each batch here before it is
+# put to use, identifiers left unused when a server process stops are
+# not lost, but are reused by the next process.  Because multiple
+# server processes may load the same reserved identifiers, an
+# identifier must be claimed (i.e., its row successfully deleted)
+# before it is used.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.db
+import django.db.models
+
+import util
+
+_batchSize = 500
+
+class MinterReservation (django.db.models.Model):
+  # Describes an unused identifier reserved from a minter.
+
+  minter = django.db.models.URLField(max_length=255, db_index=True)
+  # The absolute URL of the minter the identifier was minted by.
+
+  identifier = django.db.models.CharField(
+    max_length=util.maxIdentifierLength)
+  # The identifier as returned by the minter, i.e., a scheme-less ARK
+  # identifier, e.g., "13030/fk35717n0h".
+
+  def __unicode__ (self):
+    return self.identifier
+
+def reserve (minter, identifiers):
+  # Records identifiers newly minted by a minter.  Returns a list of
+  # (row ID, identifier) tuples in the order given.
+  MinterReservation.objects.bulk_create([MinterReservation(minter=minter,
+    identifier=id) for id in identifiers], batch_size=_batchSize)
+  d = {}
+  for i in range(0, len(identifiers), _batchSize):
+    d.update((id, pk) for pk, id in MinterReservation.objects.\
+      filter(minter=minter, identifier__in=identifiers[i:i+_batchSize]).\
+      values_list("id", "identifier"))
+  return [(d[id], id) for id in identifiers]
+
+def getReservations (minter):
+  # Returns all identifiers reserved from a minter as a list of (row
+  # ID, identifier) tuples in reservation order.
+  return list(MinterReservation.objects.filter(minter=minter).\
+    order_by("id").values_list("id", "identifier"))
+
+def claim (id):
+  # Claims a reserved identifier by deleting its row.  Returns True if
+  # the identifier was claimed, False if the row no longer exists
+  # (i.e., it was claimed by another process).
+  c = django.db.connections[django.db.router.db_for_write(MinterReservation)]
+  cursor = c.cursor()
+  cursor.execute("DELETE FROM %s WHERE %s = %%s" %\
+    (c.ops.quote_name(MinterReservation._meta.db_table),
+    c.ops.quote_name("id")), [id])
+  return cursor.rowcount == 1
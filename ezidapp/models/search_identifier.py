@@ -13,9 +13,12 @@
 #
 # -----------------------------------------------------------------------------
 
+import django.db
 import django.db.models
 import django.db.utils
+import urlparse
 
+import bulk
 import custom_fields
 import identifier
 import search_datacenter
@@ -27,6 +30,7 @@ import validation
 
 # Deferred imports...
 """
+import oai
 import util2
 """
 
@@ -59,6 +63,20 @@ class SearchIdentifier (identifier.Identifier):
   # too long to be fully indexed), this field is the last 255
   # characters of the target URL in reverse order.
 
+  targetHost = django.db.models.CharField(max_length=255, editable=False)
+  targetReversedHost = django.db.models.CharField(max_length=255,
+    editable=False)
+  targetPath = django.db.models.CharField(max_length=255, editable=False)
+  # Computed values.  To support searching for identifiers by target
+  # host and path prefix (e.g., to find all identifiers that point
+  # into a repository that is migrating), these fields hold the
+  # target URL's host, lowercased, e.g., "repo.example.org"; the host
+  # with its labels reversed and followed by a period, e.g.,
+  # "org.example.repo.", which allows a host and all its subdomains
+  # to be selected by prefix; and the path and query, e.g.,
+  # "/items/42?v=1", truncated to 255 characters.  See normalizeTarget
+  # below.
+
   # Citation metadata follows.  Which is to say, the following
   # metadata refers to the resource identified by the identifier, not
   # the identifier itself.
@@ -134,6 +152,14 @@ class SearchIdentifier (identifier.Identifier):
   # hasMetadata is True and if the target URL is not the default
   # target URL.
 
+  oaiDublinCoreRecord = django.db.models.TextField(editable=False)
+  oaiDataciteRecord = django.db.models.TextField(editable=False)
+  # Computed values: if oaiVisible is True, the identifier's OAI-PMH
+  # record metadata in the oai_dc and datacite formats, respectively,
+  # serialized and ready for inclusion in OAI-PMH responses (see
+  # oai.py); otherwise, or if the metadata could not be converted,
+  # empty.
+
   linkIsBroken = django.db.models.BooleanField(editable=False,
     default=False)
   # Computed value: True if the target URL is broken.  This field is
@@ -162,6 +188,8 @@ class SearchIdentifier (identifier.Identifier):
     super(SearchIdentifier, self).computeComputedValues()
     self.searchableTarget = self.target[::-1]\
       [:self._meta.get_field("searchableTarget").max_length]
+    self.targetHost, self.targetReversedHost, self.targetPath =\
+      normalizeTarget(self.target)
     self.resourceCreator = ""
     self.resourceTitle = ""
     self.resourcePublisher = ""
@@ -207,6 +235,17 @@ class SearchIdentifier (identifier.Identifier):
       not self.isTest
     self.oaiVisible = self.publicSearchVisible and self.hasMetadata and\
       self.target != self.defaultTarget
+    self.oaiDublinCoreRecord = ""
+    self.oaiDataciteRecord = ""
+    if self.oaiVisible:
+      import oai
+      # A conversion failure is not fatal here; the OAI-PMH interface
+      # will retry the conversion (and report any error) on demand.
+      try:
+        self.oaiDublinCoreRecord = oai.serializeMetadata(self, "oai_dc")
+        self.oaiDataciteRecord = oai.serializeMetadata(self, "datacite")
+      except Exception:
+        pass
     self.computeHasIssues()
 
   def fromLegacy (self, d):
@@ -219,7 +258,9 @@ class SearchIdentifier (identifier.Identifier):
     if self.isDatacite: self.datacenter = _getDatacenter(d["_d"])
 
   # Note that MySQL FULLTEXT indexes must be created outside Django;
-  # see .../etc/search-mysql-addendum.sql.
+  # see .../etc/search-mysql-addendum.sql.  Under SQLite, the
+  # equivalent index is an FTS table (see fulltextTable below) created
+  # by a migration.
 
   class Meta (identifier.Identifier.Meta):
     index_together = [
@@ -266,10 +307,31 @@ class SearchIdentifier (identifier.Identifier):
       ("publicSearchVisible", "resourcePublisherPrefix"),
       # general search
       ("searchableTarget",),
+      ("targetReversedHost", "targetPath"),
       # OAI
-      ("oaiVisible", "updateTime")
+      ("oaiVisible", "updateTime"),
+      ("oaiVisible", "ownergroup", "updateTime"),
+      ("oaiVisible", "identifier")
     ]
 
+def normalizeTarget (url):
+  # Returns a tuple (host, reversed host, path) as stored in the
+  # SearchIdentifier target fields of the same names.  The scheme,
+  # port, user information, and fragment are discarded.  A URL that
+  # can't be parsed or that lacks a host yields empty values.
+  try:
+    u = urlparse.urlsplit(url)
+    host = (u.hostname or "").rstrip(".")
+  except ValueError:
+    host = ""
+  if host == "": return ("", "", "")
+  path = u.path or "/"
+  if u.query != "": path += "?" + u.query
+  maxLength = SearchIdentifier._meta.get_field("targetPath").max_length
+  return (host[:maxLength],
+    (".".join(reversed(host.split("."))) + ".")[:maxLength],
+    path[:maxLength])
+
 # The following caches are only added to or replaced entirely;
 # existing entries are never modified.  Thus, with appropriate coding
 # below, they are threadsafe without needing locking.
@@ -345,6 +407,45 @@ def _getProfile (label):
     "label", label)
   return p
 
+# Under SQLite, fulltext searching is supported by an FTS (SQLite's
+# fulltext search extension) table that indexes the following fields
+# of SearchIdentifier and whose row IDs are SearchIdentifier row IDs.
+# The table is maintained by the functions below.
+
+fulltextTable = "ezidapp_searchidentifier_fts"
+fulltextFields = ["resourceCreator", "resourceTitle", "resourcePublisher",
+  "keywords"]
+
+def _connection ():
+  return django.db.connections[django.db.router.db_for_write(
+    SearchIdentifier)]
+
+def hasFulltextTable ():
+  # Returns True if the search database has a fulltext (FTS) table.
+  c = _connection()
+  if c.vendor != "sqlite": return False
+  cursor = c.cursor()
+  cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = %s",
+    [fulltextTable])
+  return cursor.fetchone()[0] > 0
+
+def _removeFromFulltextTable (cursor, ids):
+  cursor.execute("DELETE FROM %s WHERE rowid IN (%s)" % (fulltextTable,
+    ", ".join(["%s"]*len(ids))), ids)
+
+def _updateFulltextTable (identifiers):
+  # Reindexes identifiers after they have been inserted or updated.
+  if not hasFulltextTable(): return
+  cursor = _connection().cursor()
+  for j in range(0, len(identifiers), 500):
+    rows = list(SearchIdentifier.objects.filter(
+      identifier__in=identifiers[j:j+500]).values_list("id", *fulltextFields))
+    if len(rows) == 0: continue
+    _removeFromFulltextTable(cursor, [r[0] for r in rows])
+    cursor.executemany("INSERT INTO %s (rowid, %s) VALUES (%s)" %\
+      (fulltextTable, ", ".join(fulltextFields),
+      ", ".join(["%s"]*(len(fulltextFields)+1))), rows)
+
 def updateFromLegacy (identifier, metadata, forceInsert=False,
   forceUpdate=False):
   # Inserts or updates an identifier in the search database.  The
@@ -365,3 +466,51 @@ def updateFromLegacy (identifier, metadata, forceInsert=False,
   # checker update daemon runs it will correct the value, which is
   # some consolation.
   i.save(force_insert=forceInsert, force_update=forceUpdate)
+  _updateFulltextTable([identifier])
+
+def updateMultipleFromLegacy (entries):
+  # Inserts or updates multiple identifiers in the search database.
+  # 'entries' should be a list of (identifier, legacy representation)
+  # pairs; identifiers must be unique within the list.  Unlike
+  # updateFromLegacy, existing linkIsBroken values are preserved (and
+  # hasIssues computed accordingly).  This function should be called
+  # within a database transaction.
+  l = []
+  for identifier, metadata in entries:
+    i = SearchIdentifier(identifier=identifier)
+    i.fromLegacy(metadata)
+    i.my_full_clean()
+    l.append(i)
+  if bulk.supportsUpsert(SearchIdentifier):
+    # linkIsBroken is False in all new objects, hence their hasIssues
+    # values need only be OR'd with the existing linkIsBroken values.
+    bulk.upsert(SearchIdentifier, l, preservedFields=["linkIsBroken"],
+      updateExpressions={ "hasIssues": "(VALUES(hasIssues) OR linkIsBroken)" })
+  else:
+    existing = {}
+    for j in range(0, len(l), 500):
+      for id, identifier, linkIsBroken in SearchIdentifier.objects.\
+        filter(identifier__in=[i.identifier for i in l[j:j+500]]).\
+        values_list("id", "identifier", "linkIsBroken"):
+        existing[identifier] = (id, linkIsBroken)
+    updates = []
+    for i in l:
+      if i.identifier in existing:
+        i.id, i.linkIsBroken = existing[i.identifier]
+        i.computeHasIssues()
+        updates.append(i)
+    bulk.update(SearchIdentifier, updates)
+    SearchIdentifier.objects.bulk_create([i for i in l\
+      if i.identifier not in existing], batch_size=100)
+  _updateFulltextTable([i.identifier for i in l])
+
+def deleteMultiple (identifiers):
+  # Deletes multiple identifiers from the search database.  This
+  # function should be called within a database transaction.
+  hasFulltext = hasFulltextTable()
+  for j in range(0, len(identifiers), 500):
+    qs = SearchIdentifier.objects.filter(identifier__in=identifiers[j:j+500])
+    if hasFulltext:
+      ids = list(qs.values_list("id", flat=True))
+      if len(ids) > 0: _removeFromFulltextTable(_connection().cursor(), ids)
+    qs.delete()
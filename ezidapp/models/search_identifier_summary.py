@@ -0,0 +1,132 @@
+# =============================================================================
+#
+# EZID :: ezidapp/models/search_identifier_summary.py
+#
+# Database model for identifier counts in the search database.  Each
+# row counts the identifiers having a particular combination of owner,
+# owner group, status, hasIssues, linkIsBroken, and crossrefStatus, so
+# that counts over those columns (as required by the dashboard and
+# the manage page, for example) can be computed by summing a handful
+# of rows rather than by scanning the SearchIdentifier table.
+#
+# The table is maintained incrementally: a writer of SearchIdentifier
+# rows tallies the affected identifiers before and after modifying
+# them and applies the difference, within the same transaction.  See
+# backproc.py and linkcheck_update.py.  Should the table ever drift,
+# it can be recomputed from scratch by the ezidrebuildsearchsummary
+# management command.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.core.validators
+import django.db
+import django.db.models
+import django.db.transaction
+
+import custom_fields
+import search_group
+import search_identifier
+import search_user
+
+class SearchIdentifierSummary (django.db.models.Model):
+  # Stores the number of identifiers in a class of identifiers.
+
+  owner = custom_fields.NonValidatingForeignKey(search_user.SearchUser,
+    on_delete=django.db.models.CASCADE)
+  ownergroup = custom_fields.NonValidatingForeignKey(search_group.SearchGroup,
+    blank=True, null=True, default=None, on_delete=django.db.models.CASCADE)
+  status = django.db.models.CharField(max_length=1,
+    choices=search_identifier.SearchIdentifier._meta.get_field("status")\
+    .choices)
+  hasIssues = django.db.models.BooleanField()
+  linkIsBroken = django.db.models.BooleanField()
+  crossrefStatus = django.db.models.CharField(max_length=1, blank=True,
+    choices=search_identifier.SearchIdentifier._meta.get_field(
+    "crossrefStatus").choices)
+  # The class descriptor, corresponding to the like-named
+  # SearchIdentifier fields.  The table holds derived data only, so
+  # deleting a user or group simply deletes its rows.
+
+  count = django.db.models.IntegerField(
+    validators=[django.core.validators.MinValueValidator(0)])
+  # The number of identifiers in the class.
+
+  class Meta:
+    unique_together = ("owner", "ownergroup", "status", "hasIssues",
+      "linkIsBroken", "crossrefStatus")
+
+  def __unicode__ (self):
+    return "%d:%s:%s:%s:%s:%s=%d" % (self.owner_id, self.ownergroup_id,
+      self.status, self.hasIssues, self.linkIsBroken, self.crossrefStatus,
+      self.count)
+
+_classFields = ["owner_id", "ownergroup_id", "status", "hasIssues",
+  "linkIsBroken", "crossrefStatus"]
+
+def classOf (identifier):
+  # Returns the class (a tuple of values of the class descriptor
+  # fields) a SearchIdentifier object belongs to.
+  return tuple(getattr(identifier, f) for f in _classFields)
+
+def tally (identifiers):
+  # Returns the classes of the identifiers in a list of qualified
+  # identifiers, e.g., ["ark:/12345/foo", ...], as a dictionary
+  # mapping classes to counts.  Identifiers not in the search database
+  # are ignored.  The identifiers' rows are locked so that the tally
+  # remains accurate for the remainder of the enclosing transaction.
+  d = {}
+  for j in range(0, len(identifiers), 500):
+    for r in search_identifier.SearchIdentifier.objects.select_for_update()\
+      .filter(identifier__in=identifiers[j:j+500])\
+      .values_list(*_classFields):
+      d[r] = d.get(r, 0) + 1
+  return d
+
+def _adjust (c, n):
+  kw = dict(zip(_classFields, c))
+  if kw["ownergroup_id"] == None:
+    del kw["ownergroup_id"]
+    kw["ownergroup__isnull"] = True
+  if SearchIdentifierSummary.objects.filter(**kw).update(
+    count=django.db.models.F("count")+n) > 0:
+    # Empty classes are removed so that rows don't accumulate for
+    # users and groups that no longer own identifiers.
+    if n < 0: SearchIdentifierSummary.objects.filter(count=0, **kw).delete()
+    return
+  assert n > 0, "identifier summary count underflow"
+  try:
+    with django.db.transaction.atomic(using="search"):
+      SearchIdentifierSummary.objects.create(count=n,
+        **dict(zip(_classFields, c)))
+  except django.db.IntegrityError:
+    # Another process created the row first.
+    SearchIdentifierSummary.objects.filter(**kw).update(
+      count=django.db.models.F("count")+n)
+
+def adjust (before, after):
+  # Updates the table given 'before' and 'after' tallies (see tally
+  # above) of a set of identifiers that have been inserted, updated,
+  # and/or deleted.  This function should be called within the same
+  # database transaction that modified the identifiers.
+  for c in set(before.keys()) | set(after.keys()):
+    n = after.get(c, 0) - before.get(c, 0)
+    if n != 0: _adjust(c, n)
+
+def rebuild ():
+  # Recomputes the table from scratch.
+  with django.db.transaction.atomic(using="search"):
+    SearchIdentifierSummary.objects.all().delete()
+    SearchIdentifierSummary.objects.bulk_create(
+      [SearchIdentifierSummary(count=r["identifierCount"],
+      **dict((f, r[f]) for f in _classFields))\
+      for r in search_identifier.SearchIdentifier.objects.order_by()\
+      .values(*_classFields)\
+      .annotate(identifierCount=django.db.models.Count("id"))],
+      batch_size=500)
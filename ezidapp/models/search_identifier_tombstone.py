@@ -0,0 +1,83 @@
+# =============================================================================
+#
+# EZID :: ezidapp/models/search_identifier_tombstone.py
+#
+# Database model for identifiers that have been deleted from the OAI
+# feed, either because they were deleted outright or because they
+# ceased to be OAI-visible (see SearchIdentifier.oaiVisible).  The
+# OAI-PMH interface (see oai.py) reports these identifiers as deleted
+# records, which allows harvesters to remove them incrementally.
+# Tombstones are written by backproc.py and are kept indefinitely
+# ("persistent" deleted record support in OAI-PMH parlance); a
+# tombstone is removed if its identifier becomes OAI-visible again.
+#
+# Author:
+#   Greg Janee <gjanee@ucop.edu>
+#
+# License:
+#   Copyright (c) 2017, Regents of the University of California
+#   http://creativecommons.org/licenses/BSD/
+#
+# -----------------------------------------------------------------------------
+
+import django.db.models
+
+import custom_fields
+import search_group
+import search_identifier
+import util
+
+class SearchIdentifierTombstone (django.db.models.Model):
+  # Describes an identifier deleted from the OAI feed.
+
+  identifier = django.db.models.CharField(max_length=util.maxIdentifierLength,
+    unique=True)
+  # The identifier, qualified and normalized, e.g., "ark:/12345/foo".
+
+  ownergroup = custom_fields.NonValidatingForeignKey(search_group.SearchGroup,
+    blank=True, null=True, default=None,
+    on_delete=django.db.models.SET_NULL)
+  # The identifier's owner group at the time of deletion, for the
+  # purpose of determining OAI-PMH set membership.
+
+  deleteTime = django.db.models.IntegerField()
+  # The time the identifier was deleted as a Unix timestamp.
+
+  class Meta:
+    index_together = [
+      ("deleteTime",),
+      ("ownergroup", "deleteTime")
+    ]
+
+  def __unicode__ (self):
+    return self.identifier
+
+def getVisible (identifiers):
+  # Returns the OAI-visible identifiers among a list of qualified
+  # identifiers as a dictionary mapping each such identifier to its
+  # owner group's row ID.
+  d = {}
+  for j in range(0, len(identifiers), 500):
+    d.update(search_identifier.SearchIdentifier.objects.filter(
+      identifier__in=identifiers[j:j+500], oaiVisible=True)\
+      .values_list("identifier", "ownergroup_id"))
+  return d
+
+def record (before, after, deleteTimes):
+  # Updates the table given the visible identifiers (see getVisible
+  # above) among a set of identifiers before and after they were
+  # inserted, updated, and/or deleted.  'deleteTimes' should map
+  # identifiers to deletion times.  This function should be called
+  # within the same database transaction that modified the
+  # identifiers.
+  for identifier, ownergroup in before.items():
+    if identifier not in after:
+      if SearchIdentifierTombstone.objects.filter(identifier=identifier)\
+        .update(ownergroup=ownergroup,
+        deleteTime=deleteTimes[identifier]) == 0:
+        SearchIdentifierTombstone.objects.create(identifier=identifier,
+          ownergroup_id=ownergroup, deleteTime=deleteTimes[identifier])
+  l = after.keys()
+  for j in range(0, len(l), 500):
+    SearchIdentifierTombstone.objects.filter(identifier__in=l[j:j+500])\
+      .delete()
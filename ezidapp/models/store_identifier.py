@@ -17,6 +17,7 @@ import django.core.exceptions
 import django.db.models
 import re
 
+import bulk
 import custom_fields
 import identifier
 import shoulder
@@ -193,3 +194,37 @@ class StoreIdentifier (identifier.Identifier):
           { k: "Field is not settable." })
       else:
         self.cm[k] = d[k]
+
+# The maximum number of rows written per database statement.
+
+_bulkBatchSize = 100
+
+def createMultiple (objects):
+  # Inserts multiple new StoreIdentifier objects using multi-row
+  # inserts, and sets the objects' primary keys.  The objects should
+  # have been cleaned.  This method should be called within a
+  # database transaction.
+  StoreIdentifier.objects.bulk_create(objects, batch_size=_bulkBatchSize)
+  # Not all database backends return primary keys from bulk inserts.
+  l = [o for o in objects if o.pk == None]
+  for i in range(0, len(l), _bulkBatchSize):
+    ids = dict(StoreIdentifier.objects.filter(identifier__in=\
+      [o.identifier for o in l[i:i+_bulkBatchSize]]).\
+      values_list("identifier", "id"))
+    for o in l[i:i+_bulkBatchSize]: o.pk = ids[o.identifier]
+
+def updateMultiple (objects):
+  # Writes multiple existing StoreIdentifier objects using multi-row
+  # UPDATE statements.  The objects should have been cleaned.  This
+  # method should be called within a database transaction.
+  bulk.update(StoreIdentifier, objects)
+
+def deleteMultiple (objects):
+  # Deletes multiple existing StoreIdentifier objects using a single
+  # database delete per batch.  This method should be called within a
+  # database transaction.
+  for i in range(0, len(objects), _bulkBatchSize):
+    StoreIdentifier.objects.filter(pk__in=[o.pk for o in\
+      objects[i:i+_bulkBatchSize]]).delete()
+  # As is done by Model.delete.
+  for o in objects: o.pk = None
@@ -24,9 +24,14 @@ import django.db.models
 import time
 
 import custom_fields
+import notification
 import store_identifier
 import util
 
+# The maximum number of rows inserted per database statement.
+
+_bulkBatchSize = 500
+
 class UpdateQueue (django.db.models.Model):
   # Describes identifiers that were created, updated, or deleted, and
   # which are awaiting further, asynchronous processing.
@@ -96,3 +101,27 @@ def enqueue (object, operation, updateExternalServices=True, identifier=None):
     updateExternalServices=updateExternalServices)
   r.full_clean()
   r.save()
+  notification.signal("UpdateQueue")
+
+def enqueueMultiple (entries):
+  # Enqueues multiple StoreIdentifier objects using a single database
+  # insert.  'entries' should be a list of (object, operation,
+  # updateExternalServices) tuples, where 'object' is a
+  # StoreIdentifier object or an (identifier, blob) tuple, and
+  # 'operation' is as in 'enqueue'.  Objects are serialized exactly
+  # once.  Entries are enqueued in list order.  This method should be
+  # called within a database transaction that includes the
+  # identifiers' updates in the StoreIdentifier table.
+  t = int(time.time())
+  l = []
+  for object, operation, updateExternalServices in entries:
+    if isinstance(object, store_identifier.StoreIdentifier):
+      identifier = object.identifier
+      blob = custom_fields.serializeStoreIdentifier(object)
+    else:
+      identifier, blob = object
+    l.append(UpdateQueue(enqueueTime=t, identifier=identifier, object=blob,
+      operation=UpdateQueue.operationLabelToCode(operation),
+      updateExternalServices=updateExternalServices))
+  UpdateQueue.objects.bulk_create(l, batch_size=_bulkBatchSize)
+  notification.signal("UpdateQueue")
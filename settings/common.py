@@ -82,7 +82,8 @@ MIDDLEWARE_CLASSES = (
   "django.middleware.locale.LocaleMiddleware",
   "django.contrib.messages.middleware.MessageMiddleware",
   "django.contrib.auth.middleware.AuthenticationMiddleware",
-  "middleware.ExceptionScrubberMiddleware"
+  "middleware.ExceptionScrubberMiddleware",
+  "middleware.SearchLimitMiddleware"
 )
 
 ROOT_URLCONF = "settings.urls"
@@ -55,6 +55,9 @@ urlpatterns = django.conf.urls.patterns("",
   ("^status$", "api.getStatus"),
   ("^version$", "api.getVersion"),
   ("^download_request$", "api.batchDownloadRequest"),
+  ("^export$", "api.exportIdentifiers"),
+  ("^search_page$", "api.searchPage"),
+  ("^batch$", "api.batch"),
   ("^admin/pause$", "api.pause"),
   ("^admin/reload$", "api.reload"),
 
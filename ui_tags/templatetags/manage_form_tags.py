@@ -78,6 +78,7 @@ def column_head(request, field, fields_mapped, order_by, sort, primary_page):
     c['sort'] = 'desc'
   # If sorting, set result to first page
   if 'p' in c: c['p'] = 1
+  if 'cursor' in c: del c['cursor']
   form_and_hidden = "<form method='get' action='" + reverse(primary_page) +\
     "' role='form'>" + rewrite_hidden(c)
   r = "<th>" + escape(fields_mapped[field][1]) + form_and_hidden
@@ -133,8 +134,12 @@ def datetime_disp(x, href):
     " UTC</a>"
 
 @register.simple_tag
-def pager_display(request, current_page, total_pages, page_size, select_position):
-  if total_pages < 2: return ''
+def pager_display(request, current_page, total_pages, page_size, select_position,
+  next_cursor=None, prev_cursor=None, approximate=False):
+  """ Next and previous page buttons carry cursors for keyset pagination, if available.
+      If total_pages is an estimate, there is no last page button, and the next page
+      button is shown only if there is a next page """
+  if total_pages < 2 and not (approximate and next_cursor): return ''
   p_out = ''
   s_total = str(total_pages)
   empty = ''
@@ -142,19 +147,25 @@ def pager_display(request, current_page, total_pages, page_size, select_position
     p_out += page_link(request, 1, empty, page_size, 'pagination__first', \
       _("First page of results")) + ' '
     p_out += page_link(request, current_page - 1, _("Previous"), page_size,\
-      'pagination__prev', _("Previous page of results")) + ' '
+      'pagination__prev', _("Previous page of results"), prev_cursor) + ' '
   p_out += "<input id='page-directselect-" + select_position + \
            "' type='number' class='pagination__input' min='1' " + \
-           "max='"  + s_total  + "' name='p' value='" + str(current_page) + "'/> " + \
-           _("of") + " " + s_total + " "
-  if current_page < total_pages:
+           ("" if approximate else "max='"  + s_total  + "' ") + \
+           "name='p' value='" + str(current_page) + "'/> " + \
+           _("of") + " " + (_("about") + " " if approximate else "") + s_total + " "
+  if approximate:
+    if next_cursor:
+      p_out += page_link(request, current_page + 1, _("Next"), page_size, \
+        'pagination__next', _("Next page of results"), next_cursor) + ' '
+  elif current_page < total_pages:
     p_out += page_link(request, current_page + 1, _("Next"), page_size, \
-      'pagination__next', _("Next page of results")) + ' '
+      'pagination__next', _("Next page of results"), next_cursor) + ' '
     p_out += page_link(request, total_pages, empty, page_size, \
       'pagination__last', _("Last page of results")) + ' '
   return p_out
 
-def page_link(request, this_page, link_text, page_size, cname, title=None):
+def page_link(request, this_page, link_text, page_size, cname, title=None, cursor=None):
   attr_aria = " aria-label='" + title + "'" if title else ""
+  attr_cursor = " data-cursor='" + escape(cursor) + "'" if cursor else ""
   return "<button data-page='" + str(this_page) + "' class='" + cname + "'" + \
-    attr_aria + " type='button'>" + escape(link_text) + "</button>"
+    attr_aria + attr_cursor + " type='button'>" + escape(link_text) + "</button>"